@@ -134,9 +134,14 @@ TAGCLOUD_SIZE = 100
 # prefix for the system mails
 EMAIL_SUBJECT_PREFIX = '%s: ' % BASE_DOMAIN_NAME
 
+# number of subscriptions whose mails are sent by one task
+NOTIFICATION_CHUNK_SIZE = 500
+
 
 # forum settings
 FORUM_LIMIT_UNREAD = 100
+# number of the most recently updated topics searched for unread topics
+FORUM_NEWPOSTS_WINDOW = 5000
 FORUM_THUMBNAIL_SIZE = (64, 64)
 # time in seconds after posting a user is allowed to edit/delete his own posts,
 # for posts (without, with) replies. -1 for infinitely, 0 for never
@@ -147,6 +152,10 @@ FORUM_SURGE_PROTECTION_TIMEOUT = 90  # seconds
 
 FORUM_DISABLE_POSTING = False
 
+# planet settings
+# number of feeds that are fetched at the same time
+PLANET_SYNC_WORKERS = 8
+
 # Number of days a user is allowed to perform the respective action with his
 # user account.
 USER_REACTIVATION_LIMIT = 31
@@ -182,12 +191,18 @@ WIKI_REVISIONS_PER_PAGE = 100
 # wiki internal stuff like page or attachment lists.
 WIKI_CACHE_TIMEOUT = 60 * 60 * 2
 
+# Number of wiki pages rendered by one task of ``render_all_pages``.
+WIKI_RENDER_CHUNK_SIZE = 100
+
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = None
 
 
 # 24h is the recommended and tested Cache Timeout
 CACHE_TIMEOUT = 60 * 60 * 24
+# Expired rendered content is served this long while one worker renders it
+# again, instead of letting all workers wait for it.
+CONTENT_CACHE_STALE_TIME = 60 * 60
 # Cache Setup
 CACHES = {
     'default': {
@@ -195,6 +210,14 @@ CACHES = {
         'LOCATION': 'redis://127.0.0.1:6379/1',
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            # Uncomment to serve hot, read-mostly keys from a process-local
+            # LRU in front of redis (see inyoka.utils.cache.LocalCacheTier).
+            # 'LOCAL_CACHE': {
+            #     'KEYS': ('forum/forums/*', 'forum/slugs', 'wiki/objects_slugs',
+            #              'ikhaya/categories', 'storage/*'),
+            #     'MAX_SIZE': 16 * 1024 * 1024,
+            #     'TIMEOUT': 60,
+            # },
         },
         'TIMEOUT': CACHE_TIMEOUT
     },
@@ -278,6 +301,7 @@ CELERY_IMPORTS = [
     'inyoka.portal.tasks',
     'inyoka.planet.tasks',
     'inyoka.wiki.tasks',
+    'inyoka.forum.tasks',
     'inyoka.utils.notification',
     'inyoka.forum.notifications',
 ]
@@ -314,8 +338,20 @@ CELERY_BEAT_SCHEDULE = {
     },
     'render_all_wiki_pages': {
         'task': 'inyoka.wiki.tasks.render_all_pages',
-        'schedule': crontab(hour=23, minute=5),
-    }
+        'schedule': crontab(minute=5),
+    },
+    'flush_topic_view_counts': {
+        'task': 'inyoka.forum.tasks.flush_topic_view_counts',
+        'schedule': timedelta(minutes=5),
+    },
+    'flush_counters': {
+        'task': 'inyoka.portal.tasks.flush_counters',
+        'schedule': timedelta(minutes=5),
+    },
+    'reconcile_counters': {
+        'task': 'inyoka.portal.tasks.reconcile_counters',
+        'schedule': timedelta(hours=1),
+    },
 }
 
 
@@ -445,6 +481,8 @@ FORMAT_MODULE_PATH = 'inyoka.locale'
 
 # Used for user.post_count, forum.topic_count etc.
 COUNTER_CACHE_TIMEOUT = 60 * 60 * 24 * 2  # two days
+# Number of counters counted again by each run of the reconcile_counters task
+COUNTER_RECONCILE_BATCH = 1000
 
 # disable anonymous user creating in django-guardian
 ANONYMOUS_USER_NAME = 'anonymous'
@@ -21,6 +21,9 @@ POSTS_PER_PAGE = 15
 TOPICS_PER_PAGE = 30
 CACHE_PAGES_COUNT = 5
 
+#: first byte of the serialized `ReadStatus`, pickled data starts with 0x80
+READ_STATUS_VERSION = 1
+
 UBUNTU_DISTROS = {
     'none': gettext_lazy('No Ubuntu'),
     'edubuntu': gettext_lazy('Edubuntu'),
@@ -12,6 +12,7 @@ from typing import List, Optional
 import pickle
 import os
 import re
+from collections.abc import MutableMapping
 from datetime import datetime
 from functools import reduce
 from hashlib import md5
@@ -26,16 +27,18 @@ from django.contrib.auth.models import Group
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.db import models, transaction
-from django.db.models import Count, F, Max, Sum, QuerySet
+from django.db.models import Case, Count, F, Max, Sum, QuerySet, Value, When
 from django.utils.encoding import DjangoUnicodeDecodeError, force_str
 from django.utils.html import escape, format_html
 from django.utils.translation import gettext as _
 from django.utils.translation import pgettext, gettext_lazy
+from redis.exceptions import ResponseError
 from werkzeug.utils import secure_filename
 
 from inyoka.forum.constants import (
     CACHE_PAGES_COUNT,
     POSTS_PER_PAGE,
+    READ_STATUS_VERSION,
     SUPPORTED_IMAGE_TYPES,
     UBUNTU_DISTROS,
 )
@@ -43,7 +46,7 @@ from inyoka.forum.notifications import notify_reported_topic_subscribers
 from inyoka.portal.models import Subscription
 from inyoka.portal.user import User
 from inyoka.portal.utils import get_ubuntu_versions
-from inyoka.utils.cache import QueryCounter
+from inyoka.utils.cache import QueryCounter, register_counter
 from inyoka.utils.database import (
     InyokaMarkupField,
     LockableObject,
@@ -164,6 +167,7 @@ class ForumManager(models.Manager):
         else:
             forums = self.get_cached()
 
+        user.prefetch_perms(forums)
         if reverse:
             forums = [forum for forum in forums if not user.has_perm(priv, forum)]
         else:
@@ -214,8 +218,278 @@ class ForumManager(models.Manager):
             forum.save()
 
 
+class TopicOrder:
+    """
+    The ids of the topics of a forum in the order of the forum view: sticky
+    topics first, then ordered by their last post.
+
+    The order is kept in a redis sorted set per forum, so slicing it (as
+    `Pagination` does) is one ``ZREVRANGE`` however deep the page is.  The
+    set is built from the database when it is missing and updated by
+    :meth:`TopicManager.update_order` when topics change.  It expires after
+    ``TIMEOUT`` seconds, so a change missed while the set was built is not
+    kept forever.
+    """
+
+    #: sticky topics get this added to the id of their last post
+    STICKY_OFFSET = 2 ** 48
+
+    #: seconds until the set is built again
+    TIMEOUT = 60 * 60
+
+    #: only update an existing set, a missing one is built by the next reader
+    UPDATE_SCRIPT = ('if redis.call("exists", KEYS[1]) == 1 then '
+                     'redis.call("zadd", KEYS[1], ARGV[1], ARGV[2]) end')
+
+    def __init__(self, forum_id):
+        self.forum_id = forum_id
+        self.key = self.make_key(forum_id)
+
+    @staticmethod
+    def make_key(forum_id):
+        return cache.make_key(f'forum/topic_order/{forum_id}')
+
+    @classmethod
+    def score(cls, sticky, last_post_id):
+        return (cls.STICKY_OFFSET if sticky else 0) + (last_post_id or 0)
+
+    def build(self):
+        """Create the sorted set from the database."""
+        rows = Topic.objects.filter(forum_id=self.forum_id) \
+                            .values_list('id', 'sticky', 'last_post_id')
+        pipeline = cache.client.get_client().pipeline()
+        pipeline.delete(self.key)
+        if rows:
+            pipeline.zadd(self.key, {topic_id: self.score(sticky, last_post_id)
+                                     for topic_id, sticky, last_post_id in rows})
+            pipeline.expire(self.key, self.TIMEOUT)
+        pipeline.execute()
+
+    def count(self):
+        redis = cache.client.get_client()
+        if not redis.exists(self.key):
+            self.build()
+        return redis.zcard(self.key)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            raise TypeError('TopicOrder only supports slices')
+        start, stop = item.start or 0, item.stop
+        redis = cache.client.get_client()
+        ids = redis.zrevrange(self.key, start, -1 if stop is None else stop - 1)
+        if not ids and not redis.exists(self.key):
+            self.build()
+            ids = redis.zrevrange(self.key, start, -1 if stop is None else stop - 1)
+        return [int(topic_id) for topic_id in ids]
+
+
+class RecentTopics:
+    """
+    The ``FORUM_NEWPOSTS_WINDOW`` topics with the most recent posts, used
+    to find the unread topics of a user without sending the read topics to
+    the database.
+
+    The window is a redis sorted set of the topic ids scored by the id of
+    their last post and a hash with the forum and the ubuntu version of the
+    topics.  Like `TopicOrder` it is built from the database when it is
+    missing, updated by :meth:`TopicManager.update_order` and expires after
+    ``TopicOrder.TIMEOUT`` seconds.
+    """
+
+    #: add or update the topic if the window exists and drop the oldest
+    #: topics that do not fit into the window anymore
+    UPDATE_SCRIPT = '''
+        if redis.call("exists", KEYS[1]) == 0 then return end
+        redis.call("zadd", KEYS[1], ARGV[1], ARGV[2])
+        redis.call("hset", KEYS[2], ARGV[2], ARGV[3])
+        local old = redis.call("zrange", KEYS[1], 0, -tonumber(ARGV[4]) - 1)
+        if #old > 0 then
+            redis.call("zrem", KEYS[1], unpack(old))
+            redis.call("hdel", KEYS[2], unpack(old))
+        end
+    '''
+
+    def __init__(self):
+        self.key, self.data_key = self.make_keys()
+
+    @staticmethod
+    def make_keys():
+        key = cache.make_key('forum/recent_topics')
+        return key, key + ':data'
+
+    @staticmethod
+    def make_data(forum_id, ubuntu_version):
+        return f'{forum_id}:{ubuntu_version or ""}'
+
+    @classmethod
+    def update_args(cls, topic):
+        return (topic.last_post_id, topic.id,
+                cls.make_data(topic.forum_id, topic.ubuntu_version),
+                settings.FORUM_NEWPOSTS_WINDOW)
+
+    def build(self):
+        """Create the window from the database."""
+        rows = Topic.objects.exclude(first_post_id__isnull=True) \
+                            .exclude(last_post_id__isnull=True) \
+                            .order_by('-last_post_id') \
+                            .values_list('id', 'forum_id', 'last_post_id', 'ubuntu_version')
+        rows = rows[:settings.FORUM_NEWPOSTS_WINDOW]
+        pipeline = cache.client.get_client().pipeline()
+        pipeline.delete(self.key, self.data_key)
+        if rows:
+            pipeline.zadd(self.key, {topic_id: last_post_id
+                                     for topic_id, _, last_post_id, _ in rows})
+            pipeline.hset(self.data_key, mapping={
+                topic_id: self.make_data(forum_id, version)
+                for topic_id, forum_id, _, version in rows})
+            pipeline.expire(self.key, TopicOrder.TIMEOUT)
+            pipeline.expire(self.data_key, TopicOrder.TIMEOUT)
+        pipeline.execute()
+
+    def get(self):
+        """
+        Return ``(topic_id, forum_id, last_post_id, ubuntu_version)`` of the
+        topics in the window, the most recent first.
+        """
+        redis = cache.client.get_client(write=False)
+
+        def read():
+            pipeline = redis.pipeline()
+            pipeline.zrevrange(self.key, 0, -1, withscores=True)
+            pipeline.hgetall(self.data_key)
+            return pipeline.execute()
+
+        topics, data = read()
+        if not topics and not redis.exists(self.key):
+            # an empty window is not stored, so it is built only once here
+            self.build()
+            topics, data = read()
+
+        result = []
+        for topic_id, last_post_id in topics:
+            forum_id, version = data.get(topic_id, b':').decode('utf-8').split(':', 1)
+            if not forum_id:
+                # updated between the two queries
+                continue
+            result.append((int(topic_id), int(forum_id), int(last_post_id), version or None))
+        return result
+
+    def unread(self, read_status, forum_ids=None, ubuntu_version=None):
+        """
+        Return the ids of the topics in the window that are unread according
+        to `read_status`, optionally only the ones in `forum_ids` and with
+        `ubuntu_version`.
+        """
+        return [
+            topic_id for topic_id, forum_id, last_post_id, version in self.get()
+            if (forum_ids is None or forum_id in forum_ids)
+            and (ubuntu_version is None or version == ubuntu_version)
+            and not read_status.is_topic_read(forum_id, last_post_id)
+        ]
+
+
 class TopicManager(models.Manager):
 
+    #: redis hash with the views of the topics that are not written to the
+    #: database yet, see :meth:`flush_view_counts`.
+    view_count_key = 'forum/topic_view_counts'
+
+    def _view_count_keys(self):
+        key = cache.make_key(self.view_count_key)
+        return key, key + ':flushing'
+
+    def count_view(self, topic_id):
+        """Count a view of the topic in redis."""
+        cache.client.get_client().hincrby(self._view_count_keys()[0], topic_id, 1)
+
+    def prefetch_view_counts(self, topics):
+        """
+        Fetch the views of `topics` that are not written to the database yet
+        with one redis query, so that `Topic.current_view_count` does not need
+        to query redis again.
+        """
+        topics = list(topics)
+        if not topics:
+            return
+        ids = [topic.id for topic in topics]
+        pipeline = cache.client.get_client(write=False).pipeline(transaction=False)
+        for key in self._view_count_keys():
+            pipeline.hmget(key, ids)
+        pending, flushing = pipeline.execute()
+        for topic, *counts in zip(topics, pending, flushing):
+            topic._pending_view_count = sum(int(count) for count in counts if count)
+
+    def flush_view_counts(self, batch_size=500):
+        """
+        Write the views counted in redis to the database.
+
+        The hash is renamed first, so views counted in the meantime are not
+        lost.  If a flush failed, the renamed hash is written by the next one.
+        Only one flush runs at a time and the renamed hash is deleted right
+        before the transaction commits, so the views are never written twice.
+        """
+        lock = cache.lock(self.view_count_key + ':lock', timeout=600)
+        if not lock.acquire(blocking=False):
+            # another flush is running
+            return 0
+        try:
+            redis = cache.client.get_client()
+            key, flushing_key = self._view_count_keys()
+            if not redis.exists(flushing_key):
+                try:
+                    redis.rename(key, flushing_key)
+                except ResponseError:
+                    # no views were counted since the last flush
+                    return 0
+
+            counts = {int(topic_id): int(count) for topic_id, count
+                      in redis.hgetall(flushing_key).items()}
+            ids = sorted(counts)
+            with transaction.atomic():
+                for start in range(0, len(ids), batch_size):
+                    batch = ids[start:start + batch_size]
+                    increment = Case(*(When(id=topic_id, then=Value(counts[topic_id]))
+                                       for topic_id in batch),
+                                     output_field=models.IntegerField())
+                    self.get_queryset().filter(id__in=batch) \
+                        .update(view_count=F('view_count') + increment)
+                redis.delete(flushing_key)
+            return len(ids)
+        finally:
+            lock.release()
+
+    def update_order(self, topics, old_forum_id=None):
+        """
+        Update the position of `topics` in the `TopicOrder` of their forum
+        and in the `RecentTopics`, and remove them from the `TopicOrder` of
+        `old_forum_id` if they were moved.
+
+        The sets are updated once the transaction is committed, so a reader
+        that builds a missing set from the database sees the changes.
+        """
+        recent_keys = RecentTopics.make_keys()
+        pipeline = cache.client.get_client().pipeline(transaction=False)
+        for topic in topics:
+            pipeline.eval(TopicOrder.UPDATE_SCRIPT, 1, TopicOrder.make_key(topic.forum_id),
+                          TopicOrder.score(topic.sticky, topic.last_post_id), topic.id)
+            if old_forum_id is not None:
+                pipeline.zrem(TopicOrder.make_key(old_forum_id), topic.id)
+            if topic.first_post_id is None or topic.last_post_id is None:
+                pipeline.zrem(recent_keys[0], topic.id)
+                pipeline.hdel(recent_keys[1], topic.id)
+            else:
+                pipeline.eval(RecentTopics.UPDATE_SCRIPT, 2, *recent_keys,
+                              *RecentTopics.update_args(topic))
+        transaction.on_commit(pipeline.execute)
+
+    def remove_from_order(self, topic):
+        recent_keys = RecentTopics.make_keys()
+        pipeline = cache.client.get_client().pipeline(transaction=False)
+        pipeline.zrem(TopicOrder.make_key(topic.forum_id), topic.id)
+        pipeline.zrem(recent_keys[0], topic.id)
+        pipeline.hdel(recent_keys[1], topic.id)
+        transaction.on_commit(pipeline.execute)
+
     def prepare_for_overview(self, topic_ids):
         related = ('author', 'last_post', 'last_post__author', 'first_post',
                    'first_post__author')
@@ -602,8 +876,18 @@ class Topic(models.Model):
         return Forum.objects.get(self.forum_id)
 
     def touch(self):
-        """Increment the view count in a safe way."""
-        Topic.objects.filter(id=self.id).update(view_count=F('view_count') + 1)
+        """
+        Increment the view count.  The views are collected in redis and
+        written to the database by the `flush_topic_view_counts` task.
+        """
+        Topic.objects.count_view(self.id)
+
+    @property
+    def current_view_count(self):
+        """The view count including the views that are not flushed yet."""
+        if not hasattr(self, '_pending_view_count'):
+            Topic.objects.prefetch_view_counts([self])
+        return self.view_count + self._pending_view_count
 
     def move(self, new_forum):
         """Move the topic to another forum."""
@@ -645,6 +929,7 @@ class Topic(models.Model):
             Forum.objects.update_last_post(new_forums)
             Forum.objects.update_last_post(old_forums)
 
+        Topic.objects.update_order([self], old_forum_id=old_forum.id)
         old_forum.invalidate_topic_cache()
         new_forum.invalidate_topic_cache()
 
@@ -807,6 +1092,19 @@ class PostManager(models.Manager):
             last_post_map = {post.id: post for post in last_posts}
         return last_post_map
 
+    def prefetch_rendered(self, posts):
+        """Fetch the rendered texts of `posts` and the signatures of their
+        authors with a constant number of cache queries.
+
+        `posts` should be a list or an already evaluated QuerySet with the
+        authors selected, so the same instances are rendered later on.
+        """
+        posts = list(posts)
+        self.model._meta.get_field('text').prefetch_rendered(
+            [post for post in posts if not post.is_plaintext])
+        User._meta.get_field('signature').prefetch_rendered(
+            [post.author for post in posts if post.author.signature])
+
 
 class Post(models.Model, LockableObject):
     """Represents a post in a topic."""
@@ -1055,6 +1353,7 @@ class Post(models.Model, LockableObject):
             for forum in old_forums:
                 forum.post_count.decr(len(posts))
 
+        Topic.objects.update_order(Topic.objects.filter(pk__in=[old_topic.pk, new_topic.pk]))
         new_topic.forum.invalidate_topic_cache()
         old_topic.forum.invalidate_topic_cache()
 
@@ -1168,6 +1467,11 @@ class Post(models.Model, LockableObject):
         )
 
 
+register_counter('forum_post_count', Forum, 'post_count')
+register_counter('forum_topic_count', Forum, 'topic_count')
+register_counter('topic_post_count', Topic, 'post_count')
+
+
 class Attachment(models.Model):
     """Represents an attachment associated to a post."""
 
@@ -1414,13 +1718,140 @@ class Poll(models.Model):
         return not self.ended and not self.participated
 
 
+def _encode_varint(value, out):
+    """Append `value` as unsigned LEB128 varint to the bytearray `out`."""
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(data, pos):
+    """Return the varint at `pos` in `data` and the position after it."""
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class ReadStatusData(MutableMapping):
+    """
+    Mapping of ``forum_id -> (last_read_post_id, set_of_read_post_ids)``
+    stored in a compact binary format:
+
+    * one byte with the format version (``READ_STATUS_VERSION``)
+    * varint with the number of forums
+    * for each forum (ordered by id): varint with the difference to the
+      previous forum id, varint with the length of the record and the record
+    * a record is a varint with ``last_read_post_id + 1`` (``0`` for none),
+      varint with the number of post ids and the sorted post ids delta coded
+
+    Only the index is read on creation, the records are decoded when the
+    forum is accessed and :meth:`serialize` copies the records that were
+    never accessed without decoding them.  Data in the old pickle format is
+    read as well and converted when it is written the next time.
+
+    The data is still stored as one blob, so every mark writes the records
+    of all forums back to the database.
+    """
+
+    def __init__(self, serialized_data=None):
+        #: records that were not decoded yet
+        self._raw = {}
+        #: decoded records
+        self._rows = {}
+
+        if not serialized_data:
+            return
+        serialized_data = bytes(serialized_data)
+        if serialized_data[0] != READ_STATUS_VERSION:
+            self._rows = pickle.loads(serialized_data)
+            return
+
+        count, pos = _decode_varint(serialized_data, 1)
+        forum_id = 0
+        for i in range(count):
+            delta, pos = _decode_varint(serialized_data, pos)
+            length, pos = _decode_varint(serialized_data, pos)
+            forum_id += delta
+            self._raw[forum_id] = serialized_data[pos:pos + length]
+            pos += length
+
+    @staticmethod
+    def _decode_row(record):
+        last_post_id, pos = _decode_varint(record, 0)
+        count, pos = _decode_varint(record, pos)
+        post_ids = set()
+        post_id = 0
+        for i in range(count):
+            delta, pos = _decode_varint(record, pos)
+            post_id += delta
+            post_ids.add(post_id)
+        return (last_post_id - 1 if last_post_id else None, post_ids)
+
+    @staticmethod
+    def _encode_row(row):
+        last_post_id, post_ids = row
+        record = bytearray()
+        _encode_varint(0 if last_post_id is None else last_post_id + 1, record)
+        _encode_varint(len(post_ids), record)
+        previous = 0
+        for post_id in sorted(post_ids):
+            _encode_varint(post_id - previous, record)
+            previous = post_id
+        return bytes(record)
+
+    def __getitem__(self, forum_id):
+        if forum_id not in self._rows:
+            self._rows[forum_id] = self._decode_row(self._raw.pop(forum_id))
+        return self._rows[forum_id]
+
+    def __setitem__(self, forum_id, row):
+        self._raw.pop(forum_id, None)
+        self._rows[forum_id] = row
+
+    def __delitem__(self, forum_id):
+        if forum_id in self._raw:
+            del self._raw[forum_id]
+        else:
+            del self._rows[forum_id]
+
+    def __contains__(self, forum_id):
+        return forum_id in self._raw or forum_id in self._rows
+
+    def __iter__(self):
+        yield from self._raw
+        yield from self._rows
+
+    def __len__(self):
+        return len(self._raw) + len(self._rows)
+
+    def serialize(self):
+        out = bytearray((READ_STATUS_VERSION,))
+        _encode_varint(len(self), out)
+        previous = 0
+        for forum_id in sorted(self):
+            record = self._raw.get(forum_id)
+            if record is None:
+                record = self._encode_row(self._rows[forum_id])
+            _encode_varint(forum_id - previous, out)
+            _encode_varint(len(record), out)
+            out += record
+            previous = forum_id
+        return bytes(out)
+
+
 class ReadStatus:
     """
     Manages the read status of forums and topics for a specific user.
     """
 
     def __init__(self, serialized_data):
-        self.data = pickle.loads(serialized_data) if serialized_data else {}
+        self.data = ReadStatusData(serialized_data)
 
     def __call__(self, item):
         """
@@ -1435,12 +1866,20 @@ class ReadStatus:
         else:
             raise ValueError('Can\'t determine read status of an unknown type')
 
+        if is_forum:
+            row = self.data.get(forum_id, (None, []))
+            return bool(row[0] and row[0] >= post_id)
+        return self.is_topic_read(forum_id, post_id)
+
+    def is_topic_read(self, forum_id, last_post_id):
+        """
+        Return whether the topic in the forum `forum_id` with the last post
+        `last_post_id` was read.
+        """
         row = self.data.get(forum_id, (None, []))
-        if row[0] and row[0] >= post_id:
+        if row[0] and row[0] >= last_post_id:
             return True
-        elif is_forum:
-            return False
-        return post_id in row[1]
+        return last_post_id in row[1]
 
     def mark(self, item, user):
         """
@@ -1495,7 +1934,7 @@ class ReadStatus:
         self.data[parent_forum_id] = row
 
     def serialize(self):
-        return pickle.dumps(self.data)
+        return self.data.serialize()
 
 
 def mark_all_forums_read(user):
@@ -54,11 +54,13 @@ def post_save_topic(sender, **kwargs):
     instance = kwargs.get('instance')
     if kwargs.get('created', False):
         instance.forum.topic_count.incr()
+    Topic.objects.update_order([instance])
 
 
 @receiver(post_delete, sender=Topic)
 def post_delete_topic(sender, **kwargs):
     cache.delete('forum/reported_topic_count')
+    Topic.objects.remove_from_order(kwargs['instance'])
 
 
 @receiver(pre_save, sender=Post)
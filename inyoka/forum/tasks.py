@@ -0,0 +1,22 @@
+"""
+    inyoka.forum.tasks
+    ~~~~~~~~~~~~~~~~~~
+
+    Module that implements forum related tasks that must be executed by
+    our distributed queue implementation.
+
+    :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from celery import shared_task
+
+from inyoka.utils.logger import logger
+
+
+@shared_task
+def flush_topic_view_counts():
+    """Write the topic views counted in redis to the database."""
+    from inyoka.forum.models import Topic
+
+    count = Topic.objects.flush_view_counts()
+    logger.debug('Flushed the view counts of %s topics', count)
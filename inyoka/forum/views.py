@@ -46,7 +46,9 @@ from inyoka.forum.models import (
     PollVote,
     Post,
     PostRevision,
+    RecentTopics,
     Topic,
+    TopicOrder,
     mark_all_forums_read)
 from inyoka.forum.notifications import (
     send_deletion_notification,
@@ -56,11 +58,9 @@ from inyoka.forum.notifications import (
     send_notification_for_topics,
     notify_reported_topic_subscribers)
 from inyoka.markup.base import RenderContext, parse
-from inyoka.markup.parsertools import flatten_iterator
 from inyoka.portal.models import Subscription
 from inyoka.portal.user import User
 from inyoka.portal.utils import abort_access_denied
-from inyoka.utils.database import get_simplified_queryset
 from inyoka.utils.dates import format_datetime, _localtime
 from inyoka.utils.feeds import InyokaAtomFeed
 from inyoka.utils.flash_confirmation import confirm_action
@@ -149,10 +149,7 @@ def forum(request, slug, page=1):
     if unread_forum is not None:
         return redirect(url_for(unread_forum, 'welcome'))
 
-    topic_ids = Topic.objects.filter(forum=forum)\
-                             .values_list('id', flat=True)\
-                             .order_by('-sticky', '-last_post')
-    pagination = Pagination(request, topic_ids, page, TOPICS_PER_PAGE,
+    pagination = Pagination(request, TopicOrder(forum.id), page, TOPICS_PER_PAGE,
                             url_for(forum), total=forum.topic_count.value())
 
     subforums = [children for children in forum.children if request.user.has_perm('forum.view_forum', children)]
@@ -166,6 +163,7 @@ def forum(request, slug, page=1):
 
     for topic in topics:
         topic.forum = forum
+    Topic.objects.prefetch_view_counts(topics)
 
     context = {
         'forum': forum,
@@ -254,6 +252,9 @@ def viewtopic(request, topic_slug, page=1):
     for p in posts:
         p.topic = topic
 
+    # fetch all rendered texts with one cache query instead of one per post
+    Post.objects.prefetch_rendered(posts)
+
     # clear read status and subscriptions
     if request.user.is_authenticated:
         topic.mark_read(request.user)
@@ -1658,14 +1659,6 @@ def topiclist(request, page=1, action='newposts', hours=24, user=None, forum=Non
             title = _('Involved topics')
             url = href('forum', 'egosearch', forum)
     elif action == 'newposts':
-        forum_ids = tuple(forum.id for forum in Forum.objects.get_cached())
-        # get read status data
-        read_status = request.user._readstatus.data
-        read_topics = tuple(flatten_iterator(
-            read_status.get(id, [None, []])[1] for id in forum_ids
-        ))
-        if read_topics:
-            topics = topics.exclude(last_post__id__in=read_topics)
         url = href('forum', 'newposts', forum)
         title = _('New posts')
 
@@ -1679,11 +1672,21 @@ def topiclist(request, page=1, action='newposts', hours=24, user=None, forum=Non
         if forum_obj and forum_obj.id not in invisible:
             topics = topics.filter(forum=forum_obj)
 
-    total_topics = get_simplified_queryset(topics).count()
-    topics = topics.values_list('id', flat=True)
-    pagination = Pagination(request, topics, page, TOPICS_PER_PAGE, url,
-                            total=total_topics, max_pages=MAX_PAGES_TOPICLIST)
-    topic_ids = [tid for tid in pagination.get_queryset()]
+    if action == 'newposts':
+        if forum_obj and forum_obj.id not in invisible:
+            forum_ids = {forum_obj.id}
+        else:
+            forum_ids = set(Forum.objects.get_ids()).difference(invisible)
+        unread = RecentTopics().unread(request.user._readstatus, forum_ids,
+                                       request.GET.get('version'))
+        pagination = Pagination(request, unread, page, TOPICS_PER_PAGE, url,
+                                max_pages=MAX_PAGES_TOPICLIST)
+        topic_ids = pagination.get_queryset()
+    else:
+        pagination = Pagination(request, topics.only('id', 'last_post_id'), page,
+                                TOPICS_PER_PAGE, url, max_pages=MAX_PAGES_TOPICLIST,
+                                ordering=('-last_post_id',), approximate_total=True)
+        topic_ids = [topic.id for topic in pagination.get_queryset()]
 
     # check for moderation permissions
     moderatable_forums = [
@@ -1699,6 +1702,7 @@ def topiclist(request, page=1, action='newposts', hours=24, user=None, forum=Non
                    'first_post')
         topics = Topic.objects.filter(id__in=topic_ids).select_related(*related) \
                               .order_by('-last_post__id')
+        Topic.objects.prefetch_view_counts(topics)
     else:
         topics = []
 
@@ -1737,14 +1741,9 @@ def postlist(request, page=1, user=None, topic_slug=None, forum_slug=None):
     if hidden_ids:
         posts = posts.exclude(topic__forum__id__in=hidden_ids)
 
-    total_posts = get_simplified_queryset(posts).count()
-
-    # at least with MySQL we need this, as it is the fastest method
-    posts = posts.values_list('id', flat=True)
-
-    pagination = Pagination(request, posts, page, TOPICS_PER_PAGE, pagination_url,
-        total=total_posts, max_pages=MAX_PAGES_TOPICLIST)
-    post_ids = [post_id for post_id in pagination.get_queryset()]
+    pagination = Pagination(request, posts.only('id', 'pub_date'), page, TOPICS_PER_PAGE, pagination_url,
+        max_pages=MAX_PAGES_TOPICLIST, ordering=('-pub_date', '-id'), approximate_total=True)
+    post_ids = [post.id for post in pagination.get_queryset()]
 
     posts = Post.objects.filter(id__in=post_ids).order_by('-pub_date').select_related('topic', 'topic__forum', 'author')
 
@@ -70,8 +70,9 @@
     possibility to cache things in the cached stream.
 
     The code format is either a static string with a header prefix or a
-    pickled list with references to dynamic elements.  It may and will most
-    likely contain binary data, thus it should not be saved in the database.
+    pickled (and base64 encoded) list with references to dynamic elements.
+    Because the pickled elements depend on the code base, it should not be
+    saved in the database, but it's fine to cache it.
 
 
     Syntax
@@ -70,11 +70,13 @@ class rule:
     """
     This represents a parsing rule.
     """
-    __slots__ = ('match', 'token', 'enter', 'silententer', 'switch', 'leave')
+    __slots__ = ('regex', 'match', 'token', 'enter', 'silententer', 'switch',
+                 'leave')
 
     def __init__(self, regexp, token=None, enter=None, silententer=None,
                  switch=None, leave=0):
-        self.match = re.compile(regexp, re.U).match
+        self.regex = re.compile(regexp, re.U)
+        self.match = self.regex.match
         self.token = token
         self.enter = enter
         self.silententer = silententer
@@ -358,6 +360,9 @@ _block_start_re = re.compile(r'(?<!\\)\{\{\{')
 _block_end_re = re.compile(r'(?<!\\)\}\}\}')
 
 
+_flags_re = re.compile(r'^\(\?([a-z]+)\)')
+
+
 def iter_rules(x):
     for rule in rules[x]:
         if rule.__class__ is include:
@@ -366,7 +371,100 @@ def iter_rules(x):
             yield rule
 
 
-def tokenize_block(string, _escape_hint=None):
+class RuleMatch:
+    """
+    The part of a match of the :class:`CombinedScanner` that belongs to one
+    rule.  Behaves like the match of the rule's own regular expression.
+    """
+    __slots__ = ('_match', '_index', '_groups')
+
+    def __init__(self, match, index, groups):
+        self._match = match
+        self._index = index
+        self._groups = groups
+
+    def group(self):
+        return self._match.group(self._index)
+
+    def groups(self):
+        return tuple(map(self._match.group,
+                         range(self._index + 1, self._index + 1 + self._groups)))
+
+    def start(self):
+        return self._match.start()
+
+    def end(self):
+        return self._match.end()
+
+
+class CombinedScanner:
+    """
+    Finds the next rule of a state that matches.  All rules are joined into
+    one regular expression, every rule becomes a group of an alternation in
+    the order of the ruleset, so the first rule that matches wins just like
+    if they were tried one after another.
+    """
+
+    def __init__(self, rules):
+        parts = []
+        self.rules = {}
+        index = 1
+        for rule in rules:
+            pattern = rule.regex.pattern
+            # global flags are only allowed at the start of the expression
+            flags = _flags_re.match(pattern)
+            if flags is not None:
+                pattern = '(?%s:%s)' % (flags.group(1), pattern[flags.end():])
+            parts.append('(%s)' % pattern)
+            self.rules[index] = rule
+            index += 1 + rule.regex.groups
+        self.regex = re.compile('|'.join(parts), re.U)
+
+    def search(self, string, pos):
+        """
+        Return the first rule that matches at or after `pos` together with
+        its match or ``(None, None)``.
+        """
+        m = self.regex.search(string, pos)
+        if m is None or m.start() == len(string):
+            return None, None
+        index = m.lastindex
+        rule = self.rules[index]
+        return rule, RuleMatch(m, index, rule.regex.groups)
+
+
+class RuleScanner:
+    """
+    Finds the next rule of a state that matches by trying all rules at every
+    position.  This is much slower than the :class:`CombinedScanner`, but
+    obviously correct, so it's used as reference in the tests.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def search(self, string, pos):
+        for start in range(pos, len(string)):
+            for rule in self.rules:
+                m = rule.match(string, start)
+                if m is not None:
+                    return rule, m
+        return None, None
+
+
+_scanner_cache = {}
+
+
+def get_scanner(state, scanner_class=CombinedScanner):
+    try:
+        return _scanner_cache[scanner_class, state]
+    except KeyError:
+        scanner = scanner_class(list(iter_rules(state)))
+        _scanner_cache[scanner_class, state] = scanner
+        return scanner
+
+
+def tokenize_block(string, _escape_hint=None, scanner_class=CombinedScanner):
     """
     This tokenizes a block.  It's used by the normal tokenize function to
     lex quotes and normal markup isolated, so that breakage in one block
@@ -376,84 +474,87 @@ def tokenize_block(string, _escape_hint=None):
     pos = 0
     end = len(string)
     stack = [(None, 'everything')]
-    rule_cache = {}
     text_buffer = []
     add_text = text_buffer.append
     push = stack.append
     flatten = ''.join
 
     while pos < end:
-        state = stack[-1][1]
-        if state not in rule_cache:
-            rule_cache[state] = list(iter_rules(state))
-        for rule in rule_cache[state]:
-            m = rule.match(string, pos)
-            if m is not None:
-                # if the token is escaped we push the lexed
-                # value to the text buffer and ignore
-                if escaped or _escape_hint is not None:
-                    add_text(m.group())
-                    pos = m.end()
-                    if _escape_hint is not None:
-                        _escape_hint.append(m.start())
-                    escaped = False
-                    break
-
-                # first flush text that is left in the buffer
-                if text_buffer:
-                    text = flatten(text_buffer)
-                    if text:
-                        yield 'text', text
-                    del text_buffer[:]
-
-                # now enter the new scopes if entered in a
-                # non silent way
-                if rule.enter is not None:
-                    push((rule.enter + '_end', rule.enter))
-                    yield rule.enter + '_begin', m.group()
-                elif rule.silententer is not None:
-                    push((None, rule.silententer))
-
-                # now process the data
-                if callable(rule.token):
-                    yield from rule.token(m)
-                elif rule.token is not None:
-                    yield rule.token, m.group()
-
-                # now check if we leave something. if the state was
-                # entered non silent, send a close token.
-                pos = m.end()
-                for x in range(rule.leave):
-                    announce, item = stack.pop()
-                    if announce is not None:
-                        yield announce, m.group()
-
-                # switch to another state, postponing the nonsilent token
-                if rule.switch:
-                    announce, item = stack.pop()
-                    if announce is not None:
-                        push((announce, rule.switch))
-                break
-        else:
-            char = string[pos]
-            if char == '\\':
-                if escaped:
-                    # this is a fix for the problem that two backslashes
-                    # inside are displayed as one, even in code blocks
-                    if string[pos - 1] == '\\':
-                        char = '\\\\'
-                    else:
-                        char = ''
-                    escaped = False
-                else:
-                    escaped = True
-                    char = ''
+        rule, m = get_scanner(stack[-1][1], scanner_class).search(string, pos)
+        start = end if m is None else m.start()
+
+        # everything up to the next match is text
+        if start > pos:
+            if not escaped and '\\' not in string[pos:start]:
+                add_text(string[pos:start])
             else:
-                if escaped:
-                    char = '\\' + char
-                escaped = False
-            add_text(char)
-            pos += 1
+                for index in range(pos, start):
+                    char = string[index]
+                    if char == '\\':
+                        if escaped:
+                            # this is a fix for the problem that two backslashes
+                            # inside are displayed as one, even in code blocks
+                            if string[index - 1] == '\\':
+                                char = '\\\\'
+                            else:
+                                char = ''
+                            escaped = False
+                        else:
+                            escaped = True
+                            char = ''
+                    else:
+                        if escaped:
+                            char = '\\' + char
+                        escaped = False
+                    add_text(char)
+            pos = start
+            if m is None:
+                break
+
+        # if the token is escaped we push the lexed
+        # value to the text buffer and ignore
+        if escaped or _escape_hint is not None:
+            add_text(m.group())
+            pos = m.end()
+            if _escape_hint is not None:
+                _escape_hint.append(m.start())
+            escaped = False
+            continue
+
+        # first flush text that is left in the buffer
+        if text_buffer:
+            text = flatten(text_buffer)
+            if text:
+                yield 'text', text
+            del text_buffer[:]
+
+        # now enter the new scopes if entered in a
+        # non silent way
+        if rule.enter is not None:
+            push((rule.enter + '_end', rule.enter))
+            yield rule.enter + '_begin', m.group()
+        elif rule.silententer is not None:
+            push((None, rule.silententer))
+
+        # now process the data
+        if callable(rule.token):
+            yield from rule.token(m)
+        elif rule.token is not None:
+            yield rule.token, m.group()
+
+        # now check if we leave something. if the state was
+        # entered non silent, send a close token.
+        pos = m.end()
+        for x in range(rule.leave):
+            announce, item = stack.pop()
+            if announce is not None:
+                yield announce, m.group()
+
+        # switch to another state, postponing the nonsilent token
+        if rule.switch:
+            announce, item = stack.pop()
+            if announce is not None:
+                push((announce, rule.switch))
 
     # if there is a bogus escaped push a backslash
     if escaped:
@@ -487,6 +588,9 @@ def escape(text):
 
 class Lexer:
 
+    def __init__(self, scanner_class=CombinedScanner):
+        self.scanner_class = scanner_class
+
     def tokenize(self, string):
         """
         Resolve quotes and parse quote for quote in an isolated environment.
@@ -496,7 +600,8 @@ class Lexer:
         open_blocks = [False]
 
         def tokenize_buffer():
-            yield from tokenize_block('\n'.join(smart_str(obj) for obj in buffer))
+            yield from tokenize_block('\n'.join(smart_str(obj) for obj in buffer),
+                                      scanner_class=self.scanner_class)
             del buffer[:]
 
         def changes_block_state(line, reverse):
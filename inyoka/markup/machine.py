@@ -10,6 +10,7 @@
     :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+from base64 import b64decode, b64encode
 from pickle import dumps, loads, HIGHEST_PROTOCOL
 
 from django.utils.translation import gettext as _
@@ -24,7 +25,11 @@ class NodeCompiler:
     """
 
     def compile(self, format):
-        """Return a compiled instruction set."""
+        """
+        Return a compiled instruction set.  Static instruction sets are the
+        rendered text with a header, dynamic ones are pickled and base64
+        encoded, so both can be stored as text.
+        """
         assert not '\0' in format
         result = []
         text_buffer = []
@@ -44,7 +49,7 @@ class NodeCompiler:
 
         if not is_dynamic:
             return '!%s\0%s' % (format, ''.join(result))
-        return '@' + dumps((format, result), HIGHEST_PROTOCOL)
+        return '@' + b64encode(dumps((format, result), HIGHEST_PROTOCOL)).decode('ascii')
 
 
 class NodeRenderer:
@@ -176,12 +181,21 @@ class Renderer:
                 self.format = obj[1:pos]
                 self.instructions = [obj[pos + 1:]]
             elif obj[0] == '@':
-                self.format, self.instructions = loads(obj[1:])
+                self.format, self.instructions = loads(b64decode(obj[1:]))
         else:
             self.instructions = None
             self.node = obj
             self.format = None
 
+    @property
+    def is_static(self):
+        """
+        `True` if the renderer was constructed from an instruction set
+        without dynamic elements, so that it does not need a context.
+        """
+        return self.instructions is not None and \
+            all(isinstance(instruction, str) for instruction in self.instructions)
+
     def stream(self, context, format=None):
         """
         Creates a generator that yields the results of the instructions
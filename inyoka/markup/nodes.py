@@ -40,6 +40,37 @@ def error_box(title, message):
     ])
 
 
+def resolve_links(tree):
+    """
+    Resolve all `InternalLink` and `InterWikiLink` nodes in `tree` at once,
+    with one lookup in the slug index and in the linkmap, so that preparing
+    the links does not need a cache query per link.
+    """
+    internal_links = []
+    interwiki_links = []
+    for node in tree.query.all:
+        if isinstance(node, InternalLink) and not node.resolved:
+            internal_links.append(node)
+        elif isinstance(node, InterWikiLink) and not node.resolved:
+            interwiki_links.append(node)
+
+    if internal_links:
+        from inyoka.wiki.models import Page
+        existing = Page.objects.get_existing({node.page for node in internal_links})
+        for node in internal_links:
+            node.existing = node.page in existing
+            node.resolved = True
+
+    if interwiki_links:
+        inter_wiki_map = None
+        if any(node.token not in ('user', 'attachment') for node in interwiki_links):
+            Linkmap = apps.get_model(app_label='portal', model_name='Linkmap')
+            inter_wiki_map = Linkmap.objects.get_linkmap()
+        for node in interwiki_links:
+            node.target = node.resolve_interwiki_link(inter_wiki_map)
+            node.resolved = True
+
+
 def html_partial(template_name, block_level=False, **context):
     """
     Return a `HTMLOnly` node with the rendered template and an empty
@@ -382,6 +413,10 @@ class Document(Container):
     is_document = True
     allowed_in_signatures = True
 
+    def prepare_html(self):
+        resolve_links(self)
+        yield from Container.prepare_html(self)
+
 
 class Raw(Container):
     """
@@ -453,11 +488,13 @@ class InternalLink(Element):
             children = [Text(text)]
         Element.__init__(self, children, id, style, class_)
         self.existing = force_existing
+        #: if `existing` is known, see `resolve_links`
+        self.resolved = force_existing
         self.page = page
         self.anchor = anchor
 
     def prepare_html(self):
-        if not self.existing:
+        if not self.resolved:
             from inyoka.wiki.models import Page
             self.existing = Page.objects.exists(self.page)
         url = href('wiki', self.page)
@@ -488,9 +525,15 @@ class InterWikiLink(Element):
         self.token = token
         self.page = page
         self.anchor = anchor
+        #: if `target` is known, see `resolve_links`
+        self.resolved = False
+        self.target = None
 
     def prepare_html(self):
-        target = self.resolve_interwiki_link()
+        if self.resolved:
+            target = self.target
+        else:
+            target = self.resolve_interwiki_link()
 
         if target is None:
             yield from Element.prepare_html(self)
@@ -507,18 +550,20 @@ class InterWikiLink(Element):
         yield from Element.prepare_html(self)
         yield '</a>'
 
-    def resolve_interwiki_link(self):
+    def resolve_interwiki_link(self, inter_wiki_map=None):
         """
         Resolve an interwiki link. If the token does not exist, the return value
-        will be `None`.
+        will be `None`.  `inter_wiki_map` is fetched from the `Linkmap` if it
+        is not given.
         """
         if self.token == 'user':
             return href('portal', 'user', self.page)
         if self.token == 'attachment':
             return href('wiki', '_attachment', target=self.page)
 
-        Linkmap = apps.get_model(app_label='portal', model_name='Linkmap')
-        inter_wiki_map = Linkmap.objects.get_linkmap()
+        if inter_wiki_map is None:
+            Linkmap = apps.get_model(app_label='portal', model_name='Linkmap')
+            inter_wiki_map = Linkmap.objects.get_linkmap()
 
         if self.token not in inter_wiki_map:
             return None
@@ -27,12 +27,15 @@ r"""
 import re
 import random
 import operator
+import threading
+from collections import OrderedDict
 from functools import total_ordering, partial
 
+from django.core.cache import cache
 from django.utils.encoding import smart_str
 from django.utils.translation import gettext as _
 
-from inyoka.markup.base import escape, unescape_string
+from inyoka.markup.base import escape, parse, unescape_string
 from inyoka.markup.parsertools import TokenStream
 from inyoka.markup.utils import debug_repr, has_key, join_array, regex_match, simple_match
 from inyoka.wiki.exceptions import CaseSensitiveException
@@ -62,7 +65,7 @@ def expand_page_template(template, context, macro_behavior=False):
                                % {'name': template})
     except CaseSensitiveException as e:
         page = e.page
-    doc = page.rev.text.parse(context)
+    doc = parse(get_page_template(page).to_markup(Context(context)))
     children, is_block_tag = doc.get_fragment_nodes(True)
 
     # children is a reference to a list in a node.  We don't want to
@@ -72,6 +75,58 @@ def expand_page_template(template, context, macro_behavior=False):
     return nodes.Container(children)
 
 
+#: Number of parsed wiki templates kept in each process.
+PAGE_TEMPLATE_CACHE_SIZE = 256
+
+_page_templates = OrderedDict()
+_page_templates_lock = threading.Lock()
+
+
+def get_page_template(page):
+    """
+    Return the parsed template code of the current revision of the wiki
+    `page`.  Parsed templates are cached per page and revision in this
+    process and in redis, so a template used many times is parsed only once.
+    """
+    key = (page.id, page.rev.id)
+    with _page_templates_lock:
+        template = _page_templates.get(key)
+        if template is not None:
+            _page_templates.move_to_end(key)
+            return template
+
+    cache_key = 'wiki/page_template/%s' % page.id
+    cached = cache.get(cache_key)
+    if cached is not None and cached[0] == page.rev.id:
+        template = cached[1]
+    else:
+        template = Parser(page.rev.text.value).parse()
+        cache.set(cache_key, (page.rev.id, template))
+
+    with _page_templates_lock:
+        _page_templates[key] = template
+        while len(_page_templates) > PAGE_TEMPLATE_CACHE_SIZE:
+            _page_templates.popitem(last=False)
+    return template
+
+
+def invalidate_page_template(page_id=None):
+    """
+    Drop the parsed templates of the page with the id `page_id` or of all
+    pages if it is `None`.
+    """
+    with _page_templates_lock:
+        if page_id is None:
+            _page_templates.clear()
+        else:
+            for key in [key for key in _page_templates if key[0] == page_id]:
+                del _page_templates[key]
+    if page_id is None:
+        cache.delete_pattern('wiki/page_template/*')
+    else:
+        cache.delete('wiki/page_template/%s' % page_id)
+
+
 def ruleset(*args):
     return args
 
@@ -238,9 +293,9 @@ class Parser:
         left = self.parse_convert()
         functions = tuple(BINARY_FUNCTIONS)
         while self.stream.test('raw', functions):
-            func = BINARY_FUNCTIONS[self.stream.current.value]
+            name = self.stream.current.value
             next(self.stream)
-            left = BinaryFunction(left, self.parse_convert(), func)
+            left = BinaryFunction(left, self.parse_convert(), name)
         return left
 
     def parse_convert(self):
@@ -250,9 +305,9 @@ class Parser:
             if not self.stream.test('raw', tuple(CONVERTER)):
                 raise TemplateSyntaxError(
                     _('Unknown expression after “as” operator.'))
-            func = CONVERTER[self.stream.current.value]
+            name = self.stream.current.value
             next(self.stream)
-            left = ConverterFunction(left, func)
+            left = ConverterFunction(left, name)
         return left
 
     def parse_test(self):
@@ -267,9 +322,9 @@ class Parser:
             if not self.stream.test('raw', tuple(TESTS)):
                 raise TemplateSyntaxError(
                     _('Unknown expression after “is” operator'))
-            func = TESTS[self.stream.current.value]
+            name = self.stream.current.value
             next(self.stream)
-            left = TestFunction(left, func, negated)
+            left = TestFunction(left, name, negated)
         return left
 
     def parse_cmp(self):
@@ -906,36 +961,38 @@ class GetItem(Expr):
 
 
 class BinaryFunction(Expr):
+    # the functions are referenced by name so that parsed templates can be
+    # pickled.
 
-    def __init__(self, left, right, func):
+    def __init__(self, left, right, name):
         self.left = left
         self.right = right
-        self.func = func
+        self.name = name
 
     def evaluate(self, context):
-        return Value(self.func(self.left.evaluate(context),
-                               self.right.evaluate(context)))
+        return Value(BINARY_FUNCTIONS[self.name](self.left.evaluate(context),
+                                                 self.right.evaluate(context)))
 
 
 class ConverterFunction(Expr):
 
-    def __init__(self, expr, func):
+    def __init__(self, expr, name):
         self.expr = expr
-        self.func = func
+        self.name = name
 
     def evaluate(self, context):
-        return Value(self.func(self.expr.evaluate(context)))
+        return Value(CONVERTER[self.name](self.expr.evaluate(context)))
 
 
 class TestFunction(Expr):
 
-    def __init__(self, expr, func, negated):
+    def __init__(self, expr, name, negated):
         self.expr = expr
-        self.func = func
+        self.name = name
         self.negated = negated
 
     def evaluate(self, context):
-        rv = self.func(self.expr.evaluate(context))
+        rv = TESTS[self.name](self.expr.evaluate(context))
         if self.negated:
             return Value(not rv)
         return Value(bool(rv))
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planet', '0005_auto_20191027_1814'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blog',
+            name='feed_etag',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='blog',
+            name='feed_modified',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planet', '0006_blog_feed_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
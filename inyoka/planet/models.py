@@ -39,6 +39,9 @@ class Blog(models.Model):
     icon = models.ImageField(gettext_lazy('Icon'), upload_to='planet/icons', blank=True)
     last_sync = models.DateTimeField(blank=True, null=True)
     active = models.BooleanField(gettext_lazy('Index the blog'), default=True)
+    # validators of the last fetched feed, used for conditional requests
+    feed_etag = models.CharField(max_length=200, blank=True, default='')
+    feed_modified = models.CharField(max_length=100, blank=True, default='')
 
     @property
     def icon_url(self):
@@ -85,6 +88,8 @@ class Entry(models.Model):
     hidden = models.BooleanField(default=False)
     hidden_by = models.ForeignKey(User, blank=True, null=True,
                                   related_name='hidden_planet_posts', on_delete=models.CASCADE)
+    # hash of the synced fields, used to skip unchanged entries while syncing
+    content_hash = models.CharField(max_length=40, blank=True, default='')
 
     def __str__(self):
         return '%s / %s' % (
@@ -19,12 +19,15 @@ import urllib
 import socket
 # And further patch it so feedparser works :/
 import xml.sax
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from time import time
+from hashlib import sha1
 
 import feedparser
 from celery import shared_task
 from dateutil.parser import parse as dateutil_parse
+from django.conf import settings
+from django.db import transaction
 from django.utils.encoding import force_str
 from django.utils.html import escape
 
@@ -59,114 +62,245 @@ def dateutilDateHandler(aDateString):
 feedparser.registerDateHandler(dateutilDateHandler)
 
 
-@shared_task
-def sync():
+def fetch_feed(url, etag=None, modified=None):
     """
-    Performs a synchronization. Articles that are already syncronized aren't
-    touched anymore.
+    Fetch and parse a feed.  `etag` and `modified` are the validators of
+    the last fetched version, if the feed did not change since then the
+    server answers with status 304 and the feed has no entries.
+
+    Returns `None` if the feed could not be fetched.
     """
-    for blog in Blog.objects.filter(active=True):
-        logger.debug('syncing blog %s' % blog.name)
-        # parse the feed. feedparser.parse will never given an exception
-        # but the bozo bit might be defined.
-        try:
-            feed = feedparser.parse(blog.feed_url)
-        except (LookupError, urllib.error.URLError, socket.timeout, ConnectionError, ssl.SSLError) as e:
-            logger.debug('%s on %s' % (repr(e), blog.feed_url))
-            continue
+    # feedparser.parse will never given an exception but the bozo bit might
+    # be defined.
+    try:
+        return feedparser.parse(url, etag=etag or None, modified=modified or None)
+    except (LookupError, urllib.error.URLError, socket.timeout, ConnectionError, ssl.SSLError) as e:
+        logger.debug('%s on %s' % (repr(e), url))
+        return None
 
-        blog_author = feed.get('author') or blog.name
-        blog_author_detail = feed.get('author_detail')
 
-        for entry in feed.entries:
-            # get the guid. either the id if specified, otherwise the link.
-            # if none is available we skip the entry.
-            guid = entry.get('id') or entry.get('link')
-            if not guid:
-                logger.debug(' no guid found, skipping')
-                continue
+def parse_entries(feed, blog_name, blog_url):
+    """
+    Return a list of dicts with the fields of the `Entry` objects for the
+    entries of `feed`.  Invalid entries are skipped.  This does not touch
+    the database, so it can run in the threads that fetch the feeds.
+    """
+    blog_author = feed.get('author') or blog_name
+    blog_author_detail = feed.get('author_detail')
+
+    entries = []
+    for entry in feed.entries:
+        # get the guid. either the id if specified, otherwise the link.
+        # if none is available we skip the entry.
+        guid = entry.get('id') or entry.get('link')
+        if not guid:
+            logger.debug(' no guid found, skipping')
+            continue
+        # the ids in the html have to be unique on the page but must not
+        # change on every sync, otherwise the entry is written every time.
+        id_hash = sha1(guid.encode('utf-8')).hexdigest()[:8]
 
-            try:
-                old_entry = Entry.objects.get(guid=guid)
-            except Entry.DoesNotExist:
-                old_entry = None
-
-            # get title, url and text. skip if no title or no text is
-            # given. if the link is missing we use the blog link.
-            if entry.get('title_detail'):
-                title = entry.title_detail.get('value') or ''
-                if entry.title_detail.get('type') in HTML_MIMETYPES:
-                    title = cleanup_html(title, make_xhtml=True,
-                                         id_prefix='entry-title-%x' % int(time()))
-                    # cleanup_html adds <p> around the text, remove it again
-                    title = title[3:-4]
-                else:
-                    title = escape(title)
+        # get title, url and text. skip if no title or no text is
+        # given. if the link is missing we use the blog link.
+        if entry.get('title_detail'):
+            title = entry.title_detail.get('value') or ''
+            if entry.title_detail.get('type') in HTML_MIMETYPES:
+                title = cleanup_html(title, make_xhtml=True,
+                                     id_prefix='entry-title-%s' % id_hash)
+                # cleanup_html adds <p> around the text, remove it again
+                title = title[3:-4]
             else:
-                logger.debug(' no title found for %r, skipping' % guid)
-                continue
+                title = escape(title)
+        else:
+            logger.debug(' no title found for %r, skipping' % guid)
+            continue
 
-            url = entry.get('link') or blog.blog_url
-            text = 'content' in entry and entry.content[0] or \
-                   entry.get('summary_detail')
+        url = entry.get('link') or blog_url
+        text = 'content' in entry and entry.content[0] or \
+               entry.get('summary_detail')
 
-            if not text:
-                logger.debug('no text found for %r, skipping' % guid)
-                continue
+        if not text:
+            logger.debug('no text found for %r, skipping' % guid)
+            continue
 
-            # if we have an html text we use that, otherwise we HTML
-            # escape the text and use that one. We also handle XHTML
-            # with our tag soup parser for the moment.
-            if text.get('type') in HTML_MIMETYPES:
-                text = cleanup_html(text.get('value') or '', make_xhtml=True,
-                                    id_prefix='entry-text-%x' % int(time()))
-            else:
-                text = escape(nl2p(text.get('value') or ''))
-
-            # get the pub date and updated date. This is rather complex
-            # because different feeds do different stuff
-            pub_date = entry.get('published_parsed') or \
-                entry.get('created_parsed') or \
-                entry.get('date_parsed')
-            updated = entry.get('updated_parsed') or pub_date
-            pub_date = pub_date or updated
-
-            # if we don't have a pub_date we skip.
-            if not pub_date:
-                logger.debug(' no pub_date for %r found, skipping' % guid)
-                continue
+        # if we have an html text we use that, otherwise we HTML
+        # escape the text and use that one. We also handle XHTML
+        # with our tag soup parser for the moment.
+        if text.get('type') in HTML_MIMETYPES:
+            text = cleanup_html(text.get('value') or '', make_xhtml=True,
+                                id_prefix='entry-text-%s' % id_hash)
+        else:
+            text = escape(nl2p(text.get('value') or ''))
+
+        # get the pub date and updated date. This is rather complex
+        # because different feeds do different stuff
+        pub_date = entry.get('published_parsed') or \
+            entry.get('created_parsed') or \
+            entry.get('date_parsed')
+        updated = entry.get('updated_parsed') or pub_date
+        pub_date = pub_date or updated
+
+        # if we don't have a pub_date we skip.
+        if not pub_date:
+            logger.debug(' no pub_date for %r found, skipping' % guid)
+            continue
+
+        # convert the time tuples to datetime objects.
+        pub_date = datetime(*pub_date[:6])
+        updated = datetime(*updated[:6])
+
+        # get the blog author or fall back to blog default.
+        author = entry.get('author') or blog_author
+        author_detail = entry.get('author_detail') or blog_author_detail
+        if not author and author_detail:
+            author = author_detail.get('name')
+        if not author:
+            logger.debug(' no author for entry %r found, skipping' % guid)
+        author_homepage = author_detail and author_detail.get('href') \
+            or url
+
+        entries.append({
+            'guid': guid,
+            'title': title,
+            'url': url,
+            'text': text,
+            'pub_date': pub_date,
+            'updated': updated,
+            'author': author,
+            'author_homepage': author_homepage,
+        })
+    return entries
+
+
+def fetch_blog(feed_url, etag, modified, blog_name, blog_url):
+    """
+    Fetch and parse the feed of a blog.  Returns the parsed feed (or `None`
+    on errors) and the list of entries (see `parse_entries`).
+    """
+    logger.debug('fetching feed %s' % feed_url)
+    feed = fetch_feed(feed_url, etag, modified)
+    if feed is None or feed.get('status') == 304:
+        return feed, []
+    return feed, parse_entries(feed, blog_name, blog_url)
 
-            # convert the time tuples to datetime objects.
-            pub_date = datetime(*pub_date[:6])
-            updated = datetime(*updated[:6])
-
-            # get the blog author or fall back to blog default.
-            author = entry.get('author') or blog_author
-            author_detail = entry.get('author_detail') or blog_author_detail
-            if not author and author_detail:
-                author = author_detail.get('name')
-            if not author:
-                logger.debug(' no author for entry %r found, skipping' % guid)
-            author_homepage = author_detail and author_detail.get('href') \
-                or url
-
-            # create a new entry object based on the data collected or
-            # update the old one.
-            entry = old_entry or Entry()
-            for n in ('blog', 'guid', 'title', 'url', 'text', 'pub_date',
-                      'updated', 'author', 'author_homepage'):
+
+#: the fields of `Entry` that are set by `save_entries`
+SYNCED_FIELDS = ('blog', 'title', 'url', 'text', 'pub_date', 'updated',
+                 'author', 'author_homepage', 'content_hash')
+
+
+def get_content_hash(blog, data):
+    """Return a hash of the entry `data` as returned by `parse_entries`."""
+    content = repr((blog.id,) + tuple(data[n] for n in sorted(data)))
+    return sha1(content.encode('utf-8')).hexdigest()
+
+
+def save_entries(blog, entries):
+    """
+    Create or update the `Entry` objects of `blog`.
+
+    The existing entries are fetched with one query and only written if
+    the hash of their content changed.  If writing them at once fails, they
+    are saved one by one and the failing entries are skipped.  Returns a dict
+    with the number of ``inserted``, ``updated``, ``skipped`` and ``failed``
+    entries.
+    """
+    entries_by_guid = {}
+    for data in entries:
+        # truncate the values to the length of the fields
+        for n, value in data.items():
+            if isinstance(value, str):
+                max_length = Entry._meta.get_field(n).max_length
+                data[n] = force_str(value[:max_length])
+        # a feed can contain an entry twice, the last one wins.
+        entries_by_guid[data['guid']] = data
+
+    existing = Entry.objects.filter(guid__in=list(entries_by_guid)) \
+                            .only('id', 'guid', 'blog_id', 'content_hash')
+    existing = {entry.guid: entry for entry in existing}
+
+    new, changed = [], []
+    for guid, data in entries_by_guid.items():
+        content_hash = get_content_hash(blog, data)
+        entry = existing.get(guid)
+        if entry is None:
+            entry = Entry(guid=guid)
+            new.append(entry)
+        elif entry.content_hash != content_hash:
+            changed.append(entry)
+        else:
+            continue
+
+        entry.blog = blog
+        entry.content_hash = content_hash
+        for n, value in data.items():
+            setattr(entry, n, value)
+
+    counts = {
+        'inserted': len(new),
+        'updated': len(changed),
+        'skipped': len(entries_by_guid) - len(new) - len(changed),
+        'failed': 0,
+    }
+    try:
+        with transaction.atomic():
+            Entry.objects.bulk_create(new)
+            Entry.objects.bulk_update(changed, SYNCED_FIELDS)
+    except Exception as exc:
+        logger.debug(' Error on entries of %s: %r, saving them one by one' % (blog.name, exc))
+        for count, objects, update_fields in (('inserted', new, None),
+                                              ('updated', changed, SYNCED_FIELDS)):
+            for entry in objects:
                 try:
-                    max_length = entry._meta.get_field(n).max_length
-                except AttributeError:
-                    max_length = None
-                if isinstance(locals()[n], str):
-                    setattr(entry, n, force_str(locals()[n][:max_length]))
-                else:
-                    setattr(entry, n, locals()[n])
-            try:
-                entry.save()
-                logger.debug(' synced entry %r' % guid)
-            except Exception as exc:
-                logger.debug(' Error on entry %r: %r' % (guid, exc))
-        blog.last_sync = datetime.utcnow()
-        blog.save()
+                    with transaction.atomic():
+                        entry.save(force_insert=update_fields is None,
+                                   update_fields=update_fields)
+                except Exception as exc:
+                    logger.debug(' Error on entry %r: %r' % (entry.guid, exc))
+                    counts[count] -= 1
+                    counts['failed'] += 1
+
+    logger.debug(' synced entries of %s: %s inserted, %s updated, %s skipped, %s failed' % (
+        blog.name, counts['inserted'], counts['updated'], counts['skipped'], counts['failed']))
+    return counts
+
+
+@shared_task
+def sync():
+    """
+    Performs a synchronization. Articles that are already syncronized aren't
+    touched anymore.
+
+    The feeds are fetched and parsed by ``PLANET_SYNC_WORKERS`` threads,
+    the entries are written to the database in this thread as soon as a
+    feed is ready.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+    blogs = list(Blog.objects.filter(active=True))
+    with ThreadPoolExecutor(max_workers=settings.PLANET_SYNC_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch_blog, blog.feed_url, blog.feed_etag,
+                            blog.feed_modified, blog.name, blog.blog_url): blog
+            for blog in blogs
+        }
+        for future in as_completed(futures):
+            blog = futures[future]
+            feed, entries = future.result()
+            if feed is None:
+                continue
+
+            logger.debug('syncing blog %s' % blog.name)
+            saved = save_entries(blog, entries)
+            for name, count in saved.items():
+                counts[name] += count
+            # keep the old validators if entries failed, so that the feed is
+            # fetched completely again next time
+            if feed.get('status') != 304 and not saved['failed']:
+                blog.feed_etag = feed.get('etag') or ''
+                blog.feed_modified = feed.get('modified') or ''
+            blog.last_sync = datetime.utcnow()
+            blog.save(update_fields=('last_sync', 'feed_etag', 'feed_modified'))
+
+    logger.info('Planet synced: %(inserted)s entries inserted, %(updated)s updated, '
+                '%(skipped)s skipped, %(failed)s failed' % counts)
+    return counts
@@ -813,6 +813,7 @@ class GroupGlobalPermissionForm(forms.Form):
             for app in self.MANAGED_APPS:
                 self._sync_permissions(app)
             cache.delete_pattern('/acl/*')
+            User.objects.clear_special_users_cache()
 
     def __init__(self, *args, **kwargs):
         initial = {}
@@ -903,6 +904,7 @@ class GroupForumPermissionForm(forms.Form):
             for perm in delete_permissions:
                 remove_perm(perm, self.instance, forum)
         cache.delete_pattern('/acl/*')
+        User.objects.clear_special_users_cache()
 
 
 class PrivateMessageForm(forms.Form):
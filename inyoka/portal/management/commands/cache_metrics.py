@@ -0,0 +1,38 @@
+"""
+    inyoka.portal.management.commands.cache_metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides a command to the Django ``manage.py`` file that
+    outputs how often and how long cache values were created by
+    ``get_or_set()``.
+
+    :copyright: (c) 2011-2024 by the Inyoka Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Outputs how often and how long cache values were created"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', default=False,
+                            help='Reset the metrics after printing them.')
+
+    def handle(self, *args, **options):
+        for alias in settings.CACHES:
+            cache = caches[alias]
+            if not hasattr(cache, 'get_rebuild_metrics'):
+                continue
+            metrics = cache.get_rebuild_metrics()
+            for name, values in sorted(metrics.items(),
+                                       key=lambda item: -item[1]['seconds']):
+                average = values['seconds'] / values['count'] if values['count'] else 0
+                self.stdout.write(
+                    f"{alias}\t{name}\t{values['count']} times\t"
+                    f"{average:.3f}s average\t{values['slow']} slow"
+                )
+            if options['reset']:
+                cache.reset_rebuild_metrics()
@@ -0,0 +1,41 @@
+"""
+    inyoka.portal.management.commands.counter_drift
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module provides a command to the Django ``manage.py`` file that
+    counts the stored counters again and outputs the ones that drifted.
+
+    :copyright: (c) 2011-2024 by the Inyoka Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from django.core.management.base import BaseCommand
+
+from inyoka.portal.models import Counter
+
+
+class Command(BaseCommand):
+    help = "Outputs the counters that differ from the counted value"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='',
+                            help='Only check counters with keys starting with this prefix, '
+                                 'e.g. forum_post_count.')
+        parser.add_argument('--fix', action='store_true', default=False,
+                            help='Store the counted values of the drifted counters and remove '
+                                 'the counters of deleted objects.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of counters counted at once.')
+
+    def handle(self, *args, **options):
+        if options['fix']:
+            Counter.objects.flush()
+        keys = list(Counter.objects.filter(key__startswith=options['prefix'])
+                    .order_by('key').values_list('key', flat=True))
+        batch_size = options['batch_size']
+        drifted = 0
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            for key, value, counted in Counter.objects.reconcile(batch, fix=options['fix']):
+                drifted += 1
+                self.stdout.write(f'{key}\t{value}\t{counted}\t{value - counted:+d}')
+        self.stdout.write(f'{drifted} of {len(keys)} counters drifted')
@@ -11,6 +11,7 @@ import os
 import glob
 import gzip
 import hashlib
+from datetime import datetime
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -18,10 +19,13 @@ from django.contrib.contenttypes.models import ContentType, ContentTypeManager
 from django.core.cache import cache
 from django.core.validators import RegexValidator
 from django.db import models, transaction
+from django.db.models import Case, F, Value, When
 from django.utils.translation import gettext_lazy
 from django.utils.functional import cached_property
+from redis.exceptions import ResponseError
 
 from .user import User
+from inyoka.utils.cache import get_counter
 from inyoka.utils.database import InyokaMarkupField
 from inyoka.utils.urls import href
 from inyoka.wiki.acl import has_privilege as have_wiki_privilege
@@ -448,3 +452,162 @@ class Linkmap(models.Model):
 class Storage(models.Model):
     key = models.CharField(max_length=200, db_index=True)
     value = InyokaMarkupField(application='portal')
+
+
+class CounterManager(models.Manager):
+
+    #: redis hash with the changes of the counters that are not written to
+    #: the database yet, see :meth:`flush`.
+    delta_key = 'portal/counter_deltas'
+
+    #: seconds :meth:`store` waits for a running flush
+    store_wait = 5
+
+    def _delta_keys(self):
+        key = cache.make_key(self.delta_key)
+        return key, key + ':flushing'
+
+    def add(self, key, count):
+        """
+        Add `count` to the counter `key`.  The change is recorded in redis and
+        written to the database by :meth:`flush`, the cached value is updated
+        if it exists.
+        """
+        delta_key = self._delta_keys()[0]
+        cache.client.get_client().eval(self.ADD_SCRIPT, 2, cache.make_key(key),
+                                       delta_key, count, key)
+
+    # Adds ARGV[1] to the cached value KEYS[1] if it exists and records the
+    # change under the name ARGV[2] in the hash KEYS[2].
+    ADD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+redis.call('HINCRBY', KEYS[2], ARGV[2], ARGV[1])
+"""
+
+    def get_pending(self, keys):
+        """Return the changes of the counters `keys` that are not flushed yet."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        pipeline = cache.client.get_client().pipeline(transaction=False)
+        for delta_key in self._delta_keys():
+            pipeline.hmget(delta_key, keys)
+        pending, flushing = pipeline.execute()
+        return {key: sum(int(count) for count in counts if count)
+                for key, *counts in zip(keys, pending, flushing)}
+
+    def get_value(self, key):
+        """
+        Return the value of the counter `key` including the changes that are
+        not flushed yet, or `None` if the counter is not in the database.
+        """
+        value = self.filter(key=key).values_list('value', flat=True).first()
+        if value is None:
+            return None
+        return value + self.get_pending([key])[key]
+
+    def store(self, key, value):
+        """
+        Store `value` as the counted value of `key`.  Changes that are not
+        flushed yet are dropped, as they are part of `value` already.
+
+        This waits for a running :meth:`flush`, which would add the changes
+        it read before again.  Returns `False` if the flush did not finish
+        in time and nothing was stored.
+        """
+        lock = cache.lock(self.delta_key + ':lock', timeout=60)
+        if not lock.acquire(blocking_timeout=self.store_wait):
+            return False
+        try:
+            self.update_or_create(key=key, defaults={'value': value})
+            pipeline = cache.client.get_client().pipeline(transaction=False)
+            for delta_key in self._delta_keys():
+                pipeline.hdel(delta_key, key)
+            pipeline.execute()
+        finally:
+            lock.release()
+        return True
+
+    def flush(self, batch_size=500):
+        """
+        Write the changes of the counters recorded in redis to the database.
+
+        The hash is renamed first, so changes recorded in the meantime are not
+        lost.  If a flush failed, the renamed hash is written by the next one.
+        Changes of counters that are not in the database are dropped, they
+        are counted when the counter is read the next time.
+
+        Only one flush runs at a time and the renamed hash is deleted right
+        before the transaction commits, so the changes are never written
+        twice and :meth:`get_value` never sees them in both places.
+        """
+        lock = cache.lock(self.delta_key + ':lock', timeout=600)
+        if not lock.acquire(blocking=False):
+            # another flush is running
+            return 0
+        try:
+            redis = cache.client.get_client()
+            key, flushing_key = self._delta_keys()
+            if not redis.exists(flushing_key):
+                try:
+                    redis.rename(key, flushing_key)
+                except ResponseError:
+                    # no counter was changed since the last flush
+                    return 0
+
+            deltas = {name.decode(): int(count) for name, count
+                      in redis.hgetall(flushing_key).items() if int(count)}
+            keys = sorted(deltas)
+            with transaction.atomic():
+                for start in range(0, len(keys), batch_size):
+                    batch = keys[start:start + batch_size]
+                    increment = Case(*(When(key=key, then=Value(deltas[key])) for key in batch),
+                                     output_field=models.BigIntegerField())
+                    self.get_queryset().filter(key__in=batch) \
+                        .update(value=F('value') + increment)
+                redis.delete(flushing_key)
+            return len(keys)
+        finally:
+            lock.release()
+
+    def reconcile(self, keys, fix=False):
+        """
+        Count the counters `keys` again and return the drifted ones as list
+        of ``(key, value, counted)``.  With `fix` the counted values are
+        stored, the counters are marked as reconciled and the counters of
+        deleted objects are removed.
+        """
+        keys = list(keys)
+        values = dict(self.filter(key__in=keys).values_list('key', 'value'))
+        pending = self.get_pending(keys)
+        drifted = []
+        for key in keys:
+            counter = get_counter(key)
+            if counter is None:
+                if fix:
+                    self.filter(key=key).delete()
+                continue
+            value = values.get(key, 0) + pending[key]
+            counted = counter.query.count()
+            if value != counted:
+                drifted.append((key, value, counted))
+                if fix:
+                    self.store(key, counted)
+                    cache.delete(key)
+        if fix:
+            self.filter(key__in=keys).update(reconciled=datetime.utcnow())
+        return drifted
+
+
+class Counter(models.Model):
+    """
+    The durable value of a :class:`~inyoka.utils.cache.QueryCounter`.  The
+    changes are collected in redis and written by :meth:`CounterManager.flush`.
+    """
+    key = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(default=0)
+    reconciled = models.DateTimeField(null=True, db_index=True)
+
+    objects = CounterManager()
@@ -14,9 +14,11 @@ from celery import shared_task
 from django.conf import settings
 from django.core.cache import cache
 from django.db import connection
+from django.db.models import F
 
 from inyoka.portal.user import User
 from inyoka.utils.logger import logger
+from inyoka.utils.sessions import get_session_counts
 from inyoka.utils.storage import storage
 
 
@@ -26,7 +28,7 @@ def check_for_user_record():
     Checks whether the current session count is a new record.
     """
     record = int(storage.get('session_record', 0))
-    session_count = len(cache.keys('sessioninfo:*'))
+    session_count = sum(get_session_counts().values())
     if session_count > record:
         storage['session_record'] = str(session_count)
         storage['session_record_time'] = int(time())
@@ -75,6 +77,34 @@ def query_counter_task(cache_key, sql):
 
     Used be inyoka.utils.cache import QueryCounter.
     """
+    from inyoka.portal.models import Counter
+
     cursor = connection.cursor()
     cursor.execute(sql)
-    cache.set(cache_key, cursor.fetchone()[0])
+    value = cursor.fetchone()[0]
+    Counter.objects.store(cache_key, value)
+    cache.set(cache_key, value)
+
+
+@shared_task
+def flush_counters():
+    """Write the changes of the counters collected in redis to the database."""
+    from inyoka.portal.models import Counter
+
+    count = Counter.objects.flush()
+    logger.debug('Flushed the changes of %s counters', count)
+
+
+@shared_task
+def reconcile_counters():
+    """
+    Count the counters that were not counted for the longest time again and
+    fix them if they drifted.
+    """
+    from inyoka.portal.models import Counter
+
+    Counter.objects.flush()
+    keys = (Counter.objects.order_by(F('reconciled').asc(nulls_first=True))
+            .values_list('key', flat=True)[:settings.COUNTER_RECONCILE_BATCH])
+    for key, value, counted in Counter.objects.reconcile(list(keys), fix=True):
+        logger.warning('Counter %s was %s instead of %s', key, value, counted)
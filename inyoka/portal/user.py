@@ -10,8 +10,9 @@
 """
 import secrets
 import string
+from copy import copy
 from datetime import datetime
-from json import loads, dumps
+from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth.models import (
@@ -27,14 +28,16 @@ from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
 from django.db.models.functions import Upper
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.utils.html import escape
 from django.utils.translation import gettext as _
 from django.utils.translation import gettext_lazy
 from guardian.mixins import GuardianUserMixin
-from guardian.shortcuts import get_perms
+from guardian.core import ObjectPermissionChecker
+from redis.exceptions import ResponseError
 
-from inyoka.utils.cache import QueryCounter
+from inyoka.utils.cache import QueryCounter, register_counter
 from inyoka.utils.database import InyokaMarkupField, JSONField, JabberField
 from inyoka.utils.decorators import deferred
 from inyoka.utils.gravatar import get_gravatar
@@ -183,7 +186,16 @@ def send_activation_mail(user):
     send_mail(subject, message, settings.INYOKA_SYSTEM_USER_EMAIL, [user.email])
 
 
+#: the anonymous and the system user of this process as ``(version, user)``
+#: by username, see :meth:`UserManager.get_anonymous_user`
+_special_users = {}
+
+
 class UserManager(BaseUserManager):
+    #: cache key of the version of the anonymous and the system user, changed
+    #: whenever one of them, their groups or the permissions change
+    special_users_version_key = 'portal/special_users_version'
+
     def get_by_username_or_email(self, name):
         """Get a user by its username or email address"""
         try:
@@ -241,15 +253,49 @@ class UserManager(BaseUserManager):
         return user
 
     def get_anonymous_user(self):
-        return User.objects.get(username__iexact=settings.ANONYMOUS_USER_NAME)
+        """
+        Return the anonymous user.  Every process keeps the user with its
+        permissions and only reads the version from the cache, see
+        :meth:`clear_special_users_cache`.
+        """
+        return self._get_special_user(settings.ANONYMOUS_USER_NAME)
 
     def get_system_user(self):
         """
         This returns the system user that is controlled by inyoka itself.  It
         is the sender for welcome notices, it updates the antispam list and
         is the owner for log entries in the wiki triggered by inyoka itself.
+        It is kept per process like the anonymous user.
+        """
+        return self._get_special_user(settings.INYOKA_SYSTEM_USER)
+
+    def clear_special_users_cache(self):
         """
-        return User.objects.get(username__iexact=settings.INYOKA_SYSTEM_USER)
+        Make all processes fetch the anonymous and the system user and their
+        permissions again.
+        """
+        cache.set(self.special_users_version_key, uuid4().hex, None)
+
+    def _get_special_user(self, username):
+        version = cache.get(self.special_users_version_key)
+        if version is None:
+            cache.add(self.special_users_version_key, uuid4().hex, None)
+            version = cache.get(self.special_users_version_key)
+        cached = _special_users.get(username)
+        if cached is None or cached[0] != version:
+            user = User.objects.get(username__iexact=username)
+            if cached is not None:
+                # the permissions cached in redis may be outdated as well
+                cache.client.get_client().delete(user._get_perm_cache_key())
+            user._load_perm_cache()
+            cached = _special_users[username] = (version, user)
+        # every caller gets its own instance, only the permissions are shared
+        return copy(cached[1])
+
+
+def obj_to_perm_key(obj):
+    """Return the key of `obj` in the permission cache of users."""
+    return '%s-%s' % (obj.__class__.__name__.lower(), obj.id)
 
 
 def upload_to_avatar(instance, filename):
@@ -500,34 +546,86 @@ class User(AbstractBaseUser, PermissionsMixin, GuardianUserMixin):
                     self.groups.add(registered_group)
         return True
 
+    #: member of the permission cache that marks it as complete
+    perm_cache_marker = '*'
+
+    def _get_perm_cache_key(self):
+        return cache.make_key('/acl/%s' % self.id)
+
+    def _load_perm_cache(self):
+        """
+        Load the permission cache from redis, where it is stored as a set of
+        the global permissions and ``<model>-<id>.<permission>`` for every
+        object permission (and ``<model>-<id>`` for every object that was
+        checked).  If the set does not exist it is created again.
+        """
+        if hasattr(self, 'perm_cache'):
+            return
+        redis = cache.client.get_client()
+        key = self._get_perm_cache_key()
+        try:
+            members = {member.decode() for member in redis.smembers(key)}
+        except ResponseError:
+            # the permissions were cached as a JSON blob by older versions
+            members = set()
+        if self.perm_cache_marker not in members:
+            # Either nothing is cached or the cache was cleared while
+            # object permissions were added to it.
+            members = set(self.get_all_permissions())
+            members.add(self.perm_cache_marker)
+            pipeline = redis.pipeline()
+            pipeline.delete(key)
+            pipeline.sadd(key, *members)
+            if cache.default_timeout is not None:
+                pipeline.expire(key, int(cache.default_timeout))
+            pipeline.execute()
+        self.perm_cache = members
+
+    def prefetch_perms(self, objects):
+        """
+        Load the object permissions of `objects` that are not cached yet
+        with one query per model and add them to the cache at once.  Calls to
+        :meth:`has_perm` for these objects do not query the database or the
+        cache afterwards.
+        """
+        self._load_perm_cache()
+        missing = {}
+        for obj in objects:
+            if obj_to_perm_key(obj) not in self.perm_cache:
+                missing.setdefault(type(obj), {})[obj.pk] = obj
+        if not missing:
+            return
+
+        members = set()
+        for objs in missing.values():
+            objs = list(objs.values())
+            checker = ObjectPermissionChecker(self)
+            checker.prefetch_perms(objs)
+            for obj in objs:
+                objkey = obj_to_perm_key(obj)
+                members.add(objkey)
+                for permission in checker.get_perms(obj):
+                    members.add('%s-%s.%s' % (objkey, obj._meta.app_label, permission))
+
+        cache.client.get_client().sadd(self._get_perm_cache_key(), *members)
+        self.perm_cache.update(members)
+
     def has_perm(self, perm, obj=None):
         """
         Heavy cached version of has_perm() to save many DB Queries.
 
-        Stores cached Permissions inside our redis cache under /acl/<user.id> as JSON blob.
+        Stores cached Permissions inside our redis cache under /acl/<user.id>
+        as a set, see :meth:`prefetch_perms` to load the permissions for
+        many objects at once.
         """
-
-        def obj_to_key(obj):
-            return '%s-%s' % (obj.__class__.__name__.lower(), obj.id)
-
-        cache_key = '/acl/%s' % self.id
-        if not hasattr(self, 'perm_cache'):
-            current_perm_cache = cache.get(cache_key, None)
-            if current_perm_cache:
-                self.perm_cache = loads(current_perm_cache)
-            else:
-                self.perm_cache = list(self.get_all_permissions())
-                cache.set(cache_key, dumps(self.perm_cache))
+        self._load_perm_cache()
 
         permkey = perm
         if obj:
-            objkey = obj_to_key(obj)
+            objkey = obj_to_perm_key(obj)
             permkey = '%s-%s' % (objkey, perm)
             if objkey not in self.perm_cache:
-                for permission in get_perms(self, obj):
-                    self.perm_cache.append('%s-%s.%s' % (objkey, obj._meta.app_label, permission))
-                self.perm_cache.append(objkey)
-                cache.set(cache_key, dumps(self.perm_cache))
+                self.prefetch_perms([obj])
 
         return permkey in self.perm_cache
 
@@ -560,6 +658,9 @@ class User(AbstractBaseUser, PermissionsMixin, GuardianUserMixin):
         ]
 
 
+register_counter('user_post_count', User, 'post_count')
+
+
 class UserPage(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     content = InyokaMarkupField()
@@ -575,3 +676,20 @@ def update_user_flags(sender, request, user, **kwargs):
 
 
 user_logged_in.disconnect(update_last_login)
+
+
+def _is_special_user(user):
+    return user.username in (settings.ANONYMOUS_USER_NAME, settings.INYOKA_SYSTEM_USER)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def clear_special_user(sender, instance, **kwargs):
+    if _is_special_user(instance):
+        User.objects.clear_special_users_cache()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def clear_special_user_groups(sender, instance, action, reverse, **kwargs):
+    if action.startswith('post_') and (reverse or _is_special_user(instance)):
+        User.objects.clear_special_users_cache()
@@ -997,7 +997,8 @@ def privmsg(request, folder=None, entry_id=None, page=1, one_page=False):
         message = None
     link = href('portal', 'privmsg', folder, 'page')
 
-    pagination = Pagination(request, query=entries, page=page, per_page=10, link=link, one_page=one_page)
+    pagination = Pagination(request, query=entries, page=page, per_page=10, link=link, one_page=one_page,
+                            ordering=('-id',))
 
     return {
         'entries': pagination.get_queryset(),
@@ -0,0 +1 @@
+/root/package/inyoka/static/js/DateTime.js
\ No newline at end of file
@@ -0,0 +1 @@
+/root/package/inyoka/static/js/NewTopic.js
\ No newline at end of file
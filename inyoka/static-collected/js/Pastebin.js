@@ -0,0 +1 @@
+/root/package/inyoka/static/js/Pastebin.js
\ No newline at end of file
@@ -0,0 +1 @@
+/root/package/inyoka/static/js/admin.js
\ No newline at end of file
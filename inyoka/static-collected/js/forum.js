@@ -0,0 +1 @@
+/root/package/inyoka/static/js/forum.js
\ No newline at end of file
@@ -0,0 +1 @@
+/root/package/inyoka/static/js/ikhaya.js
\ No newline at end of file
@@ -0,0 +1 @@
+/root/package/inyoka/static/js/jquery.ba-hashchange.min.js
\ No newline at end of file
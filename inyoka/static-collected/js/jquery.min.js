@@ -0,0 +1 @@
+/root/package/inyoka/static/js/jquery.min.js
\ No newline at end of file
@@ -0,0 +1 @@
+/root/package/inyoka/static/js/jquery.tokenfield.js
\ No newline at end of file
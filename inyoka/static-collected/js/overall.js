@@ -0,0 +1 @@
+/root/package/inyoka/static/js/overall.js
\ No newline at end of file
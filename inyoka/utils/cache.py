@@ -4,26 +4,70 @@
 
     The caching infrastructure of Inyoka.
 
-    On top of the django cache client that speaks directly to either redis
-    or caches in-memory we have a :class:`RequestCache` that caches
-    redis-commands in a thread-local dictionary.  This saves a lot of
-    redis-commands in some scenarios.
+    On top of the django cache client that speaks directly to redis we have
+    an optional :class:`LocalCacheTier`, a process-local LRU that keeps hot,
+    read-mostly keys in memory.  It is enabled per cache with the
+    ``LOCAL_CACHE`` option and invalidated through a version key in redis,
+    so it saves a lot of redis-commands in some scenarios.
 
     :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
-from time import sleep
+import re
+import threading
+from collections import OrderedDict
+from fnmatch import translate
+from math import log
+from random import random
+from time import monotonic, sleep, time
 
 from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.core.cache import cache
 from django.db.models.aggregates import Count
 from django.utils.translation import gettext as _
 from django_redis.cache import RedisCache as _RedisCache
 
+from inyoka.utils.local import local
+from inyoka.utils.logger import logger
+
+_number_re = re.compile(r'\d+')
+
+
+#: the counters that can be counted again by their key, see
+#: :func:`register_counter`
+_counter_models = {}
+
+
+def register_counter(prefix, model, attribute):
+    """
+    Register the counters with keys like ``<prefix>:<id>``, that are the
+    `QueryCounter` in `attribute` of the `model` instance with the id.
+    """
+    _counter_models[prefix] = (model, attribute)
+
+
+def get_counter(key):
+    """
+    Return the `QueryCounter` of `key`, or `None` if the object of the
+    counter does not exist anymore.
+    """
+    prefix, _, id = key.rpartition(':')
+    model, attribute = _counter_models[prefix]
+    obj = model.objects.filter(pk=int(id)).first()
+    if obj is None:
+        return None
+    return getattr(obj, attribute)
+
 
 class QueryCounter:
     """
     Calls .count() for a query and saves this value into redis.
+
+    The value is stored in the database as well (see
+    :class:`inyoka.portal.models.Counter`), so it is only counted again if
+    it is missing there.  Changes with :meth:`incr` and :meth:`decr` are
+    collected in redis and written to the database in batches.
     """
 
     def __init__(self, cache_key, query, use_task=False, timeout=None):
@@ -46,24 +90,40 @@ class QueryCounter:
     def __call__(self, default=None):
         return self.value(default=default)
 
+    @staticmethod
+    def _get_manager():
+        from inyoka.portal.models import Counter
+        return Counter.objects
+
     def db_count(self, write_cache=False):
         """
         Executes the query with .count() and returns the value.
 
-        If write_cache is True, then the value is also written to the cache.
+        If write_cache is True, then the value is also written to the cache
+        and the database.
         """
         # write_cache has to be False as default, so this method can be used
         # in cache.get_or_set() in the value()-method.
         value = self.query.count()
         if write_cache:
+            self._get_manager().store(self.cache_key, value)
             cache.set(self.cache_key, value, timeout=self.timeout)
         return value
 
+    def _rebuild(self):
+        """Return the value from the database, count it if it is missing."""
+        value = self._get_manager().get_value(self.cache_key)
+        if value is None:
+            value = self.db_count()
+            self._get_manager().store(self.cache_key, value)
+        return value
+
     def value(self, default=None, calculate=True):
         """
         Returns the value from the cache.
 
-        If the value is not in the cache and this object was initialized with
+        If the value is not in the cache, it is read from the database.  If
+        it is not in the database either and this object was initialized with
         task, then the task is executed with celery and default is returned.
 
         In other case cache.get_or_set() is used to create the value. This
@@ -79,9 +139,13 @@ class QueryCounter:
             # The value was not cached yet.
             pass
         if not self.use_task:
-            count = cache.get_or_set(self.cache_key, self.db_count, self.timeout)
+            count = cache.get_or_set(self.cache_key, self._rebuild, self.timeout)
         else:
             count = cache.get(self.cache_key)
+            if count is None and calculate:
+                count = self._get_manager().get_value(self.cache_key)
+                if count is not None:
+                    cache.set(self.cache_key, count, timeout=self.timeout)
             if count is None and calculate:
                 # Try to set a status_key. If this fails, then the task is
                 # already delayed.
@@ -106,23 +170,17 @@ class QueryCounter:
         """
         Adds count to the counter.
 
-        Does nothing if the counter is not in the cache.
+        The change is written to the database by the `flush_counters` task.
         """
-        try:
-            cache.incr(self.cache_key, count)
-        except ValueError:
-            pass
+        self._get_manager().add(self.cache_key, count)
 
     def decr(self, count=1):
         """
         Decrease the counter by count.
 
-        Does nothing if the counter is not in the cache.
+        The change is written to the database by the `flush_counters` task.
         """
-        try:
-            cache.decr(self.cache_key, count)
-        except ValueError:
-            pass
+        self._get_manager().add(self.cache_key, -count)
 
     def delete_cache(self):
         """
@@ -133,44 +191,359 @@ class QueryCounter:
         cache.delete(self.cache_key)
 
 
+# Bumps the invalidation version and records the invalidated keys with it.
+# Called with the limit of the log as first argument followed by the keys, or
+# with only the limit to invalidate all keys.  If the log has to be trimmed,
+# the highest trimmed version is stored as floor, so readers that have not yet
+# seen it know that they have to flush everything.
+INVALIDATE_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local version = redis.call('INCR', KEYS[1])
+if #ARGV == 1 then
+    redis.call('SET', KEYS[3], version)
+    redis.call('DEL', KEYS[2])
+    return version
+end
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[2], version, ARGV[i])
+end
+local excess = redis.call('ZCARD', KEYS[2]) - limit
+if excess > 0 then
+    local dropped = redis.call('ZRANGE', KEYS[2], excess - 1, excess - 1, 'WITHSCORES')
+    redis.call('SET', KEYS[3], dropped[2])
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+end
+return version
+"""
+
+
+class LocalCacheTier:
+    """
+    Process-local LRU for raw redis values of hot, read-mostly keys.
+
+    Only keys matching one of the shell-style ``patterns`` are stored.  The
+    values are kept encoded, so every hit returns a fresh object and the size
+    of the tier can be bounded in bytes by ``max_size``.  ``timeout`` bounds
+    the time a value is served without asking redis again.
+
+    Other processes learn about changed keys through an invalidation version
+    in redis, see :meth:`RedisCache.sync_local_tier`.
+    """
+
+    #: Number of invalidated keys remembered in redis.
+    log_limit = 10000
+
+    def __init__(self, patterns, max_size=8 * 1024 * 1024, timeout=60,
+                 check_interval=1):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._match = re.compile('|'.join(translate(p) for p in patterns)).match
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        #: The last invalidation version this tier has been synced to.
+        self.version = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    def matches(self, key):
+        """Return whether `key` (without prefix and version) is stored here."""
+        return self._match(key) is not None
+
+    def get(self, key):
+        """Return the raw value of `key` or `None`."""
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return None
+            if expires < monotonic():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(key) + len(value)
+        with self._lock:
+            self._discard(key)
+            if size > self.max_size:
+                return
+            self._entries[key] = (monotonic() + self.timeout, value)
+            self._size += size
+            while self._size > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def discard(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(key) + len(entry[1])
+
+
 class RedisCache(_RedisCache):
     """
     Wrapper to redis cache that creates status keys for the time a value is
     created.
 
     Idea from https://github.com/funkybob/puppy
+
+    If the ``LOCAL_CACHE`` option is set, reads of matching keys are served
+    from a :class:`LocalCacheTier`.  The option is a dict with the key
+    ``KEYS`` (a list of shell-style patterns) and optionally ``MAX_SIZE`` (in
+    bytes), ``TIMEOUT`` and ``CHECK_INTERVAL`` (both in seconds).
     """
 
-    def get_or_set(self, key, callback, timeout=None, update_time=6):
+    local_tier = None
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        local_options = params.get('OPTIONS', {}).get('LOCAL_CACHE')
+        if local_options:
+            self.local_tier = LocalCacheTier(
+                local_options['KEYS'],
+                **{name.lower(): value for name, value in local_options.items()
+                   if name != 'KEYS'}
+            )
+
+    def _local_key(self, key, version=None):
+        """
+        Return the full key of `key` if it is handled by the local tier.
+        """
+        if self.local_tier is None or not self.local_tier.matches(key):
+            return None
+        return self.make_key(key, version=version)
+
+    def sync_local_tier(self):
+        """
+        Drop all locally cached values that were changed by other processes.
+
+        This happens at most once per request (and every ``CHECK_INTERVAL``
+        seconds for long running requests and tasks) and costs one redis
+        round-trip.
+        """
+        tier = self.local_tier
+        checked = getattr(local, 'local_cache_checks', None)
+        if checked is None:
+            checked = local.local_cache_checks = {}
+        now = monotonic()
+        if now - checked.get(id(tier), float('-inf')) < tier.check_interval:
+            return
+        checked[id(tier)] = now
+
+        pipeline = self.client.get_client().pipeline(transaction=False)
+        pipeline.get(self.make_key('local_tier:version'))
+        pipeline.get(self.make_key('local_tier:floor'))
+        pipeline.zrangebyscore(self.make_key('local_tier:log'),
+                               '(%d' % (tier.version or 0), '+inf')
+        version, floor, keys = pipeline.execute()
+        version = int(version or 0)
+        if version == tier.version:
+            return
+        if tier.version is None or version < tier.version \
+                or int(floor or 0) > tier.version:
+            tier.clear()
+        else:
+            tier.discard(*(key.decode() for key in keys))
+        tier.version = version
+
+    def invalidate_local(self, keys=None):
+        """
+        Drop `keys` (full keys) from the local tier of all processes.
+
+        If `keys` is `None` all keys are dropped.
+        """
+        tier = self.local_tier
+        if keys is None:
+            tier.clear()
+            keys = ()
+        elif not keys:
+            return
+        else:
+            tier.discard(*keys)
+        redis = self.client.get_client()
+        script = redis.register_script(INVALIDATE_SCRIPT)
+        script(keys=[self.make_key('local_tier:version'),
+                     self.make_key('local_tier:log'),
+                     self.make_key('local_tier:floor')],
+               args=[tier.log_limit, *keys])
+
+    def get(self, key, default=None, version=None, client=None):
+        local_key = self._local_key(key, version)
+        if local_key is None:
+            return super().get(key, default, version, client)
+
+        self.sync_local_tier()
+        value = self.local_tier.get(local_key)
+        if value is None:
+            value = self.client.get_client(write=False).get(local_key)
+            if value is None:
+                return default
+            self.local_tier.set(local_key, value)
+        return self.client.decode(value)
+
+    def get_many(self, keys, version=None, client=None):
+        if self.local_tier is None:
+            return super().get_many(keys, version=version, client=client)
+
+        values = {}
+        missing = {}
+        remote = []
+        local_keys = {key: self._local_key(key, version) for key in keys}
+        if any(local_keys.values()):
+            self.sync_local_tier()
+        for key, local_key in local_keys.items():
+            if local_key is None:
+                remote.append(key)
+                continue
+            value = self.local_tier.get(local_key)
+            if value is None:
+                missing[key] = local_key
+            else:
+                values[key] = self.client.decode(value)
+
+        if missing:
+            redis = self.client.get_client(write=False)
+            for key, value in zip(missing, redis.mget(list(missing.values()))):
+                if value is not None:
+                    self.local_tier.set(missing[key], value)
+                    values[key] = self.client.decode(value)
+        if remote:
+            values.update(super().get_many(remote, version=version, client=client))
+        return values
+
+    def _local_keys(self, keys, version=None):
+        return [local_key for local_key in
+                (self._local_key(key, version) for key in keys)
+                if local_key is not None]
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, *args, **kwargs):
+        result = super().set(key, value, timeout, version, *args, **kwargs)
+        if self.local_tier is not None:
+            self.invalidate_local(self._local_keys([key], version))
+        return result
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, *args, **kwargs):
+        result = super().add(key, value, timeout, version, *args, **kwargs)
+        if result and self.local_tier is not None:
+            self.invalidate_local(self._local_keys([key], version))
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, *args, **kwargs):
+        result = super().set_many(data, timeout, version, *args, **kwargs)
+        if self.local_tier is not None:
+            self.invalidate_local(self._local_keys(data, version))
+        return result
+
+    def delete(self, key, version=None, *args, **kwargs):
+        result = super().delete(key, version, *args, **kwargs)
+        if self.local_tier is not None:
+            self.invalidate_local(self._local_keys([key], version))
+        return result
+
+    def delete_many(self, keys, version=None, *args, **kwargs):
+        keys = list(keys)
+        result = super().delete_many(keys, version, *args, **kwargs)
+        if self.local_tier is not None:
+            self.invalidate_local(self._local_keys(keys, version))
+        return result
+
+    def incr(self, key, delta=1, version=None, *args, **kwargs):
+        result = super().incr(key, delta, version, *args, **kwargs)
+        if self.local_tier is not None:
+            self.invalidate_local(self._local_keys([key], version))
+        return result
+
+    def decr(self, key, delta=1, version=None, *args, **kwargs):
+        result = super().decr(key, delta, version, *args, **kwargs)
+        if self.local_tier is not None:
+            self.invalidate_local(self._local_keys([key], version))
+        return result
+
+    def delete_pattern(self, *args, **kwargs):
+        result = super().delete_pattern(*args, **kwargs)
+        if self.local_tier is not None:
+            self.invalidate_local()
+        return result
+
+    def clear(self):
+        result = super().clear()
+        if self.local_tier is not None:
+            self.invalidate_local()
+        return result
+
+    def get_or_set(self, key, callback, timeout=None, update_time=6,
+                   stale_time=None, beta=None):
         """
         Get a key if it exists. Creates it if other case.
 
         Sets a status key for the time the value is created, so other workers
         do not created the same content in the meantime.
+
+        If `stale_time` is given, the value is kept that many seconds longer
+        than `timeout`.  After `timeout` one worker creates the value again,
+        while all others keep getting the stale value instead of waiting.
+
+        If `beta` is given, the value is created again before it expires with
+        a probability that grows with the time `callback` needed the last
+        time and with `beta` (XFetch, see
+        https://cseweb.ucsd.edu/~avattani/papers/cache_stampede.pdf).
+        ``1.0`` is a good default, bigger values refresh earlier.
         """
         redis = self.client.get_client()
 
+        local_key = self._local_key(key)
+        if local_key is not None:
+            self.sync_local_tier()
+            value = self.local_tier.get(local_key)
+            if value is not None:
+                return self.client.decode(value)
+
+        # Resolve our timeout value
+        if timeout is None:
+            timeout = self.default_timeout
+
         # Status key
-        key = self.make_key(key)
+        name, key = key, self.make_key(key)
         state_key = key + ':status'
+        meta_key = key + ':meta' if stale_time or beta else None
 
         # Get the value and its status
-        value = redis.get(key)
+        if meta_key is None:
+            value = redis.get(key)
+        else:
+            value, meta = redis.mget(key, meta_key)
+            if value is not None and self._needs_refresh(meta, beta) \
+                    and redis.set(state_key, 'updating', ex=update_time, nx=True):
+                # Only this worker refreshes the value, all others keep
+                # getting the stale one in the meantime.
+                try:
+                    value = self._create_value(redis, name, callback, timeout,
+                                               update_time, stale_time, beta)
+                finally:
+                    redis.delete(state_key)
 
         while value is None:
             # Try to gain an updating lock
             if redis.set(state_key, 'updating', ex=update_time, nx=True):
                 try:
-                    # TODO: log how long callback needs. If it needs more then
-                    #       update_time, it should write a warning.
-                    value = self.client.encode(callback())
-
-                    # Resolve our timeout value
-                    if timeout is None:
-                        timeout = self.default_timeout
-
-                    # Set the value
-                    redis.set(key, value, ex=timeout)
+                    value = self._create_value(redis, name, callback, timeout,
+                                               update_time, stale_time, beta)
                 finally:
                     # If the key is deleted it can not be recreated before the
                     # state_key expires. So it has to be deleted
@@ -182,9 +555,124 @@ class RedisCache(_RedisCache):
                 sleep(0.1)
                 value = redis.get(key)
 
+        if local_key is not None:
+            self.local_tier.set(key, value)
+
         try:
             return self.client.decode(value)
         except:
             # If value can not be decoded, then delete it from the cache
             redis.delete(key)
             raise
+
+    def get_stale_keys(self, keys):
+        """
+        Return the `keys` that are not in the cache or that :meth:`get_or_set`
+        would create again because they are older than their timeout.
+        """
+        keys = list(keys)
+        pipeline = self.client.get_client(write=False).pipeline(transaction=False)
+        for key in keys:
+            key = self.make_key(key)
+            pipeline.exists(key)
+            pipeline.get(key + ':meta')
+        results = pipeline.execute()
+        return [key for key, exists, meta in zip(keys, results[::2], results[1::2])
+                if not exists or self._needs_refresh(meta, None)]
+
+    def refresh(self, key, callback, timeout=None, update_time=6,
+                stale_time=None):
+        """
+        Create the value of `key` again like :meth:`get_or_set` does for stale
+        values and replace the old value with it, readers keep getting the old
+        value in the meantime.
+
+        Returns `False` if another worker is already creating the value.
+        """
+        redis = self.client.get_client()
+        if timeout is None:
+            timeout = self.default_timeout
+        state_key = self.make_key(key) + ':status'
+        if not redis.set(state_key, 'updating', ex=update_time, nx=True):
+            return False
+        try:
+            self._create_value(redis, key, callback, timeout, update_time,
+                               stale_time, None)
+        finally:
+            redis.delete(state_key)
+        return True
+
+    @staticmethod
+    def _needs_refresh(meta, beta):
+        """
+        Return whether a value with the metadata `meta` should be created
+        again.  Values without metadata were not set by :meth:`get_or_set`
+        and are never refreshed.
+        """
+        if meta is None:
+            return False
+        fresh_until, duration = (float(part) for part in meta.split(b' '))
+        now = time()
+        if beta:
+            # log(random()) is negative, so this moves `now` into the future.
+            now -= duration * beta * log(1.0 - random())
+        return now >= fresh_until
+
+    def _create_value(self, redis, name, callback, timeout, update_time,
+                      stale_time, beta):
+        """
+        Call `callback` and store its encoded result (and the metadata used
+        by the stale and early refreshes) in redis.
+        """
+        start = monotonic()
+        value = self.client.encode(callback())
+        duration = monotonic() - start
+        self.record_rebuild(name, duration, update_time)
+
+        key = self.make_key(name)
+        if not stale_time and not beta:
+            redis.set(key, value, ex=timeout)
+        else:
+            expires = timeout + (stale_time or 0)
+            pipeline = redis.pipeline()
+            pipeline.set(key, value, ex=expires)
+            pipeline.set(key + ':meta', f'{time() + timeout} {duration}', ex=expires)
+            pipeline.execute()
+        if self._local_key(name) is not None:
+            self.invalidate_local([key])
+        return value
+
+    def record_rebuild(self, key, duration, update_time):
+        """
+        Count how often and how long values are created by :meth:`get_or_set`.
+
+        The numbers are grouped by the key with all numbers replaced by ``*``
+        and can be read with :meth:`get_rebuild_metrics`.  A warning is logged
+        if creating the value took longer than `update_time`, because in
+        this case other workers may have started to create it too.
+        """
+        name = _number_re.sub('*', key)
+        pipeline = self.client.get_client().pipeline(transaction=False)
+        metrics_key = self.make_key('cache_metrics')
+        pipeline.hincrby(metrics_key, f'{name}:count', 1)
+        pipeline.hincrbyfloat(metrics_key, f'{name}:seconds', duration)
+        if duration > update_time:
+            pipeline.hincrby(metrics_key, f'{name}:slow', 1)
+            logger.warning('Creating cache value %s took %.2f seconds', key, duration)
+        pipeline.execute()
+
+    def get_rebuild_metrics(self):
+        """
+        Return a dict ``{name: {'count': …, 'seconds': …, 'slow': …}}`` of the
+        values recorded by :meth:`record_rebuild`.
+        """
+        redis = self.client.get_client(write=False)
+        metrics = {}
+        for field, value in redis.hgetall(self.make_key('cache_metrics')).items():
+            name, _, metric = field.decode().rpartition(':')
+            metrics.setdefault(name, {'count': 0, 'seconds': 0.0, 'slow': 0})
+            metrics[name][metric] = float(value) if metric == 'seconds' else int(value)
+        return metrics
+
+    def reset_rebuild_metrics(self):
+        self.client.get_client().delete(self.make_key('cache_metrics'))
@@ -9,12 +9,14 @@
 """
 import json
 
+from django.conf import settings
 from django.core.cache import cache, caches
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import models
+from django.db import connections, models
 from django.db.models.signals import post_save as model_post_save_signal
 
 from inyoka.markup.base import RenderContext, parse
+from inyoka.markup.machine import Renderer
 from inyoka.utils.forms import JabberFormField
 from inyoka.utils.highlight import highlight_code
 
@@ -95,6 +97,26 @@ def get_simplified_queryset(queryset):
     return cqry
 
 
+def estimate_count(queryset):
+    """Returns the number of rows of `queryset` as estimated by the query
+    planner.  This is much faster than a ``count()`` on big tables, but may
+    be quite off for filtered queries.
+
+    Only PostgreSQL has a usable estimate, on other databases the rows are
+    counted.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return get_simplified_queryset(queryset).count()
+    sql, params = get_simplified_queryset(queryset).query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
 def model_or_none(pk, reference):
     if not reference or pk == reference.pk:
         return None
@@ -194,12 +216,87 @@ class BaseMarkupField(models.TextField):
             field=name,
         )
 
+    def render_content(self, inst_self, field_name, content):
+        """
+        Returns the final content from the value that is stored in the cache.
+
+        By default the cache holds the final content.
+        """
+        return content
+
+    def get_prefetch_attribute(self, name):
+        return f'_{name}_prefetched'
+
+    def prefetch_rendered(self, instances):
+        """
+        Fetches the cached content of this field for all `instances` with one
+        ``get_many`` and writes the missing content back with one
+        ``set_many``.
+
+        Afterwards ``instance.FIELDNAME_rendered`` does not need to query the
+        cache anymore.  Instances that share the same database row (for
+        example the authors of several posts) are only fetched once.
+        """
+        by_key = {}
+        for instance in instances:
+            if instance.pk is not None:
+                key = self.get_redis_key(self.model, instance, self.name)
+                by_key.setdefault(key, []).append(instance)
+        if not by_key:
+            return
+
+        contents = content_cache.get_many(list(by_key))
+        missing = {}
+        for key, key_instances in by_key.items():
+            if key not in contents:
+                create_content = self.get_content_create_callback(
+                    key_instances[0], self.name)
+                contents[key] = missing[key] = create_content()
+
+        if missing:
+            timeout = self.redis_timeout
+            if timeout is None:
+                timeout = content_cache.default_timeout
+            content_cache.set_many(missing, timeout)
+
+        attribute = self.get_prefetch_attribute(self.name)
+        for key, key_instances in by_key.items():
+            for instance in key_instances:
+                instance.__dict__[attribute] = contents[key]
+
+    def refresh_rendered(self, instances, force=False):
+        """
+        Creates the cached content of this field for all `instances` whose
+        content is not in the cache or stale, or for all `instances` if
+        `force` is set.
+
+        The new content replaces the old one, so readers do not have to wait
+        for it.  Returns the instances whose content was created.
+        """
+        by_key = {}
+        for instance in instances:
+            if instance.pk is not None:
+                by_key.setdefault(self.get_redis_key(self.model, instance, self.name), instance)
+        keys = list(by_key) if force else content_cache.get_stale_keys(by_key)
+
+        attribute = self.get_prefetch_attribute(self.name)
+        refreshed = []
+        for key in keys:
+            instance = by_key[key]
+            create_content = self.get_content_create_callback(instance, self.name)
+            if content_cache.refresh(key, create_content, self.redis_timeout,
+                                     stale_time=settings.CONTENT_CACHE_STALE_TIME):
+                instance.__dict__.pop(attribute, None)
+                refreshed.append(instance)
+        return refreshed
+
     def contribute_to_class(self, cls, name):
         super().contribute_to_class(cls, name)
 
         # Register to the post_save signal, to delete the redis cache if the
         # content changes
         def delete_cache_receiver(sender, instance, created, **kwargs):
+            instance.__dict__.pop(self.get_prefetch_attribute(name), None)
             if not created:
                 key = self.get_redis_key(cls, instance, name)
                 content_cache.delete(key)
@@ -219,13 +316,21 @@ class BaseMarkupField(models.TextField):
             """
             Renders the content of the field.
             """
+            prefetched = inst_self.__dict__.get(self.get_prefetch_attribute(name))
+            if prefetched is not None:
+                return self.render_content(inst_self, name, prefetched)
+
             key = self.get_redis_key(cls, inst_self, name)
 
             create_content = self.get_content_create_callback(inst_self, name)
 
             # Get the content from the cache. Creates the content if it does not
-            # exist in redis, or if the cache is expired.
-            return content_cache.get_or_set(key, create_content, self.redis_timeout)
+            # exist in redis, or if the cache is expired. Expired content is
+            # still served to other workers while it is created again.
+            content = content_cache.get_or_set(
+                key, create_content, self.redis_timeout,
+                stale_time=settings.CONTENT_CACHE_STALE_TIME)
+            return self.render_content(inst_self, name, content)
 
         def is_in_cache(inst_self):
             key = self.get_redis_key(cls, inst_self, name)
@@ -233,6 +338,7 @@ class BaseMarkupField(models.TextField):
             return (value is not None, value)
 
         def remove_from_cache(inst_self):
+            inst_self.__dict__.pop(self.get_prefetch_attribute(name), None)
             key = self.get_redis_key(cls, inst_self, name)
             content_cache.delete(key)
 
@@ -261,6 +367,11 @@ class InyokaMarkupField(BaseMarkupField):
             kwargs['force_existing'] = self.force_existing
         return name, path, args, kwargs
 
+    def get_redis_key(self, cls, instance, name):
+        # Older versions cached the final HTML under the key without suffix,
+        # these values must not be read as instructions.
+        return super().get_redis_key(cls, instance, name) + ':compiled'
+
     def get_render_method(self):
         """
         Returns a callable that can be bound as staticmethod to the django model.
@@ -282,50 +393,70 @@ class InyokaMarkupField(BaseMarkupField):
             This method is bound to the django models as staticmethod, so it
             can also be called from the Model and not only from the instance.
             """
-            if not isinstance(context, RenderContext):
-                if context is None:
-                    context = {}
-                context = RenderContext(
-                    obj=None,  # TODO: The parser shoud not be object specific
-                    application=self.application,
-                    simplified=self.simplify,
-                    **context)
-
             node = parse(text, wiki_force_existing=self.force_existing)
-            return node.render(context, format='html')
+            return node.render(self.get_render_context(context), format='html')
 
         return get_field_rendered
 
+    def get_render_context(self, context=None):
+        """
+        Returns a RenderContext object with the configuration of this field.
+
+        `context` can be a RenderContext object, that is returned unchanged,
+        or a dictonary containing additional keywordarguments to generate the
+        RenderContext object.
+        """
+        if isinstance(context, RenderContext):
+            return context
+        return RenderContext(
+            obj=None,  # TODO: The parser shoud not be object specific
+            application=self.application,
+            simplified=self.simplify,
+            **(context or {}))
+
     def get_content_create_callback(self, inst_self, field_name):
         """
-        Returns a callable, that renders the content.
+        Returns a callable, that parses the content and compiles it into
+        instructions (see :meth:`inyoka.markup.machine.NodeCompiler.compile`).
+
+        Only the instructions are cached, so dynamic macros are still
+        executed on each rendering and a cache miss does not have to parse
+        the text again if it is rendered in another context.
 
         inst_self is an instance of a django model, which has the
         InyokaMarkupField. field_name is the name of the InyokaMarkupField.
         """
 
         def create_content(*args):
-            """
-            Calls get_render_method() with object specific arguments.
+            node = parse(getattr(inst_self, field_name, ''),
+                         wiki_force_existing=self.force_existing)
+            return node.compile('html')
 
-            get_render_method is a staticmethod and therefore can not use
-            any value of the instance.
-            """
-            # Calls the method get_FIELDNAME_render_context_kwargs if the
-            # django model has it.
-            try:
-                render_context = getattr(
-                    inst_self,
-                    f'get_{field_name}_render_context_kwargs',
-                )()
-            except AttributeError:
-                render_context = {}
+        return create_content
 
-            return self.get_render_method()(
-                getattr(inst_self, field_name, ''),
-                context=render_context)
+    def render_content(self, inst_self, field_name, content):
+        """
+        Renders the compiled instructions from the cache.
 
-        return create_content
+        Static instructions do not need a render context, so
+        get_FIELDNAME_render_context_kwargs of the django model is only called
+        if the instructions contain dynamic macros.
+        """
+        renderer = Renderer(content)
+        if renderer.is_static:
+            return renderer.render(RenderContext())
+
+        # Calls the method get_FIELDNAME_render_context_kwargs if the
+        # django model has it.
+        try:
+            render_context = getattr(
+                inst_self,
+                f'get_{field_name}_render_context_kwargs',
+            )()
+        except AttributeError:
+            render_context = {}
+
+        return renderer.render(self.get_render_context(render_context))
 
 
 class PygmentsField(BaseMarkupField):
@@ -14,17 +14,41 @@ import re
 from html.entities import name2codepoint
 from xml.sax.saxutils import quoteattr
 
+import lxml.html
 import lxml.html.clean
 from django.utils.encoding import force_str
 from html5lib import HTMLParser, treebuilders, treewalkers
+from html5lib.constants import namespaces, voidElements
 from html5lib.filters.optionaltags import Filter as OptionalTagsFilter
 from html5lib.serializer import HTMLSerializer
+from html5lib.treewalkers.base import TreeWalker
+from lxml import etree
 from lxml.html.defs import empty_tags
 
 from inyoka.utils.text import increment_string
 
 _entity_re = re.compile(r'&([^;]+);')
 _strip_re = re.compile(r'(?s)<!--.*?-->|<[^>]*>')
+#: attribute values libxml2 and html5lib pass through unchanged
+_plain_value_re = re.compile(r"[\w\-.~:/?#\[\]@!$&'()*+,;=%]*\Z", re.ASCII)
+_plain_name_re = re.compile(r'[a-z][a-z0-9_\-]*\Z')
+
+#: elements html5lib builds the same tree from as lxml, if they are nested
+#: as checked by `_is_plain_tree`.
+_inline_elements = frozenset((
+    'a', 'abbr', 'acronym', 'b', 'bdo', 'big', 'br', 'cite', 'code', 'del',
+    'dfn', 'em', 'font', 'i', 'img', 'ins', 'kbd', 'q', 's', 'samp', 'small',
+    'span', 'strike', 'strong', 'sub', 'sup', 'tt', 'u', 'var',
+))
+_block_elements = frozenset((
+    'blockquote', 'center', 'dd', 'div', 'dl', 'dt', 'h1', 'h2', 'h3', 'h4',
+    'h5', 'h6', 'hr', 'li', 'menu', 'ol', 'p', 'ul',
+))
+_headings = frozenset(('h1', 'h2', 'h3', 'h4', 'h5', 'h6'))
+_item_parents = {'li': ('ul', 'ol', 'menu'), 'dd': ('dl',), 'dt': ('dl',)}
+#: attributes libxml2 rewrites when it serializes them
+_url_attributes = frozenset(('action', 'background', 'cite', 'codebase', 'data',
+                             'href', 'longdesc', 'name', 'src', 'usemap'))
 
 
 #: a dict of html entities to codepoints. This includes the problematic
@@ -115,15 +139,30 @@ def parse_html(string, fragment=True):
 
 def cleanup_html(string, sanitize=True, fragment=True, stream=False,
                  filter_optional_tags=False, id_prefix=None,
-                 update_anchor_links=True, make_xhtml=False):
-    """Clean up some html and convert it to HTML/XHTML."""
+                 update_anchor_links=True, make_xhtml=False, single_parse=True):
+    """
+    Clean up some html and convert it to HTML/XHTML.
+
+    With `single_parse` sanitized fragments are walked straight from the
+    tree of the lxml cleaner instead of being serialized and parsed again
+    with html5lib, if the tree only uses markup both build the same way.
+    """
     if not string.strip():
         return ''
     string = force_str(string)
-    if sanitize:
+    walker = None
+    if sanitize and fragment and single_parse:
+        tree = lxml.html.fromstring(string)
+        lxml.html.clean.clean(tree)
+        if _is_plain_tree(tree):
+            walker = EtreeWalker(tree)
+        else:
+            string = etree.tostring(tree, encoding='unicode', method='html')
+    elif sanitize:
         string = lxml.html.clean.clean_html(string)
-    tree = parse_html(string, fragment)
-    walker = treewalkers.getTreeWalker('dom')(tree)
+    if walker is None:
+        tree = parse_html(string, fragment)
+        walker = treewalkers.getTreeWalker('dom')(tree)
     walker = CleanupFilter(walker, id_prefix, update_anchor_links)
     if filter_optional_tags:
         walker = OptionalTagsFilter(walker)
@@ -180,6 +219,9 @@ class CleanupFilter:
 
     def walk(self, id_map, deferred_links):
         tracked_ids = set()
+        # the id last given to each original id, the search for a free id
+        # continues there instead of walking the taken ones again.
+        last_ids = {}
 
         for token in self.source:
             if token['type'] == 'StartTag':
@@ -233,10 +275,12 @@ class CleanupFilter:
                         attrs['alt'] = ''
 
                 if 'id' in attrs:
-                    element_id = original_id = attrs['id']
+                    original_id = attrs['id']
+                    element_id = last_ids.get(original_id, original_id)
                     while element_id in tracked_ids:
                         element_id = increment_string(element_id)
                     tracked_ids.add(element_id)
+                    last_ids[original_id] = element_id
                     if self.id_prefix:
                         element_id = self.id_prefix + element_id
                     attrs['id'] = element_id
@@ -248,4 +292,63 @@ class CleanupFilter:
                 token['name'] = self.end_tags[token['name']]
             yield token
 
+
+class EtreeWalker(TreeWalker):
+    """
+    Walks an lxml element like the html5lib walkers, it is used by
+    `cleanup_html` for trees checked by `_is_plain_tree`.
+    """
+
+    def __iter__(self):
+        yield from self.walk(self.tree)
+
+    def walk(self, element):
+        name = element.tag
+        if name is etree.Comment:
+            yield self.comment(element.text)
+        else:
+            attrs = {(None, key): value for key, value in element.items()}
+            if name in voidElements:
+                yield from self.emptyTag(namespaces['html'], name, attrs)
+            else:
+                yield self.startTag(namespaces['html'], name, attrs)
+                if element.text:
+                    yield from self.text(element.text)
+                for child in element:
+                    yield from self.walk(child)
+                yield self.endTag(namespaces['html'], name)
+        if element.tail:
+            yield from self.text(element.tail)
+
+
+def _is_plain_tree(element, ancestors=frozenset(), depth=0):
+    """
+    Check if html5lib parses the serialized `element` into the same tree
+    and libxml2 serializes its attributes and text unchanged.  Only a safe
+    subset is accepted: elements that html5lib closes implicitly (like a
+    block in a paragraph or nested links), tables, forms and raw text
+    elements are left to the html5lib parser.
+    """
+    name = element.tag
+    if name is etree.Comment:
+        return '\r' not in element.text and '--' not in element.text
+    if (depth > 100
+            or (name not in _inline_elements and name not in _block_elements)
+            or (name in _block_elements and 'p' in ancestors)
+            or (name in _headings and not _headings.isdisjoint(ancestors))
+            or (name == 'a' and 'a' in ancestors)
+            or (name in _item_parents and (element.getparent() is None
+                                           or element.getparent().tag not in _item_parents[name]))
+            or '\r' in (element.text or '')
+            or '\r' in (element.tail or '')):
+        return False
+    for key, value in element.items():
+        if (not _plain_name_re.match(key) or key in ('checked', 'selected', 'disabled',
+                                                     'nowrap', 'noshade', 'compact')
+                or (key in _url_attributes and not _plain_value_re.match(value))
+                or '\r' in value):
+            return False
+    ancestors = ancestors | {name}
+    return all(_is_plain_tree(child, ancestors, depth + 1) for child in element)
+
 # circ import
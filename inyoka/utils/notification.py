@@ -8,12 +8,19 @@
 from celery import shared_task
 from celery.canvas import subtask
 from django.conf import settings
+from django.db.models import prefetch_related_objects
+from guardian.shortcuts import get_users_with_perms
 
 from inyoka.portal.models import Subscription
+from inyoka.portal.user import User
 from inyoka.utils.logger import logger
-from inyoka.utils.mail import send_mail
+from inyoka.utils.mail import send_mail, send_mails
 from inyoka.utils.templating import render_template
 
+#: stands in for the username of the recipient in notifications that are
+#: rendered once for many recipients
+USERNAME_PLACEHOLDER = '\x00username\x00'
+
 
 def send_notification(user, template_name=None, subject=None, args=None):
     """
@@ -34,24 +41,73 @@ def send_notification(user, template_name=None, subject=None, args=None):
                   settings.INYOKA_SYSTEM_USER_EMAIL, [user.email])
 
 
-def notify_about_subscription(sub, template=None, subject=None, args=None):
-    args = args or {}
-    forum_id = args.get('forum_id')
+def _get_forum_readers(forum_id, readers, user_ids):
+    """
+    Return the ids of the active users out of `user_ids` that may view the
+    forum `forum_id`, loaded with one query and memoized in `readers`.
+    """
+    if forum_id not in readers:
+        from inyoka.forum.models import Forum
+
+        users = get_users_with_perms(Forum.objects.get(id=forum_id), with_superusers=True,
+                                     only_with_perms_in=('view_forum',))
+        readers[forum_id] = set(users.filter(id__in=user_ids, status=User.STATUS_ACTIVE)
+                                     .values_list('id', flat=True))
+    return readers[forum_id]
+
+
+def _can_read(subscription, forum_id, readers, user_ids):
+    """
+    Like :meth:`Subscription.can_read`, but the forum permissions are
+    checked once per forum for all `user_ids` instead of per user.
+    """
+    if subscription.content_type_id is None:
+        if forum_id is None:
+            return False
+    elif subscription.content_type.model == 'forum':
+        forum_id = subscription.object_id
+    elif subscription.content_type.model == 'topic' and subscription.content_object:
+        forum_id = subscription.content_object.forum_id
+    else:
+        return subscription.can_read(forum_id)
+    return subscription.user_id in _get_forum_readers(forum_id, readers, user_ids)
+
+
+def _wants_mail(user, template):
+    if user.is_deleted or 'mail' not in user.settings.get('notify', ['mail']):
+        return False
+    if template == 'topic_split':
+        return 'topic_split' in user.settings.get('notifications', ('topic_split',))
+    return True
 
-    if not sub.can_read(forum_id):
-        # don't send subscriptions to user that don't have read
-        # access to the resource
-        return
-    if template == 'topic_split' and 'topic_split' not in sub.user.settings.get('notifications', ('topic_split',)):
-        return
 
-    send_notification(sub.user, template, subject, args)
+@shared_task
+def send_notification_mails(recipients, template=None, subject=None, args=None):
+    """
+    Send the notification to `recipients`, pairs of the username and the
+    email address.  The template is rendered once, only the username is
+    replaced for each recipient.
+    """
+    args = dict(args or {}, username=USERNAME_PLACEHOLDER)
+    message = render_template('mails/%s.txt' % template, args)
+    send_mails(settings.EMAIL_SUBJECT_PREFIX + subject, [
+        (message.replace(USERNAME_PLACEHOLDER, username), email)
+        for username, email in recipients
+    ], settings.INYOKA_SYSTEM_USER_EMAIL)
 
 
 @shared_task
 def queue_notifications(request_user_id, template=None, subject=None, args=None,
                         include_notified=False, exclude_current_user=True,
                         filter=None, exclude=None, callback=None):
+    """
+    Notify the users with subscriptions matching `filter` and `exclude`.
+
+    The subscriptions are fetched in chunks of ``NOTIFICATION_CHUNK_SIZE``
+    with their users, the forum permissions are checked once per forum and
+    chunk and the mails of each chunk are sent by a :func:`send_notification_mails`
+    task.  Returns the ids of the notified users.
+    """
     assert filter is not None
     assert args is not None
 
@@ -67,21 +123,40 @@ def queue_notifications(request_user_id, template=None, subject=None, args=None,
         subscriptions = subscriptions.exclude(**exclude)
     if exclude_current_user:
         subscriptions = subscriptions.exclude(user_id=request_user_id)
+    subscriptions = subscriptions.select_related('user', 'content_type').order_by('id')
 
     notified_users = set()
     notified = set()
-
-    for subscription in subscriptions.all():
-        user = subscription.user
-        if user.id in notified_users:
-            continue
-
-        notified_users.add(user.id)
-        if callable(args):
-            args = args(subscription)
-        args.update({'username': user.username})
-        notify_about_subscription(subscription, template, subject, args)
-        notified.add(subscription.id)
+    last_id = 0
+
+    while True:
+        chunk = list(subscriptions.filter(id__gt=last_id)[:settings.NOTIFICATION_CHUNK_SIZE])
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+        readers = {}
+        user_ids = [subscription.user_id for subscription in chunk]
+        prefetch_related_objects([subscription for subscription in chunk
+                                  if subscription.content_type_id is not None
+                                  and subscription.content_type.model == 'topic'],
+                                 'content_object')
+
+        recipients = []
+        for subscription in chunk:
+            user = subscription.user
+            if user.id in notified_users:
+                continue
+
+            notified_users.add(user.id)
+            if callable(args):
+                args = args(subscription)
+            if (_can_read(subscription, args.get('forum_id'), readers, user_ids)
+                    and _wants_mail(user, template)):
+                recipients.append((user.username, user.email))
+            notified.add(subscription.id)
+
+        if recipients:
+            send_notification_mails.delay(recipients, template, subject, args)
 
     if not include_notified:
         Subscription.objects.filter(id__in=notified).update(notified=True)
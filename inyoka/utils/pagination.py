@@ -29,6 +29,16 @@
     statement. In this case you can use the `rownum_column` argument.
     To get all items on one page, set `one_page=True` or `per_page=0`.
 
+    Deep offsets get slow on big tables.  If `ordering` is given (a tuple of
+    field names like for ``order_by`` that orders the query totally, e.g.
+    ``('-pub_date', '-id')``), the previous and next links carry a cursor with
+    the values of the first or last entry and the next page is selected with
+    a ``WHERE`` on these values instead of an offset.  The links to the
+    numbered pages still use offsets.  With `approximate_total=True` the
+    number of entries is estimated by the query planner (only PostgreSQL)
+    instead of counted, the next link depends only on whether there are more
+    entries.
+
     URL to the first and last page will be accessible through `pagination.first`
     and `pagination.last`.
 
@@ -53,18 +63,50 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import date
 
+from django.core.exceptions import ValidationError
+from django.db.models import Model, Q
 from django.http import Http404
 from django.utils.encoding import force_str
 
+from inyoka.utils.database import estimate_count
 from inyoka.utils.urls import urlencode
 
+#: the query parameters of the cursors of the keyset mode
+CURSOR_PARAMS = ('after', 'before')
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=lambda v: v.isoformat() if isinstance(v, date) else str(v))
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (BinasciiError, ValueError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def _get_value(obj, name):
+    if isinstance(obj, dict):
+        return obj[name]
+    for attr in name.split('__'):
+        obj = getattr(obj, attr)
+    return obj.pk if isinstance(obj, Model) else obj
+
 
 class Pagination:
     """ Handle pagination """
 
     def __init__(self, request, query, page=1, per_page=10, link=None, total=None,
-            rownum_column=None, max_pages=None, one_page=False):
+            rownum_column=None, max_pages=None, one_page=False, ordering=None,
+            approximate_total=False):
         """ Create pagination object
 
             :param request: The current request.
@@ -76,17 +118,28 @@ class Pagination:
             :param rownum_column: Name of the column used to order items.
             :param max_pages: Maximum number of pages.
             :param one_page: If set, show all elements on one page
+            :param ordering: Field names that order `query` totally, enables
+                             the keyset mode.
+            :param approximate_total: Estimate `total` if it is not given.
         """
 
         self.request = request
+        self.ordering = tuple(ordering) if ordering else None
+        self.cursor = None
+        if self.ordering is not None:
+            query = query.order_by(*self.ordering)
+            self.cursor = self._get_cursor(request)
         self.query = query
         self.page = int(page)
         self.per_page = int(per_page)
         self.base_link = self._get_base_link(link)
-        self.total = self._get_total(total)
+        self.total = self._get_total(total, approximate_total)
         self.rownum_column = rownum_column
+        self.max_pages = max_pages
 
         self._queryset = None
+        self._has_prev = None
+        self._has_next = None
         self._first = None
         self._last = None
         self._next = None
@@ -99,6 +152,10 @@ class Pagination:
         else:
             self.pages = max(0, (self.total - 1)) // self.per_page + 1
 
+        if self.cursor is not None and self.page > self.pages:
+            # the total may be estimated, the cursor decides if the page exists
+            self.pages = self.page
+
         if max_pages and self.pages > max_pages:
             self.pages = max_pages
 
@@ -109,7 +166,21 @@ class Pagination:
         # that try to fuzz the pagination with some extremly invalid unicode data.
         # Catching those here fixes vulerabilty of the whole application.
         enc = lambda v: force_str(v).encode('utf-8') if isinstance(v, str) else v
-        self.params = {enc(k): enc(v) for k, v in self.request.GET.items()}
+        self.params = {enc(k): enc(v) for k, v in self.request.GET.items()
+                       if self.ordering is None or k not in CURSOR_PARAMS}
+
+    def _get_cursor(self, request):
+        """
+        Return the direction (``'after'`` or ``'before'``) and the values of
+        the cursor of the request, or `None`.
+        """
+        for direction in CURSOR_PARAMS:
+            if direction in request.GET:
+                values = decode_cursor(request.GET[direction])
+                if values is None or len(values) != len(self.ordering):
+                    raise Http404()
+                return direction, values
+        return None
 
     def _get_base_link(self, link):
         if link is None:
@@ -119,20 +190,66 @@ class Pagination:
         else:
             self.generate_link = link
 
-    def _get_total(self, total):
+    def _get_total(self, total, approximate=False):
         if total:
             return total
         elif isinstance(self.query, (list, tuple)):
             return len(self.query)
+        elif approximate:
+            return estimate_count(self.query)
         else:
             return self.query.count()
 
+    def _keyset_filter(self, values, reverse=False):
+        """
+        Return a filter for the entries after (or before if `reverse` is set)
+        the entry with the `values` of the ordering fields.
+        """
+        condition = Q()
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') != reverse else 'gt'
+            equal = {f.lstrip('-'): value for f, value in
+                     zip(self.ordering[:index], values)}
+            condition |= Q(**equal, **{f'{name}__{lookup}': values[index]})
+        return condition
+
+    def _get_keyset_page(self):
+        index_first = (self.page - 1) * self.per_page
+        if self.cursor is None:
+            entries = list(self.query[index_first:index_first + self.per_page + 1])
+            self._has_prev = self.page > 1
+            self._has_next = len(entries) > self.per_page
+            return entries[:self.per_page]
+
+        direction, values = self.cursor
+        reverse = direction == 'before'
+        try:
+            query = self.query.filter(self._keyset_filter(values, reverse))
+            if reverse:
+                query = query.reverse()
+            entries = list(query[:self.per_page + 1])
+        except (ValidationError, ValueError, TypeError):
+            raise Http404()
+        more = len(entries) > self.per_page
+        entries = entries[:self.per_page]
+        if reverse:
+            entries.reverse()
+            self._has_prev, self._has_next = more and self.page > 1, True
+        else:
+            self._has_prev, self._has_next = True, more
+        return entries
+
     def get_queryset(self):
         """ Get objects for current page """
 
         if self._queryset is not None:
             return self._queryset
 
+        if self.ordering is not None:
+            self._queryset = self._get_keyset_page()
+            return self._queryset
+
         index_first = (self.page - 1) * self.per_page
         index_last = index_first + self.per_page
 
@@ -156,10 +273,16 @@ class Pagination:
             url = self.base_link
         else:
             url = f'{self.base_link}{page}/'
-        if self.params:
-            url = url + f'?{urlencode(self.params)}'
+        if params:
+            url = url + f'?{urlencode(params)}'
         return url
 
+    def _generate_cursor_link(self, page, direction, entry):
+        if page == 1 or not self.get_queryset():
+            return self.generate_link(page, self.params)
+        values = [_get_value(entry, field.lstrip('-')) for field in self.ordering]
+        return self.generate_link(page, dict(self.params, **{direction: encode_cursor(values)}))
+
     @property
     def first(self):
         """ Return the url to the first page """
@@ -179,6 +302,13 @@ class Pagination:
     def prev(self):
         """ Return the url to the previous page, or False if already on first page """
 
+        if self.ordering is not None:
+            if self._prev is None:
+                entries = self.get_queryset()
+                self._prev = self._has_prev and self._generate_cursor_link(
+                    self.page - 1, 'before', entries and entries[0])
+            return self._prev
+
         if self.page <= 1:
             return False
         if self._prev is None:
@@ -189,6 +319,15 @@ class Pagination:
     def next(self):
         """ Return the url to the last page, or False if already on the last page """
 
+        if self.ordering is not None:
+            if self.max_pages and self.page >= self.max_pages:
+                return False
+            if self._next is None:
+                entries = self.get_queryset()
+                self._next = self._has_next and self._generate_cursor_link(
+                    self.page + 1, 'after', entries and entries[-1])
+            return self._next
+
         if self.page >= self.pages:
             return False
         if self._next is None:
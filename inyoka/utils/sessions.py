@@ -9,6 +9,7 @@
     :license: BSD, see LICENSE for more details.
 """
 from datetime import datetime
+from operator import itemgetter
 from time import time
 
 from django.core.cache import cache
@@ -21,6 +22,14 @@ from inyoka.utils.urls import url_for
 
 SESSION_DELTA = 300
 
+#: the types of sessions, every type has its own sorted set of session ids
+#: scored by the time the session was last seen.
+SESSION_TYPES = ('anonymous', 'user', 'team')
+
+
+def _session_set_key(session_type):
+    return cache.make_key('sessions:%s' % session_type)
+
 
 def set_session_info(request):
     """Set the session info."""
@@ -36,7 +45,8 @@ def set_session_info(request):
     if request.session.new:
         return
 
-    key = 'sessioninfo:%s' % request.session['sid']
+    sid = request.session['sid']
+    key = 'sessioninfo:%s' % sid
 
     session = {
         'id': None,
@@ -53,7 +63,22 @@ def set_session_info(request):
         session['text'] = request.user.username
         session['link'] = url_for(request.user)
 
-    cache.set(key, session, timeout=SESSION_DELTA)
+    # Everything is written with one round trip: the session is moved to the
+    # sorted set of its type and sessions that were not seen for
+    # SESSION_DELTA seconds are removed from it.  Only registered sessions
+    # are listed, so only their info is stored.
+    now = time()
+    pipeline = cache.client.get_client().pipeline(transaction=False)
+    for session_type in SESSION_TYPES:
+        set_key = _session_set_key(session_type)
+        if session_type == session['type']:
+            pipeline.zadd(set_key, {sid: now})
+            pipeline.zremrangebyscore(set_key, '-inf', now - SESSION_DELTA)
+        else:
+            pipeline.zrem(set_key, sid)
+    if not session['anonymous']:
+        pipeline.set(cache.make_key(key), cache.client.encode(session), ex=SESSION_DELTA)
+    pipeline.execute()
 
 
 class SurgeProtectionMixin:
@@ -104,17 +129,47 @@ def get_user_record(values=None):
     return record, timestamp
 
 
-def get_sessions(order_by='-last_change'):
-    """Get a simple list of active sessions for the portal index."""
-    sessions = [session[1] for session in cache.get_many(cache.keys('sessioninfo:*')).items()]
+def _count_sessions(pipeline, min_score):
+    for session_type in SESSION_TYPES:
+        pipeline.zcount(_session_set_key(session_type), min_score, '+inf')
+
+
+def get_session_counts():
+    """
+    Return a dict with the number of active sessions per type (see
+    `SESSION_TYPES`).
+    """
+    pipeline = cache.client.get_client(write=False).pipeline(transaction=False)
+    _count_sessions(pipeline, time() - SESSION_DELTA)
+    return dict(zip(SESSION_TYPES, pipeline.execute()))
+
 
-    anonymous = sum(x['anonymous'] for x in sessions)
+def get_sessions():
+    """
+    Get the number of active sessions and a list of the active registered
+    sessions (the most recently seen first) for the portal index.
+    """
+    min_score = time() - SESSION_DELTA
+    pipeline = cache.client.get_client(write=False).pipeline(transaction=False)
+    _count_sessions(pipeline, min_score)
+    for session_type in ('user', 'team'):
+        pipeline.zrangebyscore(_session_set_key(session_type), min_score,
+                               '+inf', withscores=True)
+    *counts, users, team = pipeline.execute()
+    counts = dict(zip(SESSION_TYPES, counts))
+
+    keys = ['sessioninfo:%s' % sid.decode() for sid, last_seen in
+            sorted(users + team, key=itemgetter(1), reverse=True)]
+    info = cache.get_many(keys)
+    registered_sessions = [info[key] for key in keys if key in info]
+
+    registered = counts['user'] + counts['team']
     return {
-        'anonymous': anonymous,
-        'registered': len(sessions) - anonymous,
-        'all': len(sessions),
-        'sessions': sessions,
-        'registered_sessions': [s for s in sessions if not s['anonymous']]
+        'anonymous': counts['anonymous'],
+        'registered': registered,
+        'all': counts['anonymous'] + registered,
+        'sessions': registered_sessions,
+        'registered_sessions': registered_sessions,
     }
 
 
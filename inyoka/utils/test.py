@@ -17,9 +17,12 @@ from django.contrib.auth import authenticate, login
 from django.core.cache import caches
 from django.http import HttpRequest
 from django.test import TestCase as _TestCase
+from django.test import TransactionTestCase as _TransactionTestCase
 from django.test.client import Client
 
+from inyoka.markup.templates import invalidate_page_template
 from inyoka.portal.user import User
+from inyoka.utils.local import local_manager
 from inyoka.utils.spam import (
     get_comment_check_url,
     get_mark_ham_url,
@@ -159,6 +162,17 @@ class AntiSpamTestCaseMixin:
         )
 
 
+def flush_caches():
+    content_cache = caches['content']
+    content_cache.delete_pattern("*")
+    default_cache = caches['default']
+    default_cache.delete_pattern("*")
+    # ids of rolled back pages and revisions are used again
+    invalidate_page_template()
+    # e.g. the wiki storages of the last test
+    local_manager.cleanup()
+
+
 class TestCase(_TestCase):
     """
     Default TestCase for all Inyoka tests.
@@ -169,10 +183,7 @@ class TestCase(_TestCase):
     def _post_teardown(self):
         """Flush cache"""
         super()._post_teardown()
-        content_cache = caches['content']
-        content_cache.delete_pattern("*")
-        default_cache = caches['default']
-        default_cache.delete_pattern("*")
+        flush_caches()
 
     def assertXMLEqual(self, xml1, xml2, msg=None):
         """Prettify comparison of two XML strings"""
@@ -180,3 +191,18 @@ class TestCase(_TestCase):
         xml2 = xml.dom.minidom.parseString(xml2).toprettyxml(indent='  ')
 
         super().assertXMLEqual(xml1, xml2, msg)
+
+
+class TransactionTestCase(_TransactionTestCase):
+    """
+    TestCase for tests that need committed data, e.g. to use other
+    processes.
+
+    Flushes the database and deletes the cache after each run, Django runs
+    these tests after all other database tests.
+    """
+
+    def _post_teardown(self):
+        """Flush cache"""
+        super()._post_teardown()
+        flush_caches()
@@ -24,6 +24,9 @@
     :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import re
+from functools import lru_cache
+
 from django.http import HttpResponseRedirect
 
 from inyoka.portal.user import User
@@ -170,16 +173,112 @@ def get_privilege_flags(user, page_name, groups=None):
 
     page_name = normalize_pagename(page_name)
 
+    matcher = get_acl_matcher()
+    if matcher is None:
+        return PRIV_DEFAULT
+    return matcher.get_privilege_flags(user.username, page_name, groups)
+
+
+_escape_re = re.compile(r'\\(.)', re.S)
+
+
+class ACLMatcher:
+    """
+    The rules of the ACL storage compiled into a prefix trie over the
+    patterns, so a check only looks at the rules whose pattern can match the
+    page name instead of running every pattern.
+
+    The rules are still applied in the order of the storage.  Results are
+    memoized per subjects of the user and page name.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.signature = self.get_signature(rules)
+        self.user_subjects = set()
+        self.group_subjects = {}
+        # every node of the trie is a tuple of the children (a dict keyed by
+        # the next character), the rules with a wildcard after the prefix and
+        # the rules without a wildcard ending at this node.
+        self.trie = ({}, [], [])
+        for index, (pattern, subject, add_privs, del_privs) in enumerate(rules):
+            if subject.startswith('@'):
+                self.group_subjects[subject] = subject[1:]
+            else:
+                self.user_subjects.add(subject)
+
+            prefix, wildcard, rest = pattern.pattern[1:-1].partition('.*?')
+            node = self.trie
+            for char in _escape_re.sub(r'\1', prefix).lower():
+                node = node[0].setdefault(char, ({}, [], []))
+            if wildcard:
+                # `prefix*` matches everything below the node, everything
+                # else has to be tested with the regular expression.
+                test = pattern.match if rest else None
+                node[1].append((index, subject, test, add_privs, del_privs))
+            else:
+                node[2].append((index, subject, None, add_privs, del_privs))
+
+        self._get_flags = lru_cache(maxsize=4096)(self._compute_flags)
+
+    @staticmethod
+    def get_signature(rules):
+        return tuple((pattern.pattern, subject, add_privs, del_privs)
+                     for pattern, subject, add_privs, del_privs in rules)
+
+    def get_subjects(self, username, groups):
+        """Return the subjects of the rules that apply to the user."""
+        subjects = [subject for subject, group in self.group_subjects.items()
+                    if group in groups]
+        if username in self.user_subjects:
+            subjects.append(username)
+        return frozenset(subjects)
+
+    def get_privilege_flags(self, username, page_name, groups):
+        subjects = self.get_subjects(username, groups)
+        if not subjects:
+            return PRIV_NONE
+        return self._get_flags(subjects, page_name)
+
+    def _compute_flags(self, subjects, page_name):
+        candidates = []
+        node = self.trie
+        for char in page_name.lower():
+            candidates.extend(node[1])
+            node = node[0].get(char)
+            if node is None:
+                break
+        else:
+            candidates.extend(node[1])
+            candidates.extend(node[2])
+
+        privileges = PRIV_NONE
+        for index, subject, test, add_privs, del_privs in sorted(candidates):
+            if subject in subjects and (test is None or test(page_name) is not None):
+                privileges = (privileges | add_privs) & ~del_privs
+        return privileges
+
+
+_acl_matcher = None
+
+
+def get_acl_matcher():
+    """
+    Return the `ACLMatcher` for the current ACL storage or `None` if there
+    are no rules.  The matcher is only compiled again if the rules changed.
+    """
+    global _acl_matcher
     rules = storage.acl
     if not rules:
-        return PRIV_DEFAULT
-    privileges = PRIV_NONE
-    for pattern, subject, add_privs, del_privs in rules:
-        if (subject == user.username or
-            (subject.startswith('@') and subject[1:] in groups)) and \
-                pattern.match(page_name) is not None:
-            privileges = (privileges | add_privs) & ~del_privs
-    return privileges
+        return None
+    matcher = _acl_matcher
+    if matcher is None or matcher.rules is not rules:
+        if matcher is None or matcher.signature != ACLMatcher.get_signature(rules):
+            matcher = _acl_matcher = ACLMatcher(rules)
+        else:
+            # the same rules loaded again, compare only against them next time
+            matcher.rules = rules
+    return matcher
 
 
 def get_privileges(user, page_name, groups=None):
@@ -6,23 +6,38 @@
     Creates a snapshot of all wiki pages in HTML format. Requires
     BeautifulSoup4 to be installed.
 
+    The pages are rendered by a pool of ``--workers`` processes and written
+    by the main process, either into the folder or into a tar or zip
+    archive (``--archive``).  The folder contains a manifest with the
+    revision and the referenced files of every exported page, with
+    ``--incremental`` only pages with a new revision are rendered again and
+    the files no page references anymore are removed.
+
     :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 
 
 import datetime
+import json
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 from hashlib import sha1
+from io import BytesIO
+from time import time
 from urllib.parse import unquote as url_unquote
 
-from os import chmod, mkdir, path, unlink, walk
+from os import chmod, makedirs, path, unlink, walk
 from re import compile, escape, sub
-from shutil import copy, copytree, rmtree
+from shutil import copy, rmtree
 
+import django
 from bs4 import BeautifulSoup
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from django.template.defaultfilters import date
 from django.utils.encoding import force_str
 from django.utils.translation import activate
@@ -54,15 +69,16 @@ NON_WIKI_RE = compile('|'.join(escape(href(u)) for u in
 WIKI_BEGIN_RE = compile("^%s" % escape(href('wiki')))
 WIKI_CENTER_RE = compile("^%s$" % escape(href('wiki')))
 PORTAL_RE = compile(escape(href('portal')))
-DONE_SRCS = {}
-UPDATED_SRCS = set()
-
-SNAPSHOT_MESSAGE = '<div class="message staticwikinote"><strong>Hinweis:'\
-                   '</strong> Dies ist ein statischer Snapshot unseres '\
-                   'Wikis vom %s und kann daher nicht bearbeitet werden. '\
-                   'Der aktuelle Artikel ist unter <a '\
-                   'href="%s">wiki.ubuntuusers.de</a> zu finden.</div>'
+STYLE_HASH_RE = compile(r'\?[0-9a-f]{32}')
+MANIFEST = 'manifest.json'
+
+SNAPSHOT_TEMPLATE = '<div class="message staticwikinote"><strong>Hinweis:'\
+                    '</strong> Dies ist ein statischer Snapshot unseres '\
+                    'Wikis vom %s und kann daher nicht bearbeitet werden. '\
+                    'Der aktuelle Artikel ist unter <a '\
+                    'href="%s">wiki.ubuntuusers.de</a> zu finden.</div>'
 SNAPSHOT_DATE = None
+SNAPSHOT_MESSAGE = None
 
 REDIRECT_MESSAGE = '<p>Diese Seite ist eine Weiterleitung. Daher wirst '\
                    'du in 5 Sekunden automatisch nach <a '\
@@ -83,6 +99,98 @@ verbosity = 0
 
 BeautifulSoup = partial(BeautifulSoup, features='lxml')
 
+#: the command that exports the pages in this (worker) process
+_exporter = None
+
+
+def _init_worker(folder, include_images, snapshot_message):
+    """Set up a worker process of the export pool."""
+    global FOLDER, INCLUDE_IMAGES, SNAPSHOT_MESSAGE, _exporter
+    django.setup()
+    activate(settings.LANGUAGE_CODE)
+    FOLDER, INCLUDE_IMAGES, SNAPSHOT_MESSAGE = folder, include_images, snapshot_message
+    _exporter = Command()
+
+
+def _export_page(name):
+    return _exporter.export_page(name)
+
+
+class DirectoryOutput:
+    """Writes the snapshot into a folder."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, name):
+        pth = path.join(self.folder, name)
+        makedirs(path.dirname(pth), exist_ok=True)
+        return pth
+
+    def write(self, name, content):
+        with open(self._path(name), 'w') as fobj:
+            fobj.write(content)
+
+    def copy(self, src, name):
+        dst = self._path(name)
+        copy(src, dst)
+        chmod(dst, 0o644)
+
+    def remove(self, name):
+        try:
+            unlink(path.join(self.folder, name))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        pass
+
+
+class TarOutput:
+    """Streams the snapshot into a (compressed) tar archive."""
+
+    def __init__(self, filename, prefix):
+        mode = 'w'
+        if filename.endswith(('.tar.gz', '.tgz')):
+            mode = 'w:gz'
+        elif filename.endswith(('.tar.bz2', '.tbz2')):
+            mode = 'w:bz2'
+        elif filename.endswith(('.tar.xz', '.txz')):
+            mode = 'w:xz'
+        self.archive = tarfile.open(filename, mode, dereference=True)
+        self.prefix = prefix
+
+    def write(self, name, content):
+        data = content.encode('utf-8')
+        info = tarfile.TarInfo(path.join(self.prefix, name))
+        info.size = len(data)
+        info.mtime = int(time())
+        info.mode = 0o644
+        self.archive.addfile(info, BytesIO(data))
+
+    def copy(self, src, name):
+        self.archive.add(src, arcname=path.join(self.prefix, name))
+
+    def close(self):
+        self.archive.close()
+
+
+class ZipOutput:
+    """Streams the snapshot into a zip archive."""
+
+    def __init__(self, filename, prefix):
+        self.archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+        self.prefix = prefix
+
+    def write(self, name, content):
+        self.archive.writestr(path.join(self.prefix, name), content)
+
+    def copy(self, src, name):
+        self.archive.write(src, path.join(self.prefix, name))
+
+    def close(self):
+        self.archive.close()
+
 
 class Command(BaseCommand):
     help = "Creates a snapshot of all wiki pages in HTML format. Requires BeautifulSoup4 to be installed."
@@ -90,6 +198,9 @@ class Command(BaseCommand):
     def __init__(self):
         BaseCommand.__init__(self)
         self.license_file = '_lizenz.html'
+        self.user = None
+        #: files referenced by the current page, ``{name: [source, is_style]}``
+        self.files = {}
 
     def add_arguments(self, parser):
         parser.add_argument('-p', '--path',
@@ -100,13 +211,23 @@ class Command(BaseCommand):
         parser.add_argument('--images', action='store_true',
             help='If given, images will be included in the static wiki.')
 
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of processes that render the pages.')
+
+        parser.add_argument('--incremental', action='store_true',
+            help='Only export pages that changed since the last snapshot '
+                 'in the folder.')
+
+        parser.add_argument('--archive', action='store',
+            help='Write the snapshot into this tar or zip archive instead '
+                 'of the folder.')
+
     def handle(self, *args, **options):
         global verbosity
         verbosity = int(options['verbosity'])
-        path = options['path']
-        if path is not None:
+        if options['path'] is not None:
             global FOLDER
-            FOLDER = path
+            FOLDER = options['path']
 
         global INCLUDE_IMAGES
         if options['images']:
@@ -115,11 +236,29 @@ class Command(BaseCommand):
         if verbosity >= 1:
             print("Starting Export")
 
+        archive = options['archive']
+        if archive and options['incremental']:
+            raise CommandError('--incremental can not be used with --archive')
+        if options['workers'] > 1 and any(conn.in_atomic_block for conn in connections.all()):
+            # the workers use their own connections and would not see the
+            # uncommitted changes, closing the connection would break the
+            # transaction of the caller.
+            raise CommandError('--workers can not be used inside a transaction')
+        if archive and archive.endswith('.zip'):
+            output = ZipOutput(archive, path.basename(FOLDER.rstrip('/')))
+        elif archive:
+            output = TarOutput(archive, path.basename(FOLDER.rstrip('/')))
+        else:
+            output = DirectoryOutput(FOLDER)
+
         global SNAPSHOT_DATE, SNAPSHOT_MESSAGE
         activate(settings.LANGUAGE_CODE)
         SNAPSHOT_DATE = date(datetime.date.today(), settings.DATE_FORMAT)
-        SNAPSHOT_MESSAGE = SNAPSHOT_MESSAGE % (SNAPSHOT_DATE, '%s')
-        self.create_snapshot()
+        SNAPSHOT_MESSAGE = SNAPSHOT_TEMPLATE % (SNAPSHOT_DATE, '%s')
+        try:
+            self.create_snapshot(output, max(1, options['workers']), options['incremental'])
+        finally:
+            output.close()
 
         if verbosity >= 1:
             print("Export complete")
@@ -150,10 +289,6 @@ class Command(BaseCommand):
             'SETTINGS': settings
         }
 
-    def _write_file(self, pth, content):
-        with open(pth, 'w+') as fobj:
-            fobj.write(content)
-
     def save_file(self, url, is_main_page=False, is_static=False):
         if not INCLUDE_IMAGES and not is_static and not is_main_page:
             return ""
@@ -172,14 +307,10 @@ class Command(BaseCommand):
         if rel_path:
             abs_path = path.join(base, rel_path)
             hash_code = sha1(force_str(rel_path).encode('utf-8')).hexdigest()
-            if hash_code not in DONE_SRCS:
-                ext = path.splitext(rel_path)[1]
-                fname = '%s%s' % (hash_code, ext)
-                dst = path.join(FOLDER, 'files', '_', fname)
-                copy(abs_path, dst)
-                DONE_SRCS[hash_code] = fname
-                chmod(dst, 0o644)
-            return path.join('_', DONE_SRCS[hash_code])
+            ext = path.splitext(rel_path)[1]
+            dst = path.join('_', '%s%s' % (hash_code, ext))
+            self.files.setdefault(path.join('files', dst), [abs_path, False])
+            return dst
 
         return ""
 
@@ -207,18 +338,9 @@ class Command(BaseCommand):
                 tag.extract()
             else:
                 tag['href'] = '%s%s' % (pre, rel_path)
-                if rel_path not in UPDATED_SRCS:
-                    abs_path = path.join(FOLDER, 'files', rel_path)
-                    if path.isfile(abs_path):
-                        content = ''
-                        with open(abs_path) as f:
-                            content = f.read()
-
-                        _re = compile(r'\?[0-9a-f]{32}')
-                        content = _re.sub('', content)
-                        with open(abs_path, 'w') as f:
-                            f.write(content)
-                            UPDATED_SRCS.add(rel_path)
+                # the hashes are removed from the urls in the stylesheet
+                # when it is written
+                self.files[path.join('files', rel_path)][1] = True
 
         def _handle_favicon(self, tag):
             rel_path = self.save_file(tag['href'], is_main_page, True)
@@ -347,19 +469,104 @@ class Command(BaseCommand):
                 handle_non_wiki_link,
                 handle_snapshot_message]
 
-    def create_snapshot(self):
-        user = User.objects.get_anonymous_user()
+    def load_manifest(self):
+        """
+        Return the manifest of the snapshot in the folder, or `None` if
+        there is none or it was created with other options.
+        """
+        try:
+            with open(path.join(FOLDER, MANIFEST)) as fobj:
+                manifest = json.load(fobj)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('images') != INCLUDE_IMAGES:
+            return None
+        return manifest
+
+    def write_files(self, output, files, written):
+        """Write the referenced `files` that were not `written` yet."""
+        for name, (src, is_style) in files.items():
+            if name in written:
+                continue
+            written.add(name)
+            if is_style:
+                with open(src) as fobj:
+                    output.write(name, STYLE_HASH_RE.sub('', fobj.read()))
+            else:
+                output.copy(src, name)
+
+    def export_page(self, name):
+        """
+        Render the page `name` for the snapshot.  Returns a dict with the
+        revision, the files of the page (``{name: content}``) and the files
+        it references, or `None` if the page is not exported.
+        """
+        if self.user is None:
+            self.user = User.objects.get_anonymous_user()
+        user = self.user
+        parts = 0
+        is_main_page = False
+
+        if not has_privilege(user, name, 'read'):
+            return
+
+        try:
+            page = Page.objects.get_by_name(name, False, True)
+        except CaseSensitiveException as e:
+            page = e.page
+        except Page.DoesNotExist:
+            return
+
+        if page.name == settings.WIKI_MAIN_PAGE:
+            is_main_page = True
+
+        if page.rev.attachment:
+            # page is an attachment
+            return
+        if len(page.trace) > 1:
+            # page is a subpage
+            parts = len(page.trace) - 1
+
+        self.files = {}
+        content = self.fetch_page(page, user=user, settings=settings).content
+        if content is None:
+            return
+        content = content.decode('utf8')
+        soup = BeautifulSoup(content)
 
-        # create the folder structure
-        if not path.exists(FOLDER):
-            mkdir(FOLDER)
-        else:
+        # Apply the handlers from above to modify the page content
+        for handler in self.HANDLERS:
+            handler(self, soup, self._pre(parts), is_main_page, page.name)
+
+        # If a page is a redirect page, add a forward link
+        redirect = page.metadata.get('X-Redirect')
+        if redirect:
+            self.handle_redirect_page(soup, self._pre(parts), redirect)
+
+        content = str(soup)
+        pages = {path.join('files', '%s.html' % self.fix_path(page.name)): content}
+
+        if is_main_page:
+            pages['index.html'] = compile(r'(src|href)="\./([^"]+)"') \
+                .sub(lambda m: '%s="./files/%s"' %
+                               (m.groups()[0], m.groups()[1]), content)
+
+        return {'name': name, 'revision': page.rev.id, 'pages': pages,
+                'files': self.files}
+
+    def create_snapshot(self, output, workers=1, incremental=False):
+        global _exporter
+        self.user = User.objects.get_anonymous_user()
+
+        manifest = self.load_manifest() if incremental else None
+        if manifest is None and isinstance(output, DirectoryOutput) and path.exists(FOLDER):
             for root, dirs, files in walk(FOLDER):
                 for f in files:
                     unlink(path.join(root, f))
                 for d in dirs:
                     rmtree(path.join(root, d))
-        mkdir(path.join(FOLDER, 'files'))
+        old_pages = manifest['pages'] if manifest else {}
+        written = set()
 
         img = partial(path.join, settings.STATIC_ROOT, 'img')
         static_paths = ((img('icons'), 'icons'),
@@ -372,21 +579,27 @@ class Command(BaseCommand):
                         img('wiki.svg'))
 
         for pth in static_paths:
-            _pth = pth[0] if isinstance(pth, _iterables) else pth
-            if path.isdir(_pth):
-                copytree(_pth, path.join(FOLDER, 'files', 'img', pth[1]))
+            if isinstance(pth, _iterables):
+                src, dst = pth[0], path.join('files', 'img', pth[1])
+            else:
+                src, dst = pth, path.join('files', 'img', path.basename(pth))
+            if path.isdir(src):
+                for root, dirs, files in walk(src):
+                    for f in files:
+                        rel_path = path.normpath(path.join(path.relpath(root, src), f))
+                        output.copy(path.join(root, f), path.join(dst, rel_path))
             else:
-                copy(_pth, path.join(FOLDER, 'files', 'img'))
-        attachment_folder = path.join(FOLDER, 'files', '_')
-        mkdir(attachment_folder)
+                output.copy(src, dst)
 
-        license_content = self._static_page('lizenz', user=user, settings=settings).content.decode('utf8')
+        self.files = {}
+        license_content = self._static_page('lizenz', user=self.user, settings=settings).content.decode('utf8')
         license_soup = BeautifulSoup(license_content)
         # Apply the handlers from above to modify the page content
         for handler in self.HANDLERS:
             handler(self, license_soup, self._pre(0), is_main_page=False, page_name='Lizenz')
-        license_content = str(license_soup)
-        self._write_file(path.join(FOLDER, 'files', self.license_file), license_content)
+        output.write(path.join('files', self.license_file), str(license_soup))
+        self.write_files(output, self.files, written)
+        license_files = set(written)
 
         if verbosity >= 1:
             pb = ProgressBar(40)
@@ -406,70 +619,63 @@ class Command(BaseCommand):
             if do_add:
                 todo.add(page)
 
-        def _fetch_and_write(name):
-            parts = 0
-            is_main_page = False
-
-            if not has_privilege(user, name, 'read'):
-                return
-
-            try:
-                page = Page.objects.get_by_name(name, False, True)
-            except CaseSensitiveException as e:
-                page = e.page
-            except Page.DoesNotExist:
-                return
-
-            if page.name == settings.WIKI_MAIN_PAGE:
-                is_main_page = True
-
-            if page.rev.attachment:
-                # page is an attachment
-                return
-            if len(page.trace) > 1:
-                # page is a subpage
-                # create subdirectories
-                for part in page.trace[:-1]:
-                    pth = path.join(FOLDER, 'files', *self.fix_path(part).split('/'))
-                    if not path.exists(pth):
-                        mkdir(pth)
-                    parts += 1
-
-            content = self.fetch_page(page, user=user, settings=settings).content
-            if content is None:
-                return
-            content = content.decode('utf8')
-            soup = BeautifulSoup(content)
-
-            # Apply the handlers from above to modify the page content
-            for handler in self.HANDLERS:
-                handler(self, soup, self._pre(parts), is_main_page, page.name)
-
-            # If a page is a redirect page, add a forward link
-            redirect = page.metadata.get('X-Redirect')
-            if redirect:
-                self.handle_redirect_page(soup, self._pre(parts), redirect)
-
-            content = str(soup)
-
-            self._write_file(path.join(FOLDER, 'files', '%s.html' %
-                                                   self.fix_path(page.name)), content)
-
-            if is_main_page:
-                content = compile(r'(src|href)="\./([^"]+)"') \
-                    .sub(lambda m: '%s="./files/%s"' %
-                                   (m.groups()[0], m.groups()[1]), content)
-                self._write_file(path.join(FOLDER, 'index.html'), content)
-
-        if len(todo) == 0:
+        # keep the pages whose revision did not change since the last snapshot
+        revisions = {name.lower(): rev for name, rev in
+                     Page.objects.values_list('name', 'last_rev_id')}
+        pages = {}
+        names = []
+        for name in sorted(todo):
+            entry = old_pages.get(name)
+            if entry is not None and entry['revision'] == revisions.get(name):
+                pages[name] = entry
+            else:
+                names.append(name)
+        for name, entry in old_pages.items():
+            if name not in pages:
+                for fname in entry['pages']:
+                    output.remove(fname)
+
+        if workers > 1:
+            # the workers must not share the database connections
+            connections.close_all()
+            executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                           initargs=(FOLDER, INCLUDE_IMAGES, SNAPSHOT_MESSAGE))
+            results = executor.map(_export_page, names, chunksize=16)
+        else:
+            executor = None
+            _exporter = self
+            results = map(_export_page, names)
+
+        if len(names) == 0:
             percents = []
         else:
-            percents = list(percentize(len(todo)))
-        for percent, name in zip(percents, todo):
-            _fetch_and_write(name)
-            if verbosity >= 1:
-                pb.update(percent)
+            percents = list(percentize(len(names)))
+        try:
+            for percent, result in zip(percents, results):
+                if result is not None:
+                    for fname, content in result['pages'].items():
+                        output.write(fname, content)
+                    self.write_files(output, result['files'], written)
+                    pages[result['name']] = {'revision': result['revision'],
+                                             'pages': list(result['pages']),
+                                             'files': sorted(result['files'])}
+                if verbosity >= 1:
+                    pb.update(percent)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        # remove the files only the removed or changed pages referenced,
+        # the manifests of older snapshots do not list the files.
+        if all('files' in entry for entry in pages.values()):
+            referenced = license_files.union(*(entry['files'] for entry in pages.values()))
+            for entry in old_pages.values():
+                for fname in entry.get('files', ()):
+                    if fname not in referenced:
+                        output.remove(fname)
+
+        output.write(MANIFEST, json.dumps({'images': INCLUDE_IMAGES, 'pages': pages}))
 
         if verbosity >= 1:
-            print("\nCreated Wikisnapshot with %s pages; excluded %s pages"
-                % (len(todo), num_excluded))
+            print("\nCreated Wikisnapshot with %s pages (%s unchanged); excluded %s pages"
+                % (len(todo), len(todo) - len(names), num_excluded))
@@ -82,11 +82,12 @@ from typing import Optional
 import magic
 import random
 import time
+from bisect import bisect_left
 from collections import defaultdict
 from django.apps import apps
 from django.conf import settings
 from django.core.cache import cache
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Count, Max
 from django.db.models.functions import Upper
 from django.utils.html import escape
@@ -94,6 +95,7 @@ from django.utils.translation import gettext as _, to_locale, get_language
 from django.utils.translation import gettext_lazy
 from functools import partial
 from hashlib import sha1
+from uuid import uuid4
 from django.utils.functional import cached_property
 from werkzeug.utils import secure_filename
 
@@ -126,6 +128,31 @@ def is_privileged_wiki_page(name):
 to_page_by_slug_key = lambda name: f'wiki/page_by_slug/{wiki_slugify(name)}'
 
 
+class SlugIndex:
+    """
+    The slugs of all wiki pages as a sorted tuple, membership is tested by
+    bisection.  Every process keeps one index and builds it again if the
+    `version` stored in the cache changed or after ``WIKI_CACHE_TIMEOUT``
+    seconds like the cached slug list, see :meth:`PageManager.get_slug_index`.
+    """
+
+    def __init__(self, slugs, version=None):
+        self.slugs = tuple(sorted(slugs))
+        self.version = version
+        self.expires = time.time() + settings.WIKI_CACHE_TIMEOUT
+
+    def __contains__(self, slug):
+        index = bisect_left(self.slugs, slug)
+        return index < len(self.slugs) and self.slugs[index] == slug
+
+    def __len__(self):
+        return len(self.slugs)
+
+
+#: the `SlugIndex` of this process
+_slug_index = None
+
+
 class PageManager(models.Manager):
     """
     Because our table definitions are rather complex due to shared text,
@@ -135,6 +162,10 @@ class PageManager(models.Manager):
     The `PageManager` singleton instance is available as `Page.objects`.
     """
 
+    #: cache key of the version of the slug list, changed whenever the
+    #: slug list is invalidated
+    slug_index_version_key = 'wiki/slug_index_version'
+
     def exists(self, name, cached=True):
         """
         Returns `True` if `name` exists, the results are cached in a
@@ -143,13 +174,24 @@ class PageManager(models.Manager):
         `name` gets slugified with `wiki_slugify()` before.
         """
         if cached:
-            if not hasattr(local_cache, 'slug_list'):
-                local_cache.slug_list = self.get_slug_list()
-            slug_list = local_cache('slug_list')
+            slug_list = self._get_local_slug_index()
         else:
             slug_list = self.get_slug_list()
         return wiki_slugify(name) in slug_list
 
+    def get_existing(self, names):
+        """
+        Return the set of the `names` that exist, like :meth:`exists` but
+        for many pages at once.
+        """
+        index = self._get_local_slug_index()
+        return {name for name in names if wiki_slugify(name) in index}
+
+    def _get_local_slug_index(self):
+        if not hasattr(local_cache, 'slug_index'):
+            local_cache.slug_index = self.get_slug_index()
+        return local_cache('slug_index')
+
     def get_head(self, name, offset=0):
         """
         Return the revision ID for head or with an offset.  The offset
@@ -276,6 +318,21 @@ class PageManager(models.Manager):
         key = 'wiki/objects_slugs'
         return cache.get_or_set(key, make_sluglist, settings.WIKI_CACHE_TIMEOUT)
 
+    def get_slug_index(self):
+        """
+        Return the `SlugIndex` of this process.  Only the version is read
+        from the cache, the slug list is fetched again only if it changed.
+        """
+        global _slug_index
+        version = cache.get(self.slug_index_version_key)
+        if version is None:
+            cache.add(self.slug_index_version_key, uuid4().hex, None)
+            version = cache.get(self.slug_index_version_key)
+        if (_slug_index is None or _slug_index.version != version
+                or _slug_index.expires <= time.time()):
+            _slug_index = SlugIndex(self.get_slug_list(), version)
+        return _slug_index
+
     def get_attachment_list(self, parent=None, existing_only=True,
                             cached=True, exclude_privileged=False):
         """
@@ -502,38 +559,45 @@ class PageManager(models.Manager):
 
         return attachment.file.name
 
-    def render_all_pages(self):
+    def get_render_list(self):
         """
-        This method will rerender all wiki pages (only the newest revision of them and only non-privilged ones).
-        If run on a schedule, it can guarantee that an up-to-date version is in the cache.
-
-        If a page is already in the cache, the cache entry will be dropped before rerendering it.
+        Return the ids of all pages `render_pages` renders: existing pages
+        that are neither privileged nor attachments.
         """
-        page_list = self.get_page_list(exclude_privileged=True)
-
-        for name in page_list:
-            try:
-                page = self.get_by_name(name, exclude_privileged=True)
-            except CaseSensitiveException as e:
-                page = e.page
-            except Page.DoesNotExist:
-                continue
-
-            if page.rev.attachment:
-                # page is an attachment
-                continue
+        queryset = Page.objects.filter(last_rev__deleted=False,
+                                       last_rev__attachment=None)
+        for name in settings.WIKI_PRIVILEGED_PAGES:
+            queryset = queryset.exclude(name__istartswith=name)
+        return list(queryset.order_by('id').values_list('id', flat=True))
 
-            page.rev.text.remove_value_from_cache()
+    def render_pages(self, page_ids, force=False):
+        """
+        Render the newest revision of the pages with the ids `page_ids`, if
+        the rendered text is not in the cache or stale.  A page whose text or
+        whose templates, attachments or link targets changed is not in the
+        cache anymore (see `update_related_pages`).
 
-            logger.info(f'# Start rendering {name}')
-            start = time.perf_counter()
+        The new rendered text replaces the old one, so readers never have to
+        wait for it.  Returns the names of the rendered pages.
+        """
+        pages = Page.objects.select_related('last_rev__text') \
+                            .filter(id__in=page_ids, last_rev__isnull=False)
+        texts = {page.last_rev.text_id: page for page in pages}
 
-            # as this runs normally in a celery task, prevent to spawn new celery tasks (do not use `page.rev.rendered_text`)
-            page.rev.text.value_rendered[:100]
+        start = time.perf_counter()
+        field = Text._meta.get_field('value')
+        rendered = [texts[text.id].name for text in field.refresh_rendered(
+            [page.last_rev.text for page in texts.values()], force)]
+        logger.info(f'Rendered {len(rendered)} of {len(page_ids)} pages, '
+                    f'took {time.perf_counter() - start} seconds')
+        return rendered
 
-            end = time.perf_counter()
-            time_delta = end - start
-            logger.info(f' Finished {name}, took {time_delta} seconds')
+    def render_all_pages(self, force=False):
+        """
+        Render all wiki pages in this process, see `render_pages`.  The
+        ``render_all_pages`` task renders them in parallel.
+        """
+        return self.render_pages(self.get_render_list(), force)
 
     def create(self, name, text, user=None, change_date=None,
                note=None, attachment=None, attachment_filename=None,
@@ -643,9 +707,17 @@ class PageManager(models.Manager):
             lower_names = [name.lower() for name in names]
             cache.delete_many([f'wiki/page/{name}' for name in lower_names])
             cache.delete_many([to_page_by_slug_key(name) for name in lower_names])
-        cache.delete_pattern('wiki/objects_*')
+        self._clean_slug_list()
+        if transaction.get_connection().in_atomic_block:
+            # a process may have cached the slug list without the change
+            # before it was committed
+            transaction.on_commit(self._clean_slug_list)
         update_page_by_slug.delay()
 
+    def _clean_slug_list(self):
+        cache.delete_pattern('wiki/objects_*')
+        cache.set(self.slug_index_version_key, uuid4().hex, None)
+
 
 class TextManager(models.Manager):
     """
@@ -982,9 +1054,10 @@ class Page(models.Model):
         bound to the page object.  If you don't want to save the
         revision set it to `None` before calling `save()`.
         """
-        if self.id is None:
-            Page.objects.clean_cache()
+        created = self.id is None
         models.Model.save(self)
+        if created:
+            Page.objects.clean_cache()
         if self.rev is not None:
             self.rev.save()
         deferred.clear(self)
@@ -1369,6 +1442,7 @@ class Revision(models.Model):
         models.Model.save(self, *args, **kwargs)
 
         cache.delete(f'wiki/page/{self.page.name.lower()}')
+        templates.invalidate_page_template(self.page_id)
 
     def __str__(self):
         return _('Revision %(id)d (%(title)s)') % {
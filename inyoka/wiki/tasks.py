@@ -16,6 +16,7 @@ from celery import shared_task
 from django.conf import settings
 from django.core.cache import cache
 
+from inyoka.utils.local import local_manager
 from inyoka.utils.logger import logger
 
 
@@ -63,17 +64,38 @@ def update_page_by_slug():
 
 @shared_task
 def update_related_pages(page, update_meta=True):
-    from inyoka.wiki.models import MetaData, Page
+    """
+    Invalidate the pages that were rendered with an older revision of `page`
+    and render them again in the background.
+
+    The ``X-Attach`` and ``X-Link`` metadata collected from the parse tree in
+    `Page.update_meta` is the reverse dependency index: it contains the
+    included templates and attachments and all link targets of a page.  Pages
+    that link to `page` only change if it was created or deleted, because
+    that changes the style of the link.
+    """
+    from inyoka.wiki.models import MetaData, Page, Text
     page = Page.objects.get(id=page)
-    related_pages = set()
-    values = ('value', 'page__last_rev__text_id')
-    linked = MetaData.objects.values_list(*values) \
-                     .filter(key__in=('X-Link', 'X-Attach'), value=page.name)
-    for value, text_id in linked.all():
-        cache.delete(f'wiki/page/{value.lower()}')
-        related_pages.add(text_id)
     cache.delete(f'wiki/page/{page.name.lower()}')
 
+    keys = ['X-Attach']
+    deleted = list(page.revisions.values_list('deleted', flat=True)[:2])
+    if deleted and deleted[0] != (deleted[1] if len(deleted) > 1 else True):
+        keys.append('X-Link')
+
+    dependents = MetaData.objects.filter(key__in=keys, value=page.name) \
+                                 .exclude(page=page) \
+                                 .exclude(page__last_rev=None) \
+                                 .values_list('page__name', 'page__last_rev', 'page__last_rev__text') \
+                                 .distinct()
+    rendered = set()
+    for name, rev_id, text_id in dependents:
+        cache.delete(f'wiki/page/{name.lower()}')
+        if text_id not in rendered:
+            rendered.add(text_id)
+            Text(id=text_id).remove_value_from_cache()
+            render_one_revision.delay(rev_id)
+
     if update_meta:
         page.update_meta()
 
@@ -110,16 +132,72 @@ def update_recentchanges():
     cache.set('wiki/recentchanges', recentchanges)
 
 
+#: Redis set of the pages the current `render_all_pages` run did not render
+#: yet.
+RENDER_PENDING_KEY = 'wiki/render_all_pages/pending'
+
+#: Set while a `render_all_pages` run has chunks left, it expires
+#: ``RENDER_RUNNING_TIMEOUT`` seconds after the last chunk was rendered.
+RENDER_RUNNING_KEY = 'wiki/render_all_pages/running'
+RENDER_RUNNING_TIMEOUT = 60 * 60
+
+
 @shared_task
 def render_all_pages():
     """
-    Prerenders all wiki pages.
+    Prerenders all wiki pages whose rendered text is not in the cache or
+    stale, in chunks of ``WIKI_RENDER_CHUNK_SIZE`` pages that are rendered
+    in parallel by `render_pages`.
+
+    The ids of the pages that are not rendered yet are kept in redis, a run
+    that did not finish is resumed by the next one once no chunk was
+    rendered for ``RENDER_RUNNING_TIMEOUT`` seconds.  Edited pages and the
+    pages depending on them are rendered by `update_related_pages`, so this
+    is only needed to fill an empty cache.
+    """
+    from inyoka.wiki.models import Page
+    if not cache.add(RENDER_RUNNING_KEY, True, RENDER_RUNNING_TIMEOUT):
+        logger.info('Rendering of the wiki pages is still running')
+        return
+    redis = cache.client.get_client()
+    key = cache.make_key(RENDER_PENDING_KEY)
+
+    page_ids = sorted(int(page_id) for page_id in redis.smembers(key))
+    if page_ids:
+        logger.info('Resuming rendering of %s wiki pages', len(page_ids))
+    else:
+        page_ids = Page.objects.get_render_list()
+        if page_ids:
+            redis.sadd(key, *page_ids)
+        else:
+            cache.delete(RENDER_RUNNING_KEY)
+
+    size = settings.WIKI_RENDER_CHUNK_SIZE
+    for offset in range(0, len(page_ids), size):
+        render_pages.delay(page_ids[offset:offset + size])
+
+
+@shared_task
+def render_pages(page_ids):
+    """
+    Renders the wiki pages with the ids `page_ids` for `render_all_pages`.
     """
     from inyoka.wiki.models import Page
-    Page.objects.render_all_pages()
+    local_manager.cleanup()
+    Page.objects.render_pages(page_ids)
+    redis = cache.client.get_client()
+    key = cache.make_key(RENDER_PENDING_KEY)
+    redis.srem(key, *page_ids)
+    if redis.scard(key):
+        cache.touch(RENDER_RUNNING_KEY, RENDER_RUNNING_TIMEOUT)
+    else:
+        cache.delete(RENDER_RUNNING_KEY)
 
 
 @shared_task
 def render_one_revision(revision_id: int):
     from inyoka.wiki.models import Revision
+    # the list of existing pages is cached in `local`, which is only cleaned
+    # up after requests
+    local_manager.cleanup()
     Revision.objects.get(id=revision_id).rendered_text[:100]
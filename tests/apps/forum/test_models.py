@@ -7,13 +7,27 @@
     :copyright: (c) 2011-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import pickle
+
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files.base import ContentFile
 from django.test.utils import override_settings
 from unittest.mock import patch
 
-from inyoka.forum.models import Attachment, Forum, Post, PostRevision, Topic
+from inyoka.forum.constants import READ_STATUS_VERSION
+from inyoka.forum.models import (
+    Attachment,
+    Forum,
+    Post,
+    PostRevision,
+    ReadStatus,
+    ReadStatusData,
+    RecentTopics,
+    Topic,
+    TopicOrder,
+)
+from inyoka.utils.database import content_cache
 from inyoka.utils.test import TestCase
 from tests.apps.forum.forum_test_class import ForumTestCase, ForumTestCaseWithSecondItems
 
@@ -155,6 +169,48 @@ class TestPostModel(ForumTestCase):
 
         self.assertEqual(post.get_text(), "&#x27;&#x27;&#x27;test&#x27;&#x27;&#x27;")
 
+    def test_prefetch_rendered(self):
+        self.user.signature = "''sig''"
+        self.user.save()
+        ids = [Post.objects.create(text=f"'''post {i}'''", author=self.user,
+                                   topic=self.topic, position=i).pk
+               for i in range(5)]
+        posts = list(Post.objects.filter(pk__in=ids)
+                     .order_by('pk').select_related('author'))
+
+        with patch.object(content_cache, 'get_many', wraps=content_cache.get_many) as get_many, \
+                patch.object(content_cache, 'set_many', wraps=content_cache.set_many) as set_many, \
+                patch.object(content_cache, 'get_or_set') as get_or_set:
+            Post.objects.prefetch_rendered(posts)
+            texts = [post.get_text() for post in posts]
+            signatures = {post.author.signature_rendered for post in posts}
+
+        # one query for the texts and one for the signatures
+        self.assertEqual(get_many.call_count, 2)
+        self.assertEqual(set_many.call_count, 2)
+        get_or_set.assert_not_called()
+        self.assertEqual(texts, [f'<p><strong>post {i}</strong></p>' for i in range(5)])
+        self.assertEqual(signatures, {'<p><em>sig</em></p>'})
+
+    def test_prefetch_rendered_from_cache(self):
+        post = Post.objects.create(text="'''cached'''", author=self.user,
+                                   topic=self.topic, position=0)
+        self.assertEqual(post.text_rendered, '<p><strong>cached</strong></p>')
+
+        post = Post.objects.get(pk=post.pk)
+        with patch.object(content_cache, 'set_many') as set_many:
+            Post.objects.prefetch_rendered([post])
+        set_many.assert_not_called()
+        self.assertEqual(post.text_rendered, '<p><strong>cached</strong></p>')
+
+    def test_prefetched_text_reset_on_save(self):
+        post = Post.objects.create(text='old', author=self.user,
+                                   topic=self.topic, position=0)
+        Post.objects.prefetch_rendered([post])
+        post.text = 'new'
+        post.save()
+        self.assertEqual(post.text_rendered, '<p>new</p>')
+
 
 class TestPostRevisionModel(TestCase):
 
@@ -260,6 +316,151 @@ class TestPostMove(ForumTestCaseWithSecondItems):
         self.assertEqual(self.category.last_post, second_topic_posts[-1])
 
 
+class TestTopicOrder(ForumTestCaseWithSecondItems):
+
+    def setUp(self):
+        super().setUp()
+        self.topics = [self.topic]
+        for i in range(3):
+            topic = Topic.objects.create(title=f'topic {i}', author=self.user, forum=self.forum)
+            list(self.addPosts(1, topic))
+            self.topics.append(topic)
+
+    def assertOrder(self, forum):
+        expected = Topic.objects.filter(forum=forum) \
+                                .order_by('-sticky', '-last_post') \
+                                .values_list('id', flat=True)
+        self.assertEqual(TopicOrder(forum.id)[:], list(expected))
+
+    def test_order(self):
+        order = TopicOrder(self.forum.id)
+        ids = [topic.id for topic in reversed(self.topics)]
+        self.assertEqual(order[:], ids)
+        self.assertEqual(order[1:3], ids[1:3])
+        self.assertEqual(order.count(), 4)
+
+    def test_new_post(self):
+        self.assertOrder(self.forum)
+        with self.captureOnCommitCallbacks(execute=True):
+            list(self.addPosts(1, self.topic))
+        self.assertEqual(TopicOrder(self.forum.id)[:1], [self.topic.id])
+
+    def test_sticky(self):
+        self.assertOrder(self.forum)
+        self.topics[1].sticky = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.topics[1].save()
+        self.assertEqual(TopicOrder(self.forum.id)[:1], [self.topics[1].id])
+        self.assertOrder(self.forum)
+
+    def test_move(self):
+        self.assertOrder(self.forum)
+        self.assertOrder(self.other_forum)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.topics[2].move(self.other_forum)
+        self.assertOrder(self.forum)
+        self.assertOrder(self.other_forum)
+
+    def test_split(self):
+        self.assertOrder(self.forum)
+        self.assertOrder(self.other_forum)
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.split(self.topic_posts[3:], self.topic, self.topics[1])
+        self.assertOrder(self.forum)
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.split(self.topics[2].posts.all(), self.topics[2], self.other_topic)
+        self.assertOrder(self.forum)
+        self.assertOrder(self.other_forum)
+
+    def test_delete(self):
+        post, = self.addPosts(1, self.topics[1])
+        self.assertOrder(self.forum)
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.objects.get(id=post.id).delete()
+        self.assertOrder(self.forum)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.topics[2].delete()
+        self.assertOrder(self.forum)
+
+    def test_missing_set_is_built(self):
+        self.assertOrder(self.forum)
+        cache.client.get_client().delete(TopicOrder.make_key(self.forum.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            list(self.addPosts(1, self.topic))
+        self.assertOrder(self.forum)
+
+    def test_updated_after_commit(self):
+        self.assertOrder(self.forum)
+        with self.captureOnCommitCallbacks(execute=True):
+            list(self.addPosts(1, self.topic))
+            self.assertNotEqual(TopicOrder(self.forum.id)[:1], [self.topic.id])
+        self.assertEqual(TopicOrder(self.forum.id)[:1], [self.topic.id])
+
+    def test_set_expires(self):
+        self.assertOrder(self.forum)
+        ttl = cache.client.get_client().ttl(TopicOrder.make_key(self.forum.id))
+        self.assertTrue(0 < ttl <= TopicOrder.TIMEOUT)
+
+
+class TestRecentTopics(ForumTestCaseWithSecondItems):
+
+    def setUp(self):
+        super().setUp()
+        self.topics = [self.topic, self.other_topic]
+        for i in range(3):
+            topic = Topic.objects.create(title=f'topic {i}', author=self.user, forum=self.forum)
+            list(self.addPosts(1, topic))
+            self.topics.append(topic)
+
+    def assertWindow(self):
+        expected = Topic.objects.order_by('-last_post') \
+                                .values_list('id', 'forum_id', 'last_post_id', 'ubuntu_version')
+        self.assertEqual(RecentTopics().get(),
+                         list(expected[:settings.FORUM_NEWPOSTS_WINDOW]))
+
+    def test_window(self):
+        self.assertWindow()
+        with self.captureOnCommitCallbacks(execute=True):
+            list(self.addPosts(1, self.topic))
+        self.assertEqual(RecentTopics().get()[0][0], self.topic.id)
+        self.assertWindow()
+
+    def test_unread(self):
+        read_status = ReadStatus(None)
+        ids = [topic.id for topic in reversed(self.topics)]
+        self.assertEqual(RecentTopics().unread(read_status), ids)
+
+        read_status.mark(Topic.objects.get(id=self.topics[3].id), self.user)
+        self.assertEqual(RecentTopics().unread(read_status),
+                         [i for i in ids if i != self.topics[3].id])
+        self.assertEqual(RecentTopics().unread(read_status, {self.other_forum.id}),
+                         [self.other_topic.id])
+
+    def test_unread_version(self):
+        self.topics[2].ubuntu_version = '24.04'
+        self.topics[2].save()
+        self.assertEqual(RecentTopics().unread(ReadStatus(None), ubuntu_version='24.04'),
+                         [self.topics[2].id])
+
+    @override_settings(FORUM_NEWPOSTS_WINDOW=3)
+    def test_window_is_trimmed(self):
+        self.assertWindow()
+        with self.captureOnCommitCallbacks(execute=True):
+            list(self.addPosts(1, self.topic))
+        self.assertWindow()
+        data = cache.client.get_client().hkeys(RecentTopics.make_keys()[1])
+        self.assertEqual(len(data), 3)
+
+    def test_move_and_delete(self):
+        self.assertWindow()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.topics[2].move(self.other_forum)
+        self.assertWindow()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.topics[3].delete()
+        self.assertWindow()
+
+
 class PostDeletionTest(ForumTestCase):
 
     def setUp(self):
@@ -353,3 +554,82 @@ class TestTopic(ForumTestCase):
 
         self.topic.delete()
         mock.assert_called_once_with()
+
+    def test_view_count(self):
+        Topic.objects.flush_view_counts()
+        other = Topic.objects.create(forum=self.forum, title='other', author=self.user)
+        for _ in range(3):
+            self.topic.touch()
+        other.touch()
+
+        topics = list(Topic.objects.filter(id__in=[self.topic.id, other.id]).order_by('id'))
+        self.assertEqual([t.view_count for t in topics], [0, 0])
+        Topic.objects.prefetch_view_counts(topics)
+        self.assertEqual([t.current_view_count for t in topics], [3, 1])
+
+        self.assertEqual(Topic.objects.flush_view_counts(), 2)
+        topics = list(Topic.objects.filter(id__in=[self.topic.id, other.id]).order_by('id'))
+        self.assertEqual([t.view_count for t in topics], [3, 1])
+        self.assertEqual([t.current_view_count for t in topics], [3, 1])
+        self.assertEqual(Topic.objects.flush_view_counts(), 0)
+
+    def test_view_count_failed_flush(self):
+        Topic.objects.flush_view_counts()
+        self.topic.touch()
+        with patch.object(Topic.objects, 'get_queryset', side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, Topic.objects.flush_view_counts)
+        self.topic.touch()
+
+        # the views of the failed flush are still counted
+        self.assertEqual(Topic.objects.get(id=self.topic.id).current_view_count, 2)
+        Topic.objects.flush_view_counts()
+        self.assertEqual(Topic.objects.get(id=self.topic.id).view_count, 1)
+        Topic.objects.flush_view_counts()
+        self.assertEqual(Topic.objects.get(id=self.topic.id).view_count, 2)
+
+    def test_view_count_concurrent_flush(self):
+        Topic.objects.flush_view_counts()
+        self.topic.touch()
+        with cache.lock(Topic.objects.view_count_key + ':lock', timeout=10):
+            self.assertEqual(Topic.objects.flush_view_counts(), 0)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).view_count, 0)
+        self.assertEqual(Topic.objects.flush_view_counts(), 1)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).view_count, 1)
+
+
+class TestReadStatusData(TestCase):
+
+    def test_roundtrip(self):
+        data = ReadStatusData()
+        data[3] = (10, {11, 12, 300})
+        data[1] = (None, {5})
+        data[70000] = (70001, set())
+
+        loaded = ReadStatusData(data.serialize())
+        self.assertEqual(dict(loaded), {
+            1: (None, {5}),
+            3: (10, {11, 12, 300}),
+            70000: (70001, set()),
+        })
+
+    def test_legacy_pickle(self):
+        legacy = {3: (10, {11, 12}), 1: (None, {5})}
+        data = ReadStatusData(pickle.dumps(legacy))
+        self.assertEqual(dict(data), legacy)
+
+        serialized = data.serialize()
+        self.assertEqual(serialized[0], READ_STATUS_VERSION)
+        self.assertEqual(dict(ReadStatusData(serialized)), legacy)
+
+    def test_records_are_decoded_lazily(self):
+        data = ReadStatusData()
+        data[1] = (4, {5, 6})
+        data[2] = (None, {7})
+        serialized = data.serialize()
+
+        loaded = ReadStatusData(serialized)
+        with patch.object(ReadStatusData, '_decode_row',
+                          wraps=ReadStatusData._decode_row) as decode_row:
+            self.assertEqual(loaded.get(2), (None, {7}))
+            self.assertEqual(loaded.serialize(), serialized)
+        decode_row.assert_called_once()
@@ -1,6 +1,11 @@
+import io
 from unittest.mock import patch
 
+from django.core import management
+from django.core.cache import cache
+
 from inyoka.forum.models import Forum, Post, Topic
+from inyoka.portal.models import Counter
 from inyoka.portal.user import User
 from inyoka.utils.test import TestCase
 
@@ -155,3 +160,108 @@ class TestForumTopicCount(TestCase):
         Topic.objects.create(title='topic', author=self.user, forum=sub_sub_forum)
 
         self.assertEqual(self.forum.topic_count.value(), 0)
+
+
+class TestCounters(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='test_user', email='test_user')
+        self.forum = Forum.objects.create(name='This is a test')
+        self.topic = Topic.objects.create(title='topic', author=self.user, forum=self.forum)
+        Post.objects.create(text='content', author=self.user, topic=self.topic)
+        Counter.objects.flush()
+
+    def test_value_is_stored(self):
+        self.assertEqual(self.topic.post_count.value(), 1)
+        self.assertEqual(Counter.objects.get(key=f'topic_post_count:{self.topic.id}').value, 1)
+
+    def test_missing_cache_uses_database(self):
+        self.topic.post_count.value()
+        cache.delete(self.topic.post_count.cache_key)
+
+        with patch.object(self.topic.post_count, 'db_count') as mock_db_count:
+            self.assertEqual(self.topic.post_count.value(), 1)
+        mock_db_count.assert_not_called()
+
+    def test_changes_without_cache(self):
+        self.topic.post_count.value()
+        cache.delete(self.topic.post_count.cache_key)
+        Post.objects.create(text='content', author=self.user, topic=self.topic)
+
+        self.assertEqual(self.topic.post_count.value(), 2)
+        cache.delete(self.topic.post_count.cache_key)
+        self.assertEqual(Counter.objects.flush(), 3)
+        self.assertEqual(Counter.objects.get(key=f'topic_post_count:{self.topic.id}').value, 2)
+        self.assertEqual(self.topic.post_count.value(), 2)
+        self.assertEqual(Counter.objects.flush(), 0)
+
+    def test_store_waits_for_flush(self):
+        key = f'topic_post_count:{self.topic.id}'
+        self.topic.post_count.value()
+        Post.objects.create(text='content', author=self.user, topic=self.topic)
+        with cache.lock(Counter.objects.delta_key + ':lock', timeout=10), \
+                patch.object(Counter.objects, 'store_wait', 0.1):
+            self.assertFalse(Counter.objects.store(key, 2))
+        self.assertEqual(Counter.objects.get(key=key).value, 1)
+
+        self.assertTrue(Counter.objects.store(key, 2))
+        Counter.objects.flush()
+        self.assertEqual(Counter.objects.get(key=key).value, 2)
+
+    def test_reconcile(self):
+        self.topic.post_count.value()
+        Counter.objects.filter(key=f'topic_post_count:{self.topic.id}').update(value=5)
+        key = self.topic.post_count.cache_key
+
+        self.assertEqual(Counter.objects.reconcile([key]), [(key, 5, 1)])
+        self.assertEqual(Counter.objects.reconcile([key], fix=True), [(key, 5, 1)])
+        self.assertEqual(Counter.objects.reconcile([key]), [])
+        self.assertEqual(self.topic.post_count.value(), 1)
+
+    def test_reconcile_deleted(self):
+        self.forum.topic_count.value()
+        key = self.forum.topic_count.cache_key
+        Counter.objects.filter(key=key).update(key='forum_topic_count:0')
+
+        self.assertEqual(Counter.objects.reconcile(['forum_topic_count:0']), [])
+        self.assertTrue(Counter.objects.filter(key='forum_topic_count:0').exists())
+        self.assertEqual(Counter.objects.reconcile(['forum_topic_count:0'], fix=True), [])
+        self.assertFalse(Counter.objects.filter(key='forum_topic_count:0').exists())
+
+    def test_concurrent_flush(self):
+        self.topic.post_count.value()
+        Post.objects.create(text='content', author=self.user, topic=self.topic)
+        key = f'topic_post_count:{self.topic.id}'
+
+        with cache.lock(Counter.objects.delta_key + ':lock', timeout=10):
+            self.assertEqual(Counter.objects.flush(), 0)
+        self.assertEqual(Counter.objects.get(key=key).value, 1)
+        self.assertEqual(Counter.objects.get_value(key), 2)
+        Counter.objects.flush()
+        self.assertEqual(Counter.objects.get(key=key).value, 2)
+        self.assertEqual(Counter.objects.get_value(key), 2)
+
+    def test_drift_command(self):
+        self.topic.post_count.value()
+        self.forum.post_count.value()
+        Counter.objects.filter(key=f'topic_post_count:{self.topic.id}').update(value=3)
+        out = io.StringIO()
+
+        Counter.objects.create(key='topic_post_count:0', value=1)
+        Post.objects.create(text='content', author=self.user, topic=self.topic)
+        counters = list(Counter.objects.order_by('key').values_list('key', 'value'))
+
+        management.call_command('counter_drift', prefix='topic_', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            f'topic_post_count:{self.topic.id}\t4\t2\t+2',
+            '1 of 2 counters drifted',
+        ])
+        # a run without --fix does not write anything
+        self.assertEqual(list(Counter.objects.order_by('key').values_list('key', 'value')),
+                         counters)
+
+        management.call_command('counter_drift', fix=True, stdout=io.StringIO())
+        out = io.StringIO()
+        management.call_command('counter_drift', stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[-1], '0 of 2 counters drifted')
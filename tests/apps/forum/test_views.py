@@ -37,6 +37,7 @@ from inyoka.forum.models import (
     Poll,
     PollOption,
     Post,
+    RecentTopics,
     Topic,
 )
 from inyoka.portal.user import User
@@ -178,6 +179,34 @@ class TestViews(AntiSpamTestCaseMixin, TestCase):
                          self.num_topics_on_last_page)
         self.assertTrue(self.client.get("/last24/6/").status_code == 404)
 
+    @override_settings(PROPAGATE_TEMPLATE_CONTEXT=True)
+    @patch('inyoka.forum.views.TOPICS_PER_PAGE', 4)
+    @patch('inyoka.forum.constants.TOPICS_PER_PAGE', 4)
+    def test_newposts(self):
+        self._setup_pagination()
+        read = Topic.objects.order_by('-last_post')[1]
+        self.admin._readstatus.mark(read, self.admin)
+        self.admin.forum_read_status = self.admin._readstatus.serialize()
+        self.admin.save(update_fields=('forum_read_status',))
+
+        topics = self.client.get('/newposts/').tmpl_context['topics']
+        self.assertEqual(len(topics), constants.TOPICS_PER_PAGE)
+        self.assertNotIn(read, topics)
+        unread = Topic.objects.exclude(id=read.id).order_by('-last_post')
+        self.assertEqual(list(topics), list(unread[:constants.TOPICS_PER_PAGE]))
+
+        topics = self.client.get(f'/newposts/{self.forum2.slug}/').tmpl_context['topics']
+        self.assertEqual(list(topics), [self.topic])
+
+    @override_settings(PROPAGATE_TEMPLATE_CONTEXT=True)
+    def test_newposts_without_topics(self):
+        Topic.objects.update(first_post=None)
+        cache.client.get_client().delete(*RecentTopics.make_keys())
+
+        response = self.client.get('/newposts/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.tmpl_context['topics']), [])
+
     def test_service_splittopic(self):
         t1 = Topic.objects.create(title='A: topic', slug='a:-topic',
                 author=self.user, forum=self.forum2)
@@ -1610,7 +1639,8 @@ class TestPostFeed(TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_queries(self):
-        with self.assertNumQueries(9):
+        # the anonymous user and its group permissions are kept per process
+        with self.assertNumQueries(5):
             self.client.get('/feeds/full/50/')
 
     def test_topic_hidden(self):
@@ -1723,7 +1753,8 @@ class TestPostForumFeed(TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_queries(self):
-        with self.assertNumQueries(9):
+        # the anonymous user and its group permissions are kept per process
+        with self.assertNumQueries(5):
             self.client.get(f'/feeds/forum/{self.forum.name}/full/50/')
 
     def test_child_forum(self):
@@ -1862,7 +1893,8 @@ class TestTopicFeed(TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_queries(self):
-        with self.assertNumQueries(9):
+        # the anonymous user and its group permissions are kept per process
+        with self.assertNumQueries(5):
             self.client.get(f'/feeds/topic/{self.topic.slug}/full/50/')
 
     def test_multiple_posts(self):
@@ -357,7 +357,7 @@ class TestArticleFeeds(TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_queries(self):
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             self.client.get('/feeds/full/50/')
 
     def test_multiple_articles(self):
@@ -498,7 +498,7 @@ class TestArticleCategoryFeeds(TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_queries(self):
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             self.client.get(f'/feeds/{self.cat.slug}/full/50/')
 
     def test_multiple_articles(self):
@@ -588,7 +588,7 @@ class TestCommentsFeed(TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_queries(self):
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             self.client.get(f'/feeds/comments/full/50/')
 
     def test_multiple_comments(self):
@@ -671,7 +671,7 @@ class TestCommentsPerArticleFeed(TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_queries(self):
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             self.client.get(f'/feeds/comments/{self.article.id}/full/50/')
 
     def test_multiple_comments(self):
@@ -7,12 +7,18 @@
     :copyright: (c) 2013-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+from unittest.mock import patch
+
 from django.conf import settings
 from django.test import override_settings
 
 from inyoka.markup.base import Parser, RenderContext
+from inyoka.markup.base import render as render_instructions
+from inyoka.markup.machine import Renderer
 from inyoka.markup.transformers import SmileyInjector
+from inyoka.portal.models import Linkmap
 from inyoka.portal.user import User
+from inyoka.utils.local import local_manager
 from inyoka.utils.test import TestCase
 from inyoka.utils.urls import href
 from inyoka.wiki.models import Page
@@ -264,3 +270,55 @@ Text
 """
         html = render(markup)
         self.assertHTMLEqual(html, """<table><tr class="head"><td> Command </td><td> Description </td></tr><tr><td> <div class="bash"><div class="contents"><pre class="notranslate">start </pre></div></div> </td><td> Text </td></tr></table>""")
+
+
+class TestCompiledRenderer(TestCase):
+    def test_static(self):
+        tree = Parser("'''bar'''", []).parse()
+        code = tree.compile('html')
+        self.assertTrue(code.startswith('!html\0'))
+        self.assertTrue(Renderer(code).is_static)
+        self.assertHTMLEqual(render_instructions(code, RenderContext()),
+                             '<strong>bar</strong>')
+
+    def test_dynamic(self):
+        tree = Parser("'''bar''' [[Datum(1234567890)]]", []).parse()
+        code = tree.compile('html')
+        self.assertTrue(code.startswith('@'))
+        self.assertFalse(Renderer(code).is_static)
+        self.assertEqual(render_instructions(code, RenderContext(application='wiki')),
+                         tree.render(RenderContext(application='wiki'), 'html'))
+
+
+class TestLinkResolution(TestCase):
+    def setUp(self):
+        super().setUp()
+        Page.objects.create(name='Existing', text='text')
+        Linkmap.objects.create(token='github', url='https://github.com/')
+        local_manager.cleanup()
+
+    def tearDown(self):
+        local_manager.cleanup()
+        super().tearDown()
+
+    def test_resolve_links_once(self):
+        tree = Parser('[:Existing:] [:Missing:] [:Existing:] [github:foo:] '
+                      '[github:bar:] [user:baz:]', []).parse()
+        with patch.object(Page.objects, 'get_slug_index',
+                          wraps=Page.objects.get_slug_index) as get_slug_index, \
+                patch.object(Linkmap.objects, 'get_linkmap',
+                             wraps=Linkmap.objects.get_linkmap) as get_linkmap:
+            html = tree.render(RenderContext(), 'html')
+        get_slug_index.assert_called_once_with()
+        get_linkmap.assert_called_once_with()
+        self.assertEqual(html.count('class="internal"'), 2)
+        self.assertEqual(html.count('class="internal missing"'), 1)
+        self.assertIn('href="https://github.com/foo"', html)
+        self.assertIn('href="https://github.com/bar"', html)
+        self.assertIn('href="%s"' % href('portal', 'user', 'baz'), html)
+
+    def test_no_linkmap_without_interwiki_tokens(self):
+        tree = Parser('[user:baz:] [:Existing:]', []).parse()
+        with patch.object(Linkmap.objects, 'get_linkmap') as get_linkmap:
+            tree.render(RenderContext(), 'html')
+        get_linkmap.assert_not_called()
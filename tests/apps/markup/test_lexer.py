@@ -8,12 +8,55 @@
     :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import os
+import random
 import unittest
 
-from inyoka.markup.lexer import Lexer
+from inyoka.markup.lexer import Lexer, RuleScanner
 
 lexer = Lexer()
 
+#: Snippets that cover every rule of the lexer, used to build the corpus of
+#: the differential test.
+SNIPPETS = (
+    'text ', 'ümläut ', '\n', '\n\n', '\\', '\\\\', '\\__', '\x07',
+    '## comment\n', '# X-Tag: foo, "bar baz"\n', '= Headline =\n',
+    '=== Sub ===\n', ' term:: definition\n', ' * item\n', ' 1. item\n',
+    '||<-2 foo=bar> cell || cell ||\n', '{{|<title="t"> box |}}',
+    '{{{\ncode [mark]x[/mark]\n}}}', '{{{#!code python\nprint(1)\n}}}',
+    '{{{#!vorlage Foo, "a b"\ncontent\n}}}', '<' * 40 + '\n', '=' * 40 + '\n',
+    '>' * 40 + '\n', '----\n', '<!-- comment -->', "'''", "''", '``', '`',
+    '__', '--(', ')--', '~-(', ')-~', '~+(', ')+~', ',,(', '),,', '^^(', ')^^',
+    '((', '))', '[[Inhaltsverzeichnis(2)]]', '[[Datum( "2010-01-01" )]]',
+    '[[Anker(x)]]', '[[Bild(a.png, 20, left)]]', '[@Vorlage(Foo, bar=baz)]',
+    '[color=red]', '[/color]', '[size=10]', '[/size]', '[font=Arial]',
+    '[/font]', '[mod=user]', '[/mod]', '[edit=user]', '[/edit]',
+    '[raw]raw[/raw]', '[mark]', '[/mark]', '[1]', '[http://example.com]',
+    '[http://example.com label]', '[:Page:]', '[:Page#anchor:label]',
+    '[wikipedia:Foo:bar]', 'http://example.com/path.html', 'mailto:a@b.c',
+    '[?action=edit]', '[#anchor x]', '> quote\n', '>> quote\n', ']', '[',
+    ')', '(', ':', '"', "'", ',', '=',
+)
+
+
+def make_corpus(count=300, seed=42):
+    """
+    Return random combinations of the `SNIPPETS` and the texts in the
+    directory set in the ``INYOKA_LEXER_CORPUS`` environment variable (e.g.
+    a dump of all wiki pages, one file per page).
+    """
+    rnd = random.Random(seed)
+    corpus = list(SNIPPETS)
+    for _ in range(count):
+        corpus.append(''.join(rnd.choice(SNIPPETS) for _ in range(rnd.randint(1, 40))))
+
+    directory = os.environ.get('INYOKA_LEXER_CORPUS')
+    if directory:
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                corpus.append(f.read())
+    return corpus
+
 
 class TestLexer(unittest.TestCase):
 
@@ -310,3 +353,19 @@ class TestLexer(unittest.TestCase):
     def test_control_characters_stripped(self):
         expect = lexer.tokenize('\x00\x07\x08\x0f').expect
         expect('eof')
+
+
+class TestCombinedScanner(unittest.TestCase):
+    """
+    Differential test: the lexer has to emit exactly the same tokens as if
+    the rules were tried one after another.
+    """
+
+    def test_same_tokens_as_rule_scanner(self):
+        reference = Lexer(scanner_class=RuleScanner)
+        for text in make_corpus():
+            with self.subTest(text=text[:100]):
+                self.assertEqual(
+                    list(lexer.tokenize(text)),
+                    list(reference.tokenize(text)),
+                )
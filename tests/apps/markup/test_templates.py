@@ -5,12 +5,20 @@
     :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import pickle
 import unittest
+from os import path
+from unittest.mock import patch
 
+from django.conf import settings
 from django.utils import translation
 
 from inyoka.markup import templates
+from inyoka.markup.base import Parser, RenderContext
 from inyoka.markup.templates import NoneValue, Value
+from inyoka.portal.user import User
+from inyoka.utils.test import TestCase
+from inyoka.wiki.models import Page
 
 
 class TestWikiTemplates(unittest.TestCase):
@@ -397,3 +405,54 @@ class TestBinaryFunctions(unittest.TestCase):
 
         context = [('a', '1, 2, a, b, 1.2, 3.4'), ('b', ', ')]
         self.assertEqual(templates.process(code, context), '1X2XaXbX1.2X3.4')
+
+
+class TestPageTemplateCache(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('test_user', 'test@inyoka.local')
+        self.page = Page.objects.create(
+            name=path.join(settings.WIKI_TEMPLATE_BASE, 'Greeting'),
+            text="<@ if $arguments as stripped starts_with 'W' @>Hello <@ $arguments @>!<@ endif @>",
+            user=self.user)
+
+    def render(self, markup):
+        tree = Parser(markup).parse()
+        return tree.render(RenderContext(), 'html')
+
+    def test_parsed_once(self):
+        with patch.object(templates.Parser, 'parse', autospec=True,
+                          side_effect=templates.Parser.parse) as parse:
+            html = self.render('[[Vorlage(Greeting, World)]] [[Vorlage(Greeting, Wiki)]] '
+                               '[[Vorlage(Greeting, Foo)]]')
+        self.assertEqual(parse.call_count, 1)
+        self.assertIn('Hello World!', html)
+        self.assertIn('Hello Wiki!', html)
+        self.assertNotIn('Foo', html)
+
+    def test_cached_in_redis(self):
+        self.render('[[Vorlage(Greeting, World)]]')
+        templates._page_templates.clear()
+
+        with patch.object(templates.Parser, 'parse', autospec=True) as parse:
+            html = self.render('[[Vorlage(Greeting, World)]]')
+        parse.assert_not_called()
+        self.assertIn('Hello World!', html)
+
+    def test_invalidated_on_edit(self):
+        self.render('[[Vorlage(Greeting, World)]]')
+        old_key = (self.page.id, self.page.last_rev.id)
+        self.assertIn(old_key, templates._page_templates)
+
+        self.page.edit(text='Bye <@ $arguments @>', user=self.user, note='edit')
+        self.assertNotIn(old_key, templates._page_templates)
+
+        html = self.render('[[Vorlage(Greeting, World)]]')
+        self.assertIn('Bye World', html)
+
+    def test_pickle(self):
+        template = templates.Parser(self.page.last_rev.text.value).parse()
+        context = templates.Context([('arguments', 'World')])
+        self.assertEqual(pickle.loads(pickle.dumps(template)).to_markup(context),
+                         'Hello World!')
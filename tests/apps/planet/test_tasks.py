@@ -0,0 +1,137 @@
+"""
+    tests.apps.planet.test_tasks
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Test the synchronization of the planet feeds against a local HTTP server.
+
+    :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from unittest.mock import patch
+
+from django.db import IntegrityError
+from django.test.utils import override_settings
+
+from inyoka.planet.models import Blog, Entry
+from inyoka.planet.tasks import sync
+from inyoka.utils.test import TestCase
+
+FEED = '''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+  <channel>
+    <title>{name}</title>
+    <link>http://example.com/</link>
+    <description>Test</description>
+    <item>
+      <title>Entry of {name}</title>
+      <link>http://example.com/{name}/1</link>
+      <guid>http://example.com/{name}/1</guid>
+      <description>Text of {name}</description>
+      <author>author@example.com (Author)</author>
+      <pubDate>Mon, 06 Sep 2021 16:45:00 +0000</pubDate>
+    </item>
+  </channel>
+</rss>
+'''
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        name = self.path.strip('/')
+        etag = '"%s-v1"' % name
+        self.server.requests.append((name, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = FEED.format(name=name).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(PLANET_SYNC_WORKERS=4)
+class TestSync(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        self.server.requests = []
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        base_url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.blogs = [
+            Blog.objects.create(name=f'blog{i}', blog_url='http://example.com/',
+                                feed_url=f'{base_url}blog{i}')
+            for i in range(5)
+        ]
+        Blog.objects.create(name='broken', blog_url='http://example.com/',
+                            feed_url='http://127.0.0.1:1/feed')
+
+    def test_sync(self):
+        sync()
+
+        self.assertEqual(sorted(Entry.objects.values_list('title', flat=True)),
+                         [f'Entry of blog{i}' for i in range(5)])
+        for blog in Blog.objects.filter(id__in=[b.id for b in self.blogs]):
+            self.assertEqual(blog.feed_etag, f'"{blog.name}-v1"')
+            self.assertIsNotNone(blog.last_sync)
+
+    def test_conditional_get(self):
+        sync()
+        Entry.objects.all().delete()
+        self.server.requests.clear()
+
+        sync()
+
+        # the second run sends the stored validators and the unchanged feeds
+        # are not synced again.
+        self.assertEqual(sorted(self.server.requests),
+                         [(f'blog{i}', f'"blog{i}-v1"') for i in range(5)])
+        self.assertFalse(Entry.objects.exists())
+
+    def test_unchanged_entries_are_skipped(self):
+        self.assertEqual(sync(), {'inserted': 5, 'updated': 0, 'skipped': 0, 'failed': 0})
+
+        # request the full feeds again
+        Blog.objects.update(feed_etag='')
+        entry = Entry.objects.get(guid='http://example.com/blog0/1')
+        entry.title = 'changed'
+        entry.save()
+        Entry.objects.filter(guid='http://example.com/blog1/1').update(content_hash='')
+
+        self.assertEqual(sync(), {'inserted': 0, 'updated': 1, 'skipped': 4, 'failed': 0})
+        # the hash did not change, so the title is not written again
+        self.assertEqual(Entry.objects.get(guid='http://example.com/blog0/1').title, 'changed')
+        self.assertEqual(Entry.objects.get(guid='http://example.com/blog1/1').title,
+                         'Entry of blog1')
+
+    def test_failed_entry(self):
+        save = Entry.save
+
+        def save_or_fail(entry, *args, **kwargs):
+            if entry.guid == 'http://example.com/blog0/1':
+                raise IntegrityError('broken entry')
+            return save(entry, *args, **kwargs)
+
+        with patch.object(Entry.objects, 'bulk_create', side_effect=IntegrityError), \
+                patch.object(Entry, 'save', save_or_fail):
+            self.assertEqual(sync(), {'inserted': 4, 'updated': 0, 'skipped': 0, 'failed': 1})
+
+        self.assertEqual(sorted(Entry.objects.values_list('title', flat=True)),
+                         [f'Entry of blog{i}' for i in range(1, 5)])
+        # the feed with the failed entry is fetched completely again
+        self.assertEqual(Blog.objects.get(name='blog0').feed_etag, '')
+        self.assertEqual(Blog.objects.get(name='blog1').feed_etag, '"blog1-v1"')
+        self.assertEqual(sync(), {'inserted': 1, 'updated': 0, 'skipped': 0, 'failed': 0})
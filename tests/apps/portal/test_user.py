@@ -9,11 +9,13 @@
 """
 import unittest
 from datetime import datetime, timedelta
+from unittest.mock import patch
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import Group
+from guardian.shortcuts import assign_perm
 
 from inyoka.forum.models import Forum, Post, Topic
 from inyoka.ikhaya.models import Article, Category, Comment, Event, Suggestion
@@ -110,6 +112,89 @@ class TestUserModel(TestCase):
         self.assertTrue(self.user.is_team_member)
 
 
+class TestUserPermissionCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.register_user('testing', 'example@example.com',
+                                               'pwd', False)
+        self.forums = [Forum.objects.create(name=f'forum {i}') for i in range(5)]
+        group = Group.objects.get(name=settings.INYOKA_REGISTERED_GROUP_NAME)
+        for forum in self.forums[:3]:
+            assign_perm('forum.view_forum', group, forum)
+        assign_perm('forum.add_topic_forum', self.user, self.forums[0])
+        cache.delete('/acl/%s' % self.user.id)
+
+    def test_prefetch_perms(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.prefetch_perms(self.forums)
+
+        with self.assertNumQueries(0), patch.object(cache.client, 'get_client') as get_client:
+            visible = [f for f in self.forums if user.has_perm('forum.view_forum', f)]
+            self.assertTrue(user.has_perm('forum.add_topic_forum', self.forums[0]))
+            self.assertFalse(user.has_perm('forum.add_topic_forum', self.forums[1]))
+        get_client.assert_not_called()
+        self.assertEqual(visible, self.forums[:3])
+
+    def test_cached_perms_are_shared(self):
+        User.objects.get(pk=self.user.pk).prefetch_perms(self.forums)
+
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            user.prefetch_perms(self.forums)
+            self.assertTrue(user.has_perm('forum.view_forum', self.forums[2]))
+            self.assertFalse(user.has_perm('forum.view_forum', self.forums[3]))
+
+    def test_cleared_cache(self):
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(user.has_perm('forum.view_forum', self.forums[3]))
+
+        assign_perm('forum.view_forum', self.user, self.forums[3])
+        cache.delete('/acl/%s' % self.user.id)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(user.has_perm('forum.view_forum', self.forums[3]))
+
+
+class TestSpecialUsers(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.anonymous_group = Group.objects.get(name=settings.INYOKA_ANONYMOUS_GROUP_NAME)
+        self.forum = Forum.objects.create(name='forum')
+        assign_perm('forum.view_forum', self.anonymous_group, self.forum)
+        User.objects.clear_special_users_cache()
+
+    def test_no_queries(self):
+        anonymous = User.objects.get_anonymous_user()
+        self.assertTrue(anonymous.has_perm('forum.view_forum', self.forum))
+        system = User.objects.get_system_user()
+
+        with self.assertNumQueries(0):
+            anonymous = User.objects.get_anonymous_user()
+            self.assertTrue(anonymous.is_anonymous)
+            self.assertTrue(anonymous.has_perm('forum.view_forum', self.forum))
+            self.assertEqual(User.objects.get_system_user(), system)
+
+    def test_own_instances(self):
+        anonymous = User.objects.get_anonymous_user()
+        anonymous.email = 'changed@example.com'
+        self.assertNotEqual(User.objects.get_anonymous_user().email, anonymous.email)
+
+    def test_cleared_on_save(self):
+        anonymous = User.objects.get_anonymous_user()
+        anonymous.email = 'changed@example.com'
+        anonymous.save()
+        self.assertEqual(User.objects.get_anonymous_user().email, 'changed@example.com')
+
+    def test_cleared_on_group_change(self):
+        forum = Forum.objects.create(name='other forum')
+        registered_group = Group.objects.get(name=settings.INYOKA_REGISTERED_GROUP_NAME)
+        assign_perm('forum.view_forum', registered_group, forum)
+        cache.delete_pattern('/acl/*')
+        self.assertFalse(User.objects.get_anonymous_user().has_perm('forum.view_forum', forum))
+
+        User.objects.get_anonymous_user().groups.add(registered_group)
+        self.assertTrue(User.objects.get_anonymous_user().has_perm('forum.view_forum', forum))
+
+
 class TestUserHasContent(TestCase):
     def setUp(self):
         super().setUp()
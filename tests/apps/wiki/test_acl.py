@@ -7,11 +7,23 @@
     :copyright: (c) 2012-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import random
+import re
+import unittest
+from unittest.mock import patch
+
 from django.core.cache import cache
 
 from inyoka.portal.user import User
 from inyoka.utils.test import TestCase
-from inyoka.wiki.acl import PRIV_ALL, PRIV_READ, get_privilege_flags
+from inyoka.wiki.acl import (
+    ACLMatcher,
+    PRIV_ALL,
+    PRIV_NONE,
+    PRIV_READ,
+    get_acl_matcher,
+    get_privilege_flags,
+)
 from inyoka.wiki.models import Page
 
 
@@ -53,3 +65,63 @@ test_user=-edit,-create,-attach,-manage,-delete
         self.assertEqual(get_privilege_flags('test_user', 'wild cards2/test b'), PRIV_READ)
 
         cache.delete('wiki/storage/Access-Control-List')
+
+
+def naive_privilege_flags(rules, username, page_name, groups):
+    privileges = PRIV_NONE
+    for pattern, subject, add_privs, del_privs in rules:
+        if (subject == username
+            or (subject.startswith('@') and subject[1:] in groups)) and \
+                pattern.match(page_name) is not None:
+            privileges = (privileges | add_privs) & ~del_privs
+    return privileges
+
+
+class TestACLMatcher(unittest.TestCase):
+    """
+    The compiled matcher has to return the same flags as trying every rule.
+    """
+
+    patterns = ('*', 'Foo', 'Foo/*', 'Foo/*/Bar', 'foo/bar', 'Foo.bar*',
+                '*/Baz', 'Wiki/*', 'W*i', 'Ärger/*', 'a?b*')
+    pages = ('Foo', 'foo', 'Foo/Bar', 'Foo/x/Bar', 'Foo/x/Bar/y', 'Foo.bar',
+             'Fooxbar', 'x/Baz', 'Wiki', 'Wiki/Index', 'Wiki/Index/Baz',
+             'ärger/X', 'a?b', 'aXb', 'W', 'Wi', '')
+
+    def make_rules(self, rnd):
+        rules = []
+        for _ in range(rnd.randint(1, 30)):
+            page_name = rnd.choice(self.patterns)
+            pattern = re.compile(r'^%s$' % re.escape(page_name).
+                                 replace('\\*', '.*?'), re.I)
+            rules.append((pattern, rnd.choice(('user', '@team', '@other')),
+                          rnd.randint(0, PRIV_ALL), rnd.randint(0, PRIV_ALL)))
+        return rules
+
+    def test_same_flags_as_naive(self):
+        rnd = random.Random(42)
+        for _ in range(50):
+            rules = self.make_rules(rnd)
+            matcher = ACLMatcher(rules)
+            for groups in (set(), {'team'}, {'team', 'other'}):
+                for page_name in self.pages:
+                    self.assertEqual(
+                        matcher.get_privilege_flags('user', page_name, groups),
+                        naive_privilege_flags(rules, 'user', page_name, groups),
+                    )
+
+    @patch('inyoka.wiki.acl._acl_matcher', None)
+    def test_reloaded_rules(self):
+        rules = self.make_rules(random.Random(42))
+        with patch('inyoka.wiki.acl.storage') as storage:
+            storage.acl = list(rules)
+            matcher = get_acl_matcher()
+            storage.acl = reloaded = list(rules)
+            self.assertIs(get_acl_matcher(), matcher)
+            self.assertIs(matcher.rules, reloaded)
+            with patch.object(ACLMatcher, 'get_signature') as get_signature:
+                self.assertIs(get_acl_matcher(), matcher)
+            get_signature.assert_not_called()
+
+            storage.acl = rules[:-1]
+            self.assertIsNot(get_acl_matcher(), matcher)
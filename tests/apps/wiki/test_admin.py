@@ -7,18 +7,24 @@
     :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import json
+import os
+import tarfile
+from os import path
 from shutil import rmtree
 
 from django.conf import settings
 from django.core import management
+from django.core.management.base import CommandError
+from django.db import transaction
 
 from inyoka.portal.user import User
 from inyoka.portal.models import StaticPage
-from inyoka.utils.test import TestCase
+from inyoka.utils.test import TestCase, TransactionTestCase
 from inyoka.wiki.models import Page
 
 
-class TestAdminCommands(TestCase):
+class StaticWikiMixin:
 
     def setUp(self):
         user = User.objects.create_user('test_user', 'test2@inyoka.local')
@@ -30,8 +36,59 @@ class TestAdminCommands(TestCase):
         management.call_command('collectstatic', '--noinput', '--link', verbosity=0)
 
     def tearDown(self):
-        rmtree('test_static_wiki')
+        rmtree('test_static_wiki', ignore_errors=True)
+
+
+class TestAdminCommands(StaticWikiMixin, TestCase):
 
     def test_generate_static_wiki(self):
         management.call_command('generate_static_wiki', verbosity=0, path='test_static_wiki')
 
+    def test_generate_static_wiki_incremental(self):
+        page = Page.objects.create(name='other', text='Otherfoo')
+        management.call_command('generate_static_wiki', verbosity=0, path='test_static_wiki')
+        with open(path.join('test_static_wiki', 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertEqual(set(manifest['pages']), {'test', 'other'})
+
+        # a file only the deleted page references
+        asset = path.join('test_static_wiki', 'files', '_', 'asset.png')
+        os.makedirs(path.dirname(asset), exist_ok=True)
+        with open(asset, 'w') as f:
+            f.write('asset')
+        manifest['pages']['test']['files'] = ['files/_/asset.png']
+        with open(path.join('test_static_wiki', 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        page.edit(text='Otherbar', note='edit')
+        Page.objects.get_by_name('test').edit(deleted=True, note='delete')
+        with open(path.join('test_static_wiki', 'files', 'test.html'), 'w') as f:
+            f.write('unchanged')
+        management.call_command('generate_static_wiki', verbosity=0, path='test_static_wiki',
+                                incremental=True)
+
+        self.assertFalse(path.exists(path.join('test_static_wiki', 'files', 'test.html')))
+        self.assertFalse(path.exists(asset))
+        with open(path.join('test_static_wiki', 'files', 'other.html')) as f:
+            self.assertIn('Otherbar', f.read())
+
+    def test_generate_static_wiki_workers_in_transaction(self):
+        with transaction.atomic(), self.assertRaises(CommandError):
+            management.call_command('generate_static_wiki', verbosity=0, path='test_static_wiki',
+                                    workers=2)
+
+
+class TestAdminCommandsWorkers(StaticWikiMixin, TransactionTestCase):
+
+    def test_generate_static_wiki_archive(self):
+        try:
+            management.call_command('generate_static_wiki', verbosity=0, path='test_static_wiki',
+                                    archive='test_static_wiki.tar.gz', workers=2)
+            with tarfile.open('test_static_wiki.tar.gz') as archive:
+                names = archive.getnames()
+                content = archive.extractfile('test_static_wiki/files/test.html').read()
+        finally:
+            if path.exists('test_static_wiki.tar.gz'):
+                os.unlink('test_static_wiki.tar.gz')
+        self.assertIn('test_static_wiki/files/_lizenz.html', names)
+        self.assertIn(b'Testfoo', content)
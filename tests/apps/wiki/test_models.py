@@ -1,13 +1,23 @@
 from os import path
 from unittest.mock import patch
 
-from django.core.cache import cache
+from django.core.cache import cache, caches
 from django.core.files import File
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
 
+from inyoka.utils.local import local_manager
 from inyoka.utils.test import TestCase
 from inyoka.wiki.models import Page, Attachment, Revision
 from inyoka.wiki.exceptions import CaseSensitiveException
+from inyoka.wiki.tasks import (
+    RENDER_PENDING_KEY,
+    RENDER_RUNNING_KEY,
+    render_all_pages,
+    render_one_revision,
+    render_pages,
+    update_related_pages,
+)
 
 BASE_PATH = path.dirname(__file__)
 
@@ -126,6 +136,173 @@ class TestPageManager(TestCase):
         self.assertTrue(page.rev.text.is_value_in_cache()[0])
         self.assertTrue(page2.rev.text.is_value_in_cache()[0])
 
+    def test_render_all_pages__only_stale(self):
+        """
+        Test, that only pages that are not in the cache are rendered.
+        """
+        page = Page.objects.create('test1', 'test content')
+        Page.objects.create('test2', 'test content 2')
+        page.rev.text.value_rendered
+
+        self.assertEqual(Page.objects.render_all_pages(), ['test2'])
+        self.assertEqual(sorted(Page.objects.render_all_pages(force=True)), ['test1', 'test2'])
+
+    def test_render_all_pages__attachments_and_deleted(self):
+        Page.objects.create('test1', 'test content')
+        Page.objects.create('test2', 'test content', deleted=True)
+        Page.objects.create('test3', '', attachment=SimpleUploadedFile('test3.txt', b'content'),
+                            attachment_filename='test3.txt')
+
+        self.assertEqual(Page.objects.render_all_pages(), ['test1'])
+
+
+class TestSlugIndex(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        Page.objects.create('Foo Bar', 'test content')
+        local_manager.cleanup()
+
+    def tearDown(self):
+        local_manager.cleanup()
+        super().tearDown()
+
+    def test_exists(self):
+        self.assertTrue(Page.objects.exists('Foo Bar'))
+        self.assertTrue(Page.objects.exists('foo_bar'))
+        self.assertFalse(Page.objects.exists('Foo'))
+        self.assertFalse(Page.objects.exists('zzz'))
+
+    def test_index_is_shared(self):
+        index = Page.objects.get_slug_index()
+        local_manager.cleanup()
+        with patch.object(Page.objects, 'get_slug_list') as get_slug_list:
+            self.assertIs(Page.objects.get_slug_index(), index)
+            self.assertTrue(Page.objects.exists('Foo Bar'))
+        get_slug_list.assert_not_called()
+
+    def test_index_expires(self):
+        index = Page.objects.get_slug_index()
+        with patch('inyoka.wiki.models.time.time', return_value=index.expires):
+            self.assertIsNot(Page.objects.get_slug_index(), index)
+
+    def test_version_changed_after_commit(self):
+        index = Page.objects.get_slug_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            Page.objects.create('Baz', 'test content')
+            # the slug list is cached again before the commit
+            cache.set('wiki/objects_slugs', {'foo_bar'})
+            self.assertFalse('baz' in Page.objects.get_slug_index())
+        self.assertIsNot(Page.objects.get_slug_index(), index)
+        self.assertTrue('baz' in Page.objects.get_slug_index())
+
+    def test_new_page(self):
+        self.assertFalse(Page.objects.exists('Baz'))
+        Page.objects.create('Baz', 'test content')
+        local_manager.cleanup()
+        self.assertTrue(Page.objects.exists('Baz'))
+
+    def test_deleted_page(self):
+        self.assertTrue(Page.objects.exists('Foo Bar'))
+        Page.objects.get_by_name('Foo Bar').edit(deleted=True, note='delete')
+        local_manager.cleanup()
+        self.assertFalse(Page.objects.exists('Foo Bar'))
+
+
+class TestUpdateRelatedPages(TestCase):
+    def render(self, name):
+        page = Page.objects.get_by_name(name)
+        page.update_meta()
+        return page.rev.text.value_rendered
+
+    @patch('inyoka.wiki.tasks.render_one_revision.delay')
+    def test_template_edit(self, render):
+        template = Page.objects.create('Wiki/Templates/Foo', 'old')
+        page = Page.objects.create('test', '[[Vorlage(Foo)]]')
+        other = Page.objects.create('other', 'no template')
+        self.assertIn('old', self.render('test'))
+        self.render('other')
+
+        template.edit(text='new', note='changed')
+        update_related_pages(template.id)
+
+        render.assert_called_once_with(page.last_rev_id)
+        self.assertFalse(page.rev.text.is_value_in_cache()[0])
+        self.assertTrue(other.rev.text.is_value_in_cache()[0])
+        self.assertIn('new', self.render('test'))
+
+    @patch('inyoka.wiki.tasks.render_one_revision.delay')
+    def test_link_target_created(self, render):
+        page = Page.objects.create('test', '[:target:]')
+        self.assertIn('missing', self.render('test'))
+
+        target = Page.objects.create('target', 'content')
+        update_related_pages(target.id)
+
+        render.assert_called_once_with(page.last_rev_id)
+        render_one_revision(page.last_rev_id)
+        self.assertNotIn('missing', page.rev.text.value_rendered)
+
+    @patch('inyoka.wiki.tasks.render_one_revision.delay')
+    def test_link_target_edited(self, render):
+        target = Page.objects.create('target', 'content')
+        page = Page.objects.create('test', '[:target:]')
+        self.render('test')
+
+        target.edit(text='changed', note='changed')
+        update_related_pages(target.id)
+
+        render.assert_not_called()
+        self.assertTrue(page.rev.text.is_value_in_cache()[0])
+
+
+class TestRenderAllPagesTask(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = cache.client.get_client()
+        self.key = cache.make_key(RENDER_PENDING_KEY)
+        self.redis.delete(self.key)
+        cache.delete(RENDER_RUNNING_KEY)
+        self.pages = [Page.objects.create(f'test{i}', f'content {i}') for i in range(3)]
+        self.ids = [page.id for page in self.pages]
+
+    @override_settings(WIKI_RENDER_CHUNK_SIZE=2)
+    @patch('inyoka.wiki.tasks.render_pages.delay')
+    def test_chunks(self, delay):
+        render_all_pages()
+
+        delay.assert_any_call(self.ids[:2])
+        delay.assert_any_call(self.ids[2:])
+        self.assertEqual(self.redis.smembers(self.key), {str(i).encode() for i in self.ids})
+
+    @patch('inyoka.wiki.tasks.render_pages.delay')
+    def test_resume(self, delay):
+        self.redis.sadd(self.key, self.ids[1])
+
+        render_all_pages()
+
+        delay.assert_called_once_with([self.ids[1]])
+
+    @patch('inyoka.wiki.tasks.render_pages.delay')
+    def test_running(self, delay):
+        render_all_pages()
+        delay.reset_mock()
+
+        render_all_pages()
+
+        delay.assert_not_called()
+        render_pages(self.ids)
+        self.assertIsNone(cache.get(RENDER_RUNNING_KEY))
+
+    def test_render_pages(self):
+        self.redis.sadd(self.key, *self.ids)
+
+        render_pages(self.ids[:2])
+
+        self.assertEqual(self.redis.smembers(self.key), {str(self.ids[2]).encode()})
+        self.assertTrue(self.pages[0].rev.text.is_value_in_cache()[0])
+        self.assertFalse(self.pages[2].rev.text.is_value_in_cache()[0])
+
 
 class TestAttachment(TestCase):
 
@@ -228,3 +405,38 @@ class TestAttachment(TestCase):
 
         with self.assertNumQueries(2):
             Page.objects.attachment_for_page('Döwnloads/evil.png')
+
+
+class TestText(TestCase):
+
+    def test_value_rendered__dynamic_macro(self):
+        """
+        Test, that dynamic macros are executed again on each rendering, but
+        the text is only parsed once.
+        """
+        page = Page.objects.create('test1', '[[Seitenzahl]]')
+        self.assertIn('1', page.rev.text.value_rendered)
+
+        Page.objects.create('test2', 'test content')
+        cache.delete('wiki/objects_pages_existing')
+        with patch('inyoka.utils.database.parse') as parse:
+            self.assertIn('2', page.rev.text.value_rendered)
+        self.assertFalse(parse.called)
+
+    def test_value_rendered__static_without_queries(self):
+        page = Page.objects.create('test1', "'''bold''' content")
+        self.assertIn('<strong>bold</strong>', page.rev.text.value_rendered)
+
+        with self.assertNumQueries(0):
+            self.assertIn('<strong>bold</strong>', page.rev.text.value_rendered)
+
+    def test_value_rendered__legacy_html_in_cache(self):
+        """
+        Test, that the final HTML cached by older versions is not read as
+        instructions.
+        """
+        page = Page.objects.create('test1', "'''bold''' content")
+        text = page.rev.text
+        caches['content'].set(f'wiki:text:{text.pk}:value', '<p>old html</p>')
+
+        self.assertIn('<strong>bold</strong>', text.value_rendered)
@@ -7,7 +7,9 @@
 """
 from unittest.mock import DEFAULT, MagicMock, patch
 
-from inyoka.utils.cache import RedisCache
+from django.conf import settings
+
+from inyoka.utils.cache import LocalCacheTier, RedisCache
 from inyoka.utils.test import TestCase
 
 
@@ -126,3 +128,200 @@ class TestRedisCache(TestCase):
             2,
             "sleep() should be called two times.",
         )
+
+
+class TestLocalCacheTier(TestCase):
+
+    def test_lru_is_bounded_by_size(self):
+        tier = LocalCacheTier(['*'], max_size=25)
+        tier.set('a', b'x' * 9)
+        tier.set('b', b'x' * 9)
+        tier.get('a')
+        tier.set('c', b'x' * 9)
+
+        self.assertEqual(tier.get('b'), None)
+        self.assertEqual(tier.get('a'), b'x' * 9)
+        self.assertEqual(tier.get('c'), b'x' * 9)
+        self.assertEqual(tier.size, 20)
+
+    def test_too_large_values_are_not_stored(self):
+        tier = LocalCacheTier(['*'], max_size=10)
+        tier.set('a', b'x' * 10)
+        self.assertEqual(len(tier), 0)
+
+    @patch('inyoka.utils.cache.monotonic')
+    def test_timeout(self, monotonic):
+        monotonic.return_value = 100
+        tier = LocalCacheTier(['*'], timeout=10)
+        tier.set('a', b'1')
+        monotonic.return_value = 111
+        self.assertEqual(tier.get('a'), None)
+
+    def test_matches(self):
+        tier = LocalCacheTier(['forum/forums/*', 'forum/slugs'])
+        self.assertTrue(tier.matches('forum/forums/ubuntu'))
+        self.assertTrue(tier.matches('forum/slugs'))
+        self.assertFalse(tier.matches('forum/slugs2'))
+        self.assertFalse(tier.matches('wiki/objects_slugs'))
+
+
+class TestRedisCacheLocalTier(TestCase):
+    """
+    Uses two cache objects on the same redis database to simulate two
+    processes.
+    """
+
+    def make_cache(self):
+        params = dict(settings.CACHES['default'])
+        params['OPTIONS'] = dict(params['OPTIONS'], LOCAL_CACHE={
+            'KEYS': ['hot/*'],
+            'CHECK_INTERVAL': 0,
+        })
+        return RedisCache(params['LOCATION'], params)
+
+    def setUp(self):
+        super().setUp()
+        self.first = self.make_cache()
+        self.second = self.make_cache()
+        self.first.clear()
+
+    def test_value_is_served_locally(self):
+        self.first.set('hot/key', {'a': 1})
+        self.assertEqual(self.second.get('hot/key'), {'a': 1})
+
+        redis = self.second.client.get_client()
+        redis.set(self.second.make_key('hot/key'), self.second.client.encode('other'))
+        self.assertEqual(self.second.get('hot/key'), {'a': 1})
+
+    def test_other_keys_are_not_stored(self):
+        self.first.set('cold/key', 1)
+        self.assertEqual(self.second.get('cold/key'), 1)
+        self.assertEqual(len(self.second.local_tier), 0)
+
+    def test_set_invalidates_other_processes(self):
+        self.first.set('hot/key', 'old')
+        self.assertEqual(self.second.get('hot/key'), 'old')
+
+        self.first.set('hot/key', 'new')
+        self.assertEqual(self.second.get('hot/key'), 'new')
+
+    def test_delete_many_invalidates_other_processes(self):
+        self.first.set_many({'hot/a': 1, 'hot/b': 2, 'cold/c': 3})
+        self.assertEqual(self.second.get_many(['hot/a', 'hot/b', 'cold/c']),
+                         {'hot/a': 1, 'hot/b': 2, 'cold/c': 3})
+
+        self.first.delete_many(key for key in ('hot/a', 'cold/c'))
+        self.assertEqual(self.second.get_many(['hot/a', 'hot/b', 'cold/c']),
+                         {'hot/b': 2})
+
+    def test_delete_pattern_invalidates_everything(self):
+        self.first.set('hot/key', 'value')
+        self.assertEqual(self.second.get('hot/key'), 'value')
+
+        self.first.delete_pattern('hot/*')
+        self.assertIsNone(self.second.get('hot/key'))
+
+    def test_trimmed_log_invalidates_everything(self):
+        self.first.local_tier.log_limit = 2
+        self.first.set('hot/key', 'old')
+        self.assertEqual(self.second.get('hot/key'), 'old')
+
+        self.first.set('hot/key', 'new')
+        for index in range(3):
+            self.first.set(f'hot/other{index}', index)
+        self.assertEqual(self.second.get('hot/key'), 'new')
+
+    def test_get_or_set(self):
+        self.assertEqual(self.first.get_or_set('hot/key', lambda: 'value'), 'value')
+        self.assertEqual(self.first.local_tier.get(self.first.make_key('hot/key')),
+                         self.first.client.encode('value'))
+        self.assertEqual(self.second.get_or_set('hot/key', lambda: 'other'), 'value')
+
+
+class TestRedisCacheRefresh(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        params = settings.CACHES['default']
+        self.cache = RedisCache(params['LOCATION'], params)
+        self.cache.clear()
+
+    @patch('inyoka.utils.cache.time')
+    def test_stale_value_is_served_while_refreshing(self, time):
+        time.return_value = 1000
+        self.cache.get_or_set('key', lambda: 'old', 10, stale_time=60)
+
+        time.return_value = 1011
+        redis = self.cache.client.get_client()
+        redis.set(self.cache.make_key('key') + ':status', 'updating')
+        callback = MagicMock(return_value='new')
+        self.assertEqual(self.cache.get_or_set('key', callback, 10, stale_time=60), 'old')
+        self.assertFalse(callback.called)
+
+        redis.delete(self.cache.make_key('key') + ':status')
+        self.assertEqual(self.cache.get_or_set('key', callback, 10, stale_time=60), 'new')
+        self.assertEqual(self.cache.get_or_set('key', callback, 10, stale_time=60), 'new')
+        self.assertEqual(callback.call_count, 1)
+
+    def test_stale_time_extends_expiry(self):
+        self.cache.get_or_set('key', lambda: 'value', 10, stale_time=60)
+        self.assertGreater(self.cache.ttl('key'), 60)
+
+    @patch('inyoka.utils.cache.random', return_value=0.999999)
+    @patch('inyoka.utils.cache.time')
+    def test_early_refresh(self, time, random):
+        time.return_value = 1000
+        self.cache.get_or_set('key', lambda: 'old', 10, beta=1.0)
+        self.cache.client.get_client().set(
+            self.cache.make_key('key') + ':meta', '1010 1')
+
+        time.return_value = 1005
+        self.assertEqual(self.cache.get_or_set('key', lambda: 'new', 10, beta=1.0), 'new')
+
+    @patch('inyoka.utils.cache.random', return_value=0.0)
+    @patch('inyoka.utils.cache.time')
+    def test_no_early_refresh(self, time, random):
+        time.return_value = 1000
+        self.cache.get_or_set('key', lambda: 'old', 10, beta=1.0)
+
+        time.return_value = 1005
+        self.assertEqual(self.cache.get_or_set('key', lambda: 'new', 10, beta=1.0), 'old')
+
+    def test_rebuild_metrics(self):
+        self.cache.get_or_set('wiki:text:12:value', lambda: 'a')
+        self.cache.get_or_set('wiki:text:13:value', lambda: 'b')
+
+        metrics = self.cache.get_rebuild_metrics()
+        self.assertEqual(metrics['wiki:text:*:value']['count'], 2)
+        self.assertEqual(metrics['wiki:text:*:value']['slow'], 0)
+
+    @patch('inyoka.utils.cache.logger')
+    @patch('inyoka.utils.cache.monotonic', side_effect=[0, 10])
+    def test_slow_rebuild_is_counted(self, monotonic, logger):
+        self.cache.get_or_set('key', lambda: 'a', update_time=6)
+
+        self.assertEqual(self.cache.get_rebuild_metrics()['key']['slow'], 1)
+        self.assertTrue(logger.warning.called)
+
+    def test_get_stale_keys(self):
+        self.cache.set('plain', 'value')
+        self.cache.get_or_set('fresh', lambda: 'value', 10, stale_time=60)
+        self.cache.get_or_set('stale', lambda: 'value', 10, stale_time=60)
+        self.cache.client.get_client().set(self.cache.make_key('stale') + ':meta', '0 1')
+
+        self.assertEqual(self.cache.get_stale_keys(['plain', 'fresh', 'stale', 'missing']),
+                         ['stale', 'missing'])
+
+    def test_refresh(self):
+        self.cache.get_or_set('key', lambda: 'old', 10, stale_time=60)
+
+        self.assertTrue(self.cache.refresh('key', lambda: 'new', 10, stale_time=60))
+        self.assertEqual(self.cache.get('key'), 'new')
+        self.assertEqual(self.cache.get_stale_keys(['key']), [])
+
+    def test_refresh_while_updating(self):
+        self.cache.set('key', 'old')
+        self.cache.client.get_client().set(self.cache.make_key('key') + ':status', 'updating')
+
+        self.assertFalse(self.cache.refresh('key', lambda: 'new'))
+        self.assertEqual(self.cache.get('key'), 'old')
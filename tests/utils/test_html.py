@@ -5,9 +5,48 @@
     :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import random
+from unittest.mock import patch
+
+from lxml.etree import ParserError
+
 from inyoka.utils.html import cleanup_html, replace_entities
 from inyoka.utils.test import TestCase
 
+#: Snippets used to build the corpus of the differential test.
+SNIPPETS = (
+    'text ', 'foo & bar ', 'ümläut', '<', '>', '&amp;', '&nbsp;', '&#13;',
+    '&bogus;', '\n', '\r\n', '\t', '<p>', '</p>', '<div>', '</div>', '<span>',
+    '</span>', '<b>', '</b>', '<i>', '</i>', '<nobr>', '<p id="x">', '<h1 id="y">',
+    '</h1>', '<h2>', '</h2>', '<span id="x">', '<a href="#x">', '</a>',
+    '<a href="#y" target="_blank">', '<a href=" a b ü?a=1&b=2&amp;c">',
+    '<a href="https://example.org/?a=1&amp;b=2">', '<a href="?x=1&copy;">',
+    '<a name="a b">', '<a title="ü &quot;x&quot;">', '<img src="a b.png">',
+    '<img src=b.png border=1 id="x">', '<img src="x.png" alt="a\nb">', '<br>',
+    '<hr noshade=noshade>', '<hr>', '<wbr>', '<basefont>',
+    '<font color="red" size="3" face="Arial">', '<font style="a: b;" color=blue>',
+    '</font>', '<center>', '</center>', '<u>', '</u>', '<u style="color: red">',
+    '<strike>', '</strike>', '<menu>', '</menu>', '<ul>', '</ul>', '<ol>', '</ol>',
+    '<li>', '</li>', '<dl>', '<dt>', '<dd>', '</dl>', '<code>', '</code>',
+    '<table>', '</table>', '<tbody>', '<tr>', '</tr>', '<td>', '</td>', '<th>',
+    '<caption>', '<colgroup>', '<col>', '<pre>\n', '</pre>', '<listing>\n',
+    '</listing>', '<xmp>', '</xmp>', '<noscript>', '</noscript>', '<blockquote>',
+    '</blockquote>', '<p title="it\'s">', '<p title=\'"q"\'>', '<p title="a<b>\r\nc">',
+    '<p onclick="x()">', '<script>alert(1)</script>', '<style>p {}</style>',
+    '<!-- comment -->', '<iframe src=x></iframe>', '<form>',
+    '<select><option>a</select>', '<svg><circle/></svg>', '<html>', '<body>',
+    '<title>t</title>', '<meta charset=utf-8>', '<plaintext>',
+)
+
+
+def make_corpus(count=400, seed=42):
+    """Return random combinations of the `SNIPPETS`."""
+    rnd = random.Random(seed)
+    corpus = list(SNIPPETS)
+    for _ in range(count):
+        corpus.append(''.join(rnd.choice(SNIPPETS) for _ in range(rnd.randint(1, 20))))
+    return corpus
+
 
 class TestHTML(TestCase):
 
@@ -33,3 +72,46 @@ class TestHTML(TestCase):
     def test_replace_entities(self):
         self.assertEqual(replace_entities('foo &amp; bar &raquo; foo'), 'foo & bar \xbb foo')
         self.assertEqual(replace_entities('foo &amp;amp; bar'), 'foo &amp; bar')
+
+    def test_cleanup_html_conversions(self):
+        self.assertEqual(
+            cleanup_html('<center>a</center> <u>b</u> <font color="red" size="4">c</font> '
+                         '<strike>d</strike>'),
+            '<div><span style="text-align: center;">a</span> '
+            '<span style="text-decoration: underline;">b</span> '
+            '<span style="color: red; font-size: large;">c</span> <del>d</del></div>')
+
+    def test_cleanup_html_duplicate_ids(self):
+        self.assertEqual(
+            cleanup_html('<div><h2 id="a-3">x</h2>' + '<h2 id="a">y</h2>' * 4
+                         + '<a href="#a" target="_blank">top</a></div>',
+                         id_prefix='entry-'),
+            '<div><h2 id="entry-a-3">x</h2><h2 id="entry-a">y</h2><h2 id="entry-a-2">y</h2>'
+            '<h2 id="entry-a--3">y</h2><h2 id="entry-a---4">y</h2><a href="#a">top</a></div>')
+
+    def test_single_parse(self):
+        text = ('<p>Ein <a href="https://example.org/?a=1&amp;b=2">Link</a> &amp; ümläut</p>'
+                '<ul><li><strong>eins</strong></li></ul><p><img src="bild.png"><br></p>')
+        with patch('inyoka.utils.html.parse_html') as parse_html:
+            rv = cleanup_html(text, make_xhtml=True)
+        parse_html.assert_not_called()
+        self.assertEqual(rv, cleanup_html(text, make_xhtml=True, single_parse=False))
+
+    def test_single_parse_output(self):
+        """
+        Differential test: `single_parse` has to return the same as the
+        html5lib pipeline, either from the lxml tree or by falling back.
+        """
+        def cleanup(text, **kwargs):
+            try:
+                return cleanup_html(text, id_prefix='p-', **kwargs)
+            except ParserError as exc:  # e.g. only a comment
+                return str(exc)
+
+        for text in make_corpus():
+            for make_xhtml in (False, True):
+                with self.subTest(text=text, make_xhtml=make_xhtml):
+                    self.assertEqual(
+                        cleanup(text, make_xhtml=make_xhtml),
+                        cleanup(text, make_xhtml=make_xhtml, single_parse=False),
+                    )
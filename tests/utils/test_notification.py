@@ -0,0 +1,132 @@
+"""
+    tests.utils.test_notification
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Test the fan-out of notifications to subscribers.
+
+    :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from guardian.shortcuts import assign_perm
+
+from inyoka.forum.models import Forum, Topic
+from inyoka.portal.models import Subscription
+from inyoka.portal.user import User
+from inyoka.utils.notification import (
+    _get_forum_readers,
+    queue_notifications,
+    send_notification_mails,
+)
+from inyoka.utils.test import TestCase
+
+
+class TestQueueNotifications(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = User.objects.register_user('author', 'author@example.com', 'pwd', False)
+        self.forum = Forum.objects.create(name='forum')
+        self.topic = Topic.objects.create(title='topic', author=self.author, forum=self.forum)
+        self.hidden_forum = Forum.objects.create(name='hidden')
+        self.hidden_topic = Topic.objects.create(title='hidden', author=self.author,
+                                                 forum=self.hidden_forum)
+        group = Group.objects.get(name=settings.INYOKA_REGISTERED_GROUP_NAME)
+        assign_perm('forum.view_forum', group, self.forum)
+
+        self.users = [User.objects.register_user(f'user{i}', f'user{i}@example.com', 'pwd', False)
+                      for i in range(4)]
+        for user in (self.author, *self.users):
+            Subscription.objects.create(user=user, content_object=self.topic)
+        Subscription.objects.create(user=self.users[0], content_object=self.hidden_topic)
+
+    def queue(self, **kwargs):
+        ctype = ContentType.objects.get_for_model(Topic)
+        filter = {'content_type_id': ctype.pk, 'object_id__in': [self.topic.id, self.hidden_topic.id]}
+        with patch('inyoka.utils.notification.send_notification_mails.delay') as delay:
+            notified = queue_notifications(self.author.id, 'new_post', 'subject', {},
+                                           filter=filter, **kwargs)
+        return notified, delay
+
+    def test_recipients(self):
+        self.users[1].settings['notify'] = []
+        self.users[1].save()
+        self.users[2].status = User.STATUS_DELETED
+        self.users[2].save()
+
+        notified, delay = self.queue()
+
+        self.assertEqual(sorted(notified), sorted(user.id for user in self.users))
+        delay.assert_called_once_with(
+            [('user0', 'user0@example.com'), ('user3', 'user3@example.com')],
+            'new_post', 'subject', {})
+        subscriptions = Subscription.objects.filter(object_id=self.topic.id)
+        self.assertFalse(subscriptions.filter(user__in=self.users, notified=False).exists())
+        self.assertFalse(subscriptions.get(user=self.author).notified)
+
+    def test_without_permission(self):
+        Subscription.objects.filter(content_type__model='topic', object_id=self.topic.id).delete()
+
+        notified, delay = self.queue()
+
+        self.assertEqual(notified, [self.users[0].id])
+        delay.assert_not_called()
+
+    @override_settings(NOTIFICATION_CHUNK_SIZE=2)
+    def test_chunks(self):
+        notified, delay = self.queue()
+
+        self.assertEqual(len(notified), 4)
+        recipients = [recipient for call in delay.call_args_list for recipient in call.args[0]]
+        self.assertEqual(recipients, [(user.username, user.email) for user in self.users])
+        self.assertEqual(delay.call_count, 2)
+
+    @override_settings(NOTIFICATION_CHUNK_SIZE=2)
+    def test_readers_limited_to_chunk(self):
+        lookups = []
+
+        def get_forum_readers(forum_id, readers, user_ids):
+            result = _get_forum_readers(forum_id, readers, user_ids)
+            lookups.append((set(user_ids), result))
+            return result
+
+        with patch('inyoka.utils.notification._get_forum_readers', get_forum_readers):
+            self.queue()
+
+        self.assertTrue(lookups)
+        for user_ids, readers in lookups:
+            self.assertLessEqual(readers, user_ids)
+
+    def test_queries_do_not_depend_on_subscribers(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.queue()
+        Subscription.objects.update(notified=False)
+        for i in range(4, 12):
+            user = User.objects.register_user(f'user{i}', f'user{i}@example.com', 'pwd', False)
+            Subscription.objects.create(user=user, content_object=self.topic)
+        cache.clear()
+        with self.assertNumQueries(len(queries)):
+            self.queue()
+
+
+class TestSendNotificationMails(TestCase):
+
+    def test_send(self):
+        send_notification_mails([('foo', 'foo@example.com'), ('bar', 'bar@example.com'),
+                                 ('baz', 'baz@example.invalid')],
+                                'new_post', 'subject', {'topic_title': 'topic'})
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, ['foo@example.com'])
+        self.assertTrue(mail.outbox[0].body.startswith('Hallo foo,'))
+        self.assertIn('„topic“', mail.outbox[1].body)
+        self.assertTrue(mail.outbox[1].body.startswith('Hallo bar,'))
+        self.assertEqual(mail.outbox[1].subject, settings.EMAIL_SUBJECT_PREFIX + 'subject')
@@ -9,11 +9,15 @@
 """
 
 import unittest
+from datetime import datetime
+from urllib.parse import urlsplit
 
 from django.http import Http404
 from django.test import RequestFactory
 
-from inyoka.utils.pagination import Pagination
+from inyoka.portal.user import User
+from inyoka.utils.pagination import Pagination, encode_cursor
+from inyoka.utils.test import TestCase
 
 
 class TestUtilsPagination(unittest.TestCase):
@@ -72,3 +76,82 @@ class TestUtilsPagination(unittest.TestCase):
         ]
         for l, e in zip(self.p.list(), expect):
             self.assertEqual(l, e)
+
+
+class TestKeysetPagination(TestCase):
+    ordering = ('-date_joined', '-id')
+
+    def setUp(self):
+        super().setUp()
+        for i in range(11):
+            User.objects.create(username=f'user{i}', email=f'user{i}@example.com',
+                                date_joined=datetime(2024, 1, 1 + i // 3))
+        self.query = User.objects.filter(username__startswith='user')
+        self.expected = list(self.query.order_by(*self.ordering).values_list('id', flat=True))
+
+    def get(self, url='/', page=1):
+        return Pagination(RequestFactory().get(url), self.query, page, 3,
+                          link='http://localhost/', ordering=self.ordering)
+
+    def follow(self, pagination, direction):
+        url = getattr(pagination, direction)
+        parts = urlsplit(url)
+        page = parts.path.strip('/') or 1
+        return self.get(f'{parts.path}?{parts.query}', int(page))
+
+    def ids(self, pagination):
+        return [user.id for user in pagination.get_queryset()]
+
+    def test_first_page(self):
+        pagination = self.get()
+        self.assertEqual(self.ids(pagination), self.expected[:3])
+        self.assertFalse(pagination.prev)
+        self.assertIn('after=', pagination.next)
+        self.assertEqual(pagination.pages, 4)
+
+    def test_walk_forward_and_back(self):
+        pagination = self.get()
+        pages = [self.ids(pagination)]
+        while pagination.next:
+            pagination = self.follow(pagination, 'next')
+            pages.append(self.ids(pagination))
+        self.assertEqual(pages, [self.expected[i:i + 3] for i in range(0, 11, 3)])
+        self.assertEqual(pagination.page, 4)
+
+        while pagination.prev:
+            pagination = self.follow(pagination, 'prev')
+            pages.pop()
+            self.assertEqual(self.ids(pagination), pages[-1])
+        self.assertEqual(pagination.page, 1)
+        self.assertEqual(pagination.prev, False)
+
+    def test_numbered_pages_use_offsets(self):
+        pagination = self.get('/3/', 3)
+        self.assertEqual(self.ids(pagination), self.expected[6:9])
+        self.assertEqual([link.get('url') for link in pagination.list()],
+                         ['http://localhost/', 'http://localhost/2/',
+                          'http://localhost/3/', 'http://localhost/4/'])
+
+    def test_cursor_is_stable(self):
+        pagination = self.get()
+        next_url = pagination.next
+        User.objects.create(username='user_new', email='new@example.com', date_joined=datetime(2025, 1, 1))
+        self.assertEqual(self.ids(self.follow(pagination, 'next')), self.expected[3:6])
+        self.assertNotEqual(self.get().next, next_url)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(Http404):
+            self.get('/2/?after=invalid', 2)
+        with self.assertRaises(Http404):
+            self.get(f'/2/?after={encode_cursor([1])}', 2)
+        with self.assertRaises(Http404):
+            self.get(f'/2/?after={encode_cursor(["no date", 1])}', 2).get_queryset()
+
+    def test_cursor_respects_max_pages(self):
+        pagination = self.get()
+        pagination = self.follow(pagination, 'next')
+        url = urlsplit(pagination.next)
+        request = RequestFactory().get(f'{url.path}?{url.query}')
+        with self.assertRaises(Http404):
+            Pagination(request, self.query, 3, 3, link='http://localhost/',
+                       ordering=self.ordering, max_pages=2)
@@ -0,0 +1,79 @@
+"""
+    tests.utils.test_sessions
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Test the session presence tracking.
+
+    :copyright: (c) 2007-2024 by the Inyoka Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from unittest.mock import patch
+
+from django.core.cache import cache
+
+from inyoka.portal.user import User
+from inyoka.utils.sessions import (
+    SESSION_TYPES,
+    _session_set_key,
+    get_session_counts,
+    get_sessions,
+    set_session_info,
+)
+from inyoka.utils.test import TestCase
+
+
+class FakeSession(dict):
+    new = False
+
+
+class FakeRequest:
+    subdomain = 'portal'
+
+    def __init__(self, sid, user, new=False):
+        self.user = user
+        self.session = FakeSession(sid=sid)
+        self.session.new = new
+
+
+class TestSessionInfo(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.client.get_client().delete(*(_session_set_key(t) for t in SESSION_TYPES))
+        self.user = User.objects.register_user('user', 'user@example.com', 'pwd', False)
+        self.anonymous = User.objects.get_anonymous_user()
+
+    def test_counts(self):
+        set_session_info(FakeRequest('a1', self.anonymous))
+        set_session_info(FakeRequest('a2', self.anonymous))
+        set_session_info(FakeRequest('u1', self.user))
+        # visiting again does not count the session twice
+        set_session_info(FakeRequest('u1', self.user))
+
+        self.assertEqual(get_session_counts(), {'anonymous': 2, 'user': 1, 'team': 0})
+        sessions = get_sessions()
+        self.assertEqual((sessions['all'], sessions['registered'], sessions['anonymous']), (3, 1, 2))
+        self.assertEqual([s['text'] for s in sessions['registered_sessions']], ['user'])
+
+    def test_team(self):
+        with patch.object(User, 'has_perm', return_value=True):
+            set_session_info(FakeRequest('t1', self.user))
+        self.assertEqual(get_session_counts(), {'anonymous': 0, 'user': 0, 'team': 1})
+        self.assertEqual(get_sessions()['registered_sessions'][0]['type'], 'team')
+
+    def test_login_moves_session(self):
+        set_session_info(FakeRequest('s1', self.anonymous))
+        set_session_info(FakeRequest('s1', self.user))
+        self.assertEqual(get_session_counts(), {'anonymous': 0, 'user': 1, 'team': 0})
+
+    def test_expired_sessions(self):
+        with patch('inyoka.utils.sessions.time', return_value=1000):
+            set_session_info(FakeRequest('old', self.user))
+        set_session_info(FakeRequest('new', self.anonymous))
+
+        self.assertEqual(get_session_counts(), {'anonymous': 1, 'user': 0, 'team': 0})
+        self.assertEqual(get_sessions()['registered_sessions'], [])
+
+    def test_new_session_is_not_tracked(self):
+        set_session_info(FakeRequest('n1', self.anonymous, new=True))
+        self.assertEqual(sum(get_session_counts().values()), 0)